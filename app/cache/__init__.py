@@ -4,6 +4,7 @@
 from .api_data import ApiData  # noqa: F401
 from .domain import Domain  # noqa: F401
 from .media_file import MediaFile  # noqa: F401
+from .derivative_queue import DerivativeQueue  # noqa: F401
 
 # GLOBAL VARIABLES
 
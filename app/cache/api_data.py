@@ -11,6 +11,9 @@ class ApiData(DB.Model):
 
     # #### SqlAlchemy
     __bind_key__ = 'cache'
+    __table_args__ = (
+        DB.Index('ix_api_data_site_id_type_data_id', 'site_id', 'type', 'data_id', unique=True),
+    )
 
     # #### Columns
     id = DB.Column(DB.Integer, primary_key=True)
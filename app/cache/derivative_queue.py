@@ -0,0 +1,32 @@
+# APP/CACHE/DERIVATIVE_QUEUE.PY
+
+# ##LOCAL IMPORTS
+from .. import DB
+
+
+# ##GLOBAL VARIABLES
+
+# Entries are removed once the derivatives have been created, and are left as failed otherwise. Failed
+# derivatives still get another chance when the image server is asked for them.
+QUEUE_STATES = ['pending', 'failed']
+
+
+# ##CLASSES
+
+class DerivativeQueue(DB.Model):
+    # ## Declarations
+
+    # #### SqlAlchemy
+    __bind_key__ = 'cache'
+    __table_args__ = (
+        DB.Index('ix_derivative_queue_md5', 'md5', unique=True),
+        DB.Index('ix_derivative_queue_state_id', 'state', 'id'),
+    )
+
+    # #### Columns
+    id = DB.Column(DB.Integer, primary_key=True)
+    md5 = DB.Column(DB.String(32), nullable=False)
+    file_ext = DB.Column(DB.String(6), nullable=False)
+    state = DB.Column(DB.String(8), nullable=False)
+    error = DB.Column(DB.String(255), nullable=True)
+    created = DB.Column(DB.DateTime(timezone=False), nullable=False)
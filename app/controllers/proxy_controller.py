@@ -6,8 +6,10 @@ from bs4 import BeautifulSoup
 from flask import Blueprint, request, Markup, jsonify
 
 # ## LOCAL IMPORTS
+from .. import storage
 from ..models import Post
 from ..logical.file import PutGetRaw
+from ..logical.network import GetSession
 from ..sources.base_source import GetSourceById
 from ..config import DANBOORU_USERNAME, DANBOORU_APIKEY
 
@@ -16,6 +18,10 @@ from ..config import DANBOORU_USERNAME, DANBOORU_APIKEY
 
 bp = Blueprint("proxy", __name__)
 
+DANBOORU_URL = 'https://danbooru.donmai.us'
+SAUCENAO_URL = 'https://saucenao.com'
+ASCII2D_URL = 'https://ascii2d.net'
+
 MIMETYPES = {
     'jpg': 'image/jpeg',
     'png': 'image/png',
@@ -45,7 +51,7 @@ def CheckPreprocess(post):
         'search[uploader_name]': DANBOORU_USERNAME,
         'search[md5]': post.md5,
     }
-    danbooru_resp = requests.get('https://danbooru.donmai.us/uploads.json', params=params, auth=(DANBOORU_USERNAME, DANBOORU_APIKEY))
+    danbooru_resp = GetSession(DANBOORU_URL).get(DANBOORU_URL + '/uploads.json', params=params, auth=(DANBOORU_USERNAME, DANBOORU_APIKEY))
     if danbooru_resp.status_code != 200:
         return "HTTP %d: %s; Unable to query Danbooru for existing upload: %s - %s" % (danbooru_resp.status_code, danbooru_resp.reason, DANBOORU_USERNAME, post.md5)
     data = danbooru_resp.json()
@@ -60,7 +66,7 @@ def PreprocessPost(post):
         'upload[file]': (filename, buffer, mimetype)
     }
     try:
-        danbooru_resp = requests.post('https://danbooru.donmai.us/uploads/preprocess', files=files, auth=(DANBOORU_USERNAME, DANBOORU_APIKEY), timeout=30)
+        danbooru_resp = GetSession(DANBOORU_URL).post(DANBOORU_URL + '/uploads/preprocess', files=files, auth=(DANBOORU_USERNAME, DANBOORU_APIKEY), timeout=30)
     except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError) as e:
         return "Connection error: %s" % e
     if danbooru_resp.status_code != 200:
@@ -128,16 +134,16 @@ def danbooru_iqdb():
     if post is None:
         return "Post #d not found." % post_id
     file_path = post.file_path if post.file_ext != 'mp4' else post.sample_path
-    buffer = PutGetRaw(file_path, 'rb')
+    buffer = storage.ReadFile(file_path)
     files = {
         'search[file]': buffer,
     }
-    resp = requests.post('https://danbooru.donmai.us/iqdb_queries', files=files, auth=(DANBOORU_USERNAME, DANBOORU_APIKEY))
+    resp = GetSession(DANBOORU_URL).post(DANBOORU_URL + '/iqdb_queries', files=files, auth=(DANBOORU_USERNAME, DANBOORU_APIKEY))
     if resp.status_code != 200:
         return "HTTP Error %d: %s" % (resp.status_code, resp.reason)
     soup = BeautifulSoup(resp.text, 'lxml')
     base = soup.new_tag("base")
-    base['href'] = 'https://danbooru.donmai.us'
+    base['href'] = DANBOORU_URL
     soup.head.insert(0, base)
     return Markup(soup.prettify())
 
@@ -151,16 +157,16 @@ def saucenao():
     if post is None:
         return "Post #d not found." % post_id
     file_path = post.file_path if post.file_ext != 'mp4' else post.sample_path
-    buffer = PutGetRaw(file_path, 'rb')
+    buffer = storage.ReadFile(file_path)
     files = {
         'file': buffer,
     }
-    resp = requests.post('https://saucenao.com/search.php', files=files)
+    resp = GetSession(SAUCENAO_URL).post(SAUCENAO_URL + '/search.php', files=files)
     if resp.status_code != 200:
         return "HTTP Error %d: %s" % (resp.status_code, resp.reason)
     soup = BeautifulSoup(resp.text, 'lxml')
     base = soup.new_tag("base")
-    base['href'] = 'https://saucenao.com'
+    base['href'] = SAUCENAO_URL
     soup.head.insert(0, base)
     return Markup(soup.prettify())
 
@@ -174,16 +180,16 @@ def ascii2d():
     if post is None:
         return "Post #d not found." % post_id
     file_path = post.file_path if post.file_ext != 'mp4' else post.sample_path
-    buffer = PutGetRaw(file_path, 'rb')
+    buffer = storage.ReadFile(file_path)
     filename = post.md5 + '.' + post.file_ext
     files = {
         'file': (filename, buffer, 'application/octet-stream')
     }
-    resp = requests.post('https://ascii2d.net/search/file', files=files)
+    resp = GetSession(ASCII2D_URL).post(ASCII2D_URL + '/search/file', files=files)
     if resp.status_code != 200:
         return "HTTP Error %d: %s" % (resp.status_code, resp.reason)
     soup = BeautifulSoup(resp.text, 'lxml')
     base = soup.new_tag("base")
-    base['href'] = 'https://ascii2d.net'
+    base['href'] = ASCII2D_URL
     soup.head.insert(0, base)
     return Markup(soup.prettify())
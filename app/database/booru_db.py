@@ -124,3 +124,24 @@ def CheckArtistsBooru(booru):
 def BooruAppendArtist(booru, artist):
     booru.artists.append(artist)
     SESSION.commit()
+
+
+def BatchAppendBooruArtists(artist_matches):
+    """Takes (artist, danbooru artist) pairs, creating any boorus that don't exist yet. Everything gets committed at once."""
+    danbooru_ids = set(danbooru_artist['id'] for _, danbooru_artist in artist_matches)
+    boorus = {booru.danbooru_id: booru for booru in models.Booru.query.filter(models.Booru.danbooru_id.in_(danbooru_ids)).all()}
+    new_names = set(danbooru_artist['name'] for _, danbooru_artist in artist_matches if danbooru_artist['id'] not in boorus)
+    labels = {label.name: label for label in models.Label.query.filter(models.Label.name.in_(new_names)).all()} if len(new_names) else {}
+    current_time = GetCurrentTime()
+    for artist, danbooru_artist in artist_matches:
+        booru = boorus.get(danbooru_artist['id'])
+        if booru is None:
+            name = danbooru_artist['name']
+            if name not in labels:
+                labels[name] = models.Label(name=name)
+            booru = boorus[danbooru_artist['id']] = models.Booru(danbooru_id=danbooru_artist['id'], current_name=name, created=current_time, updated=current_time)
+            booru.names.append(labels[name])
+            SESSION.add(booru)
+        if artist not in booru.artists:
+            booru.artists.append(artist)
+    SESSION.commit()
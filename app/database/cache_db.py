@@ -2,55 +2,87 @@
 
 # ##PYTHON IMPORTS
 import requests
+from sqlalchemy.dialects import sqlite, postgresql
 
 # ##LOCAL IMPORTS
 from .. import SESSION
 from ..logical.utility import GetCurrentTime, DaysFromNow, GetBufferChecksum
 from ..logical.network import GetHTTPFile
 from ..logical.file import CreateDirectory, PutGetRaw
+from ..logical.ttl_cache import TTLCache
 from ..cache import ApiData, MediaFile
+from ..config import API_CACHE_SIZE, API_CACHE_TTL
+
+
+# ##GLOBAL VARIABLES
+
+# Stays under the default SQLite limit on the number of variables in a single statement
+API_DATA_READ_CHUNK_SIZE = 900
+
+# The data of API items keyed by (site_id, type, data_id). Since each process has its own, items are also
+# limited by the TTL so that saves from other processes get picked up. The data must not be modified.
+API_CACHE = TTLCache(API_CACHE_SIZE, API_CACHE_TTL)
 
 
 # ##FUNCTIONS
 
 
 def GetApiData(data_ids, site_id, type):
+    data_ids = list(set(data_ids))
     cache_data = []
-    for i in range(0, len(data_ids), 100):
-        sublist = data_ids[i: i + 100]
+    for i in range(0, len(data_ids), API_DATA_READ_CHUNK_SIZE):
+        sublist = data_ids[i: i + API_DATA_READ_CHUNK_SIZE]
         cache_data += _GetApiData(sublist, site_id, type)
     return cache_data
 
 
+def GetApiItems(data_ids, site_id, type):
+    """The data of the items found, in the order of the IDs. Only the items missing from the in-process cache get queried."""
+    items = {}
+    missing_ids = []
+    for data_id in set(data_ids):
+        data = API_CACHE.get((site_id, type, data_id))
+        if data is not None:
+            items[data_id] = data
+        else:
+            missing_ids.append(data_id)
+    if len(missing_ids):
+        for cache_item in GetApiData(missing_ids, site_id, type):
+            items[cache_item.data_id] = cache_item.data
+            API_CACHE.set((site_id, type, cache_item.data_id), cache_item.data, cache_item.expires)
+    return [items[data_id] for data_id in data_ids if data_id in items]
+
+
+def GetApiItem(data_id, site_id, type):
+    items = GetApiItems([data_id], site_id, type)
+    return items[0] if len(items) else None
+
+
 def GetApiArtist(site_artist_id, site_id):
-    cache = GetApiData([site_artist_id], site_id, 'artist')
-    return cache[0].data if len(cache) else None
+    return GetApiItem(site_artist_id, site_id, 'artist')
 
 
 def GetApiIllust(site_illust_id, site_id):
-    cache = GetApiData([site_illust_id], site_id, 'illust')
-    return cache[0].data if len(cache) else None
+    return GetApiItem(site_illust_id, site_id, 'illust')
+
+
+def GetApiCacheStatus():
+    return API_CACHE.status()
 
 
 def SaveApiData(network_data, id_key, site_id, type):
-    data_ids = [int(data[id_key]) for data in network_data]
-    cache_data = GetApiData(data_ids, site_id, type)
+    """Insert or update all of the items with a single upsert statement on the unique (site_id, type, data_id) index"""
+    expires = DaysFromNow(1)
+    cache_rows = {}
     for data_item in network_data:
         data_id = int(data_item[id_key])
-        cache_item = next(filter(lambda x: x.data_id == data_id, cache_data), None)
-        if not cache_item:
-            data = {
-                'site_id': site_id,
-                'type': type,
-                'data_id': data_id,
-            }
-            cache_item = ApiData(**data)
-            SESSION.add(cache_item)
-        else:
-            print("SaveApiData - updating cache item:", type, data_id, cache_item.id)
-        cache_item.data = data_item
-        cache_item.expires = DaysFromNow(1)
+        cache_rows[data_id] = {'site_id': site_id, 'type': type, 'data_id': data_id, 'data': data_item, 'expires': expires}
+    if len(cache_rows) == 0:
+        return
+    SESSION.execute(_ApiDataUpsert(), list(cache_rows.values()), bind_arguments={'mapper': ApiData.__mapper__})
     SESSION.commit()
+    for data_id, cache_row in cache_rows.items():
+        API_CACHE.set((site_id, type, data_id), cache_row['data'], expires)
 
 
 def GetMediaData(image_url, source):
@@ -74,6 +106,14 @@ def _GetApiData(data_ids, site_id, type):
     return q.all()
 
 
+def _ApiDataUpsert():
+    dialect_name = SESSION().get_bind(mapper=ApiData.__mapper__).dialect.name
+    insert = postgresql.insert if dialect_name == 'postgresql' else sqlite.insert
+    statement = insert(ApiData.__table__)
+    return statement.on_conflict_do_update(index_elements=['site_id', 'type', 'data_id'],
+                                           set_={'data': statement.excluded.data, 'expires': statement.excluded.expires})
+
+
 def _CreateNewMedia(download_url, source):
     buffer = GetHTTPFile(download_url, headers=source.IMAGE_HEADERS)
     if isinstance(buffer, Exception):
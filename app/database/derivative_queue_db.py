@@ -0,0 +1,54 @@
+# APP/DATABASE/DERIVATIVE_QUEUE_DB.PY
+
+# ## LOCAL IMPORTS
+from .. import SESSION
+from ..logical.utility import GetCurrentTime
+from ..cache import DerivativeQueue
+
+
+# ## GLOBAL VARIABLES
+
+QUEUE_CHUNK_SIZE = 100
+
+MAX_ERROR_LENGTH = 255
+
+
+# ## FUNCTIONS
+
+# #### Query functions
+
+def GetDerivativeQueueBatch(limit=100):
+    """Oldest pending entries first; served by the (state, id) index"""
+    return DerivativeQueue.query.filter_by(state='pending').order_by(DerivativeQueue.id).limit(limit).all()
+
+
+# #### Update functions
+
+def EnqueueDerivatives(images):
+    """Add the images as (md5, file_ext), or move them back to pending if they are already on the queue"""
+    images = dict(images)
+    md5s = list(images.keys())
+    current_time = GetCurrentTime()
+    existing_md5s = set()
+    for i in range(0, len(md5s), QUEUE_CHUNK_SIZE):
+        q = DerivativeQueue.query.filter(DerivativeQueue.md5.in_(md5s[i: i + QUEUE_CHUNK_SIZE]))
+        existing_md5s.update(x[0] for x in q.with_entities(DerivativeQueue.md5).all())
+        q.update({'state': 'pending', 'error': None}, synchronize_session=False)
+    new_rows = [{'md5': md5, 'file_ext': file_ext, 'state': 'pending', 'created': current_time}
+                for (md5, file_ext) in images.items() if md5 not in existing_md5s]
+    SESSION.bulk_insert_mappings(DerivativeQueue, new_rows)
+    SESSION.commit()
+
+
+def SetDerivativeQueueFailed(md5, error):
+    DerivativeQueue.query.filter_by(md5=md5).update({'state': 'failed', 'error': error[:MAX_ERROR_LENGTH]}, synchronize_session=False)
+    SESSION.commit()
+
+
+# #### Delete functions
+
+def DeleteDerivativeQueueEntries(md5s):
+    md5s = list(set(md5s))
+    for i in range(0, len(md5s), QUEUE_CHUNK_SIZE):
+        DerivativeQueue.query.filter(DerivativeQueue.md5.in_(md5s[i: i + QUEUE_CHUNK_SIZE])).delete(synchronize_session=False)
+    SESSION.commit()
@@ -2,6 +2,7 @@
 
 # ##PYTHON IMPORTS
 import datetime
+import threading
 
 # ##LOCAL IMPORTS
 from .. import models, SESSION
@@ -21,6 +22,10 @@ APPEND_SCALAR_RELATIONSHIPS = [('commentaries', 'body', models.Description)]
 CREATE_ALLOWED_ATTRIBUTES = ['artist_id', 'site_id', 'site_illust_id', 'site_created', 'pages', 'score', 'active', 'tags', 'commentaries']
 UPDATE_ALLOWED_ATTRIBUTES = ['site_id', 'site_illust_id', 'site_created', 'pages', 'score', 'active', 'tags', 'commentaries']
 
+# The worker runs uploads of different illusts at the same time, which can be by the same artist that doesn't exist yet.
+# Looking up and creating the artist is done under a lock picked by the site artist ID, so it only gets created once.
+ARTIST_LOCKS = [threading.Lock() for i in range(32)]
+
 
 # ## FUNCTIONS
 
@@ -78,11 +83,12 @@ def CreateIllustFromSource(site_illust_id, source):
     createparams = source.GetIllustData(site_illust_id)
     if not createparams['active']:
         return
-    artist = GetSiteArtist(createparams['site_artist_id'], source.SITE_ID)
-    if artist is None:
-        artist = CreateArtistFromSource(createparams['site_artist_id'], source)
+    with ARTIST_LOCKS[hash((source.SITE_ID, createparams['site_artist_id'])) % len(ARTIST_LOCKS)]:
+        artist = GetSiteArtist(createparams['site_artist_id'], source.SITE_ID)
         if artist is None:
-            return
+            artist = CreateArtistFromSource(createparams['site_artist_id'], source)
+    if artist is None:
+        return
     createparams['artist_id'] = artist.id
     return CreateIllustFromParameters(createparams)
 
@@ -0,0 +1,33 @@
+# APP/DATABASE/SIMILARITY_HASH_CACHE_DB.PY
+
+# ## LOCAL IMPORTS
+from .. import SESSION
+from ..similarity import SimilarityHashCache
+
+
+# ## FUNCTIONS
+
+# #### Query functions
+
+def GetCachedHashes(md5s, algorithm, hash_size):
+    """Returns a dictionary of file md5 -> variant -> hex hash"""
+    cached_hashes = {}
+    md5s = list(set(md5s))
+    for i in range(0, len(md5s), 100):
+        q = SimilarityHashCache.query.filter(SimilarityHashCache.md5.in_(md5s[i: i + 100]))
+        q = q.filter_by(algorithm=algorithm, hash_size=hash_size)
+        for cache_item in q.all():
+            cached_hashes.setdefault(cache_item.md5, {})[cache_item.variant] = cache_item.image_hash
+    return cached_hashes
+
+
+# #### Misc functions
+
+def AddCachedHashes(entries, algorithm, hash_size):
+    """Add the (file md5, variant) -> hex hash entries to the session, skipping any that are already cached; committed
+    along with the similarity data. Posts with identical files end up with the same key, so the entries are a dictionary."""
+    cached_hashes = GetCachedHashes([md5 for (md5, variant) in entries], algorithm, hash_size)
+    for (md5, variant), image_hash in entries.items():
+        if variant in cached_hashes.get(md5, {}):
+            continue
+        SESSION.add(SimilarityHashCache(md5=md5, variant=variant, algorithm=algorithm, hash_size=hash_size, image_hash=image_hash))
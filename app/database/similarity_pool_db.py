@@ -0,0 +1,36 @@
+# APP/DATABASE/SIMILARITY_POOL_DB.PY
+
+# ## PYTHON IMPORTS
+from collections import Counter
+
+# ## LOCAL IMPORTS
+from .. import SESSION
+from ..logical.utility import GetCurrentTime
+from ..similarity import SimilarityPool, SimilarityPoolElement
+
+
+# ## FUNCTIONS
+
+# #### Bulk functions
+
+def BulkReplaceSimilarityPools(post_ids, pair_results):
+    """Replace all similarity pools with one pool per post, with each (post_id1, post_id2, score) as sibling elements"""
+    current_time = GetCurrentTime()
+    pool_id_by_post_id = {post_id: i + 1 for i, post_id in enumerate(sorted(set(post_ids)))}
+    element_counts = Counter()
+    element_rows = []
+    for post_id1, post_id2, score in pair_results:
+        element_id = len(element_rows) + 1
+        element_rows.append({'id': element_id, 'pool_id': pool_id_by_post_id[post_id1], 'post_id': post_id2, 'score': score, 'sibling_id': element_id + 1})
+        element_rows.append({'id': element_id + 1, 'pool_id': pool_id_by_post_id[post_id2], 'post_id': post_id1, 'score': score, 'sibling_id': element_id})
+        element_counts[post_id1] += 1
+        element_counts[post_id2] += 1
+    pool_rows = [{'id': pool_id, 'post_id': post_id, 'element_count': element_counts[post_id], 'created': current_time, 'updated': current_time}
+                 for post_id, pool_id in pool_id_by_post_id.items()]
+    SimilarityPoolElement.query.update({'sibling_id': None})
+    SimilarityPoolElement.query.delete()
+    SimilarityPool.query.delete()
+    SESSION.bulk_insert_mappings(SimilarityPool, pool_rows)
+    SESSION.bulk_insert_mappings(SimilarityPoolElement, element_rows)
+    SESSION.commit()
+    return len(pool_rows), len(element_rows)
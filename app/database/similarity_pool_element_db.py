@@ -32,7 +32,7 @@ def DeleteSimilarityPoolElement(similarity_pool_element):
 def BatchDeleteSimilarityPoolElement(similarity_pool_elements):
     pool_element_ids = [element.id for element in similarity_pool_elements]
     pool_element_ids += [element.sibling_id for element in similarity_pool_elements if element.sibling_id is not None]
-    similarity_pools = UniqueObjects(similarity_pool_elements + [element.sibling.pool for element in similarity_pool_elements if element.sibling_id is not None])  # This could maybe be done better
+    similarity_pools = UniqueObjects([element.pool for element in similarity_pool_elements] + [element.sibling.pool for element in similarity_pool_elements if element.sibling_id is not None])  # This could maybe be done better
     SimilarityPoolElement.query.filter(SimilarityPoolElement.id.in_(pool_element_ids)).update({'sibling_id': None})
     SESSION.commit()
     SimilarityPoolElement.query.filter(SimilarityPoolElement.id.in_(pool_element_ids)).delete()
@@ -0,0 +1,66 @@
+# APP/DATABASE/SIMILARITY_QUEUE_DB.PY
+
+# ## LOCAL IMPORTS
+from .. import SESSION
+from ..logical.utility import GetCurrentTime
+from ..similarity import SimilarityQueue
+
+
+# ## GLOBAL VARIABLES
+
+QUEUE_CHUNK_SIZE = 100
+
+MAX_ERROR_LENGTH = 255
+
+
+# ## FUNCTIONS
+
+# #### Query functions
+
+def GetSimilarityQueueBatch(state, limit=100):
+    """Oldest entries first; served by the (state, id) index so it never scans past the batch"""
+    return SimilarityQueue.query.filter_by(state=state).order_by(SimilarityQueue.id).limit(limit).all()
+
+
+def GetQueuedPostIDs():
+    return set(x[0] for x in SESSION.query(SimilarityQueue.post_id).all())
+
+
+# #### Update functions
+
+def EnqueueSimilarityPosts(post_ids, state='pending'):
+    """Add the posts to the queue, or move them back to the given state if they are already on it"""
+    post_ids = list(set(post_ids))
+    current_time = GetCurrentTime()
+    existing_post_ids = set()
+    for i in range(0, len(post_ids), QUEUE_CHUNK_SIZE):
+        q = SimilarityQueue.query.filter(SimilarityQueue.post_id.in_(post_ids[i: i + QUEUE_CHUNK_SIZE]))
+        existing_post_ids.update(x[0] for x in q.with_entities(SimilarityQueue.post_id).all())
+        q.update({'state': state, 'error': None, 'updated': current_time}, synchronize_session=False)
+    new_rows = [{'post_id': post_id, 'state': state, 'created': current_time, 'updated': current_time}
+                for post_id in post_ids if post_id not in existing_post_ids]
+    SESSION.bulk_insert_mappings(SimilarityQueue, new_rows)
+    SESSION.commit()
+
+
+def SetSimilarityQueueState(post_ids, state, error=None):
+    post_ids = list(set(post_ids))
+    update = {'state': state, 'error': error[:MAX_ERROR_LENGTH] if error is not None else None, 'updated': GetCurrentTime()}
+    for i in range(0, len(post_ids), QUEUE_CHUNK_SIZE):
+        SimilarityQueue.query.filter(SimilarityQueue.post_id.in_(post_ids[i: i + QUEUE_CHUNK_SIZE])).update(update, synchronize_session=False)
+    SESSION.commit()
+
+
+def ResetSimilarityQueueState(from_states, to_state):
+    update = {'state': to_state, 'error': None, 'updated': GetCurrentTime()}
+    SimilarityQueue.query.filter(SimilarityQueue.state.in_(from_states)).update(update, synchronize_session=False)
+    SESSION.commit()
+
+
+# #### Delete functions
+
+def DeleteSimilarityQueuePosts(post_ids):
+    post_ids = list(set(post_ids))
+    for i in range(0, len(post_ids), QUEUE_CHUNK_SIZE):
+        SimilarityQueue.query.filter(SimilarityQueue.post_id.in_(post_ids[i: i + QUEUE_CHUNK_SIZE])).delete(synchronize_session=False)
+    SESSION.commit()
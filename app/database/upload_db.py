@@ -5,7 +5,7 @@ import re
 
 # ## LOCAL IMPORTS
 from .. import models, SESSION
-from ..logical.utility import GetCurrentTime
+from ..logical.utility import GetCurrentTime, SecondsAgo
 from .base_db import UpdateColumnAttributes, UpdateRelationshipCollections
 
 
@@ -27,6 +27,7 @@ def CreateUploadFromParameters(createparams):
     data = {
         'successes': 0,
         'failures': 0,
+        'resumes': 0,
         'status': 'pending',
         'subscription_id': None,
         'created': GetCurrentTime(),
@@ -40,6 +41,46 @@ def CreateUploadFromParameters(createparams):
     return upload
 
 
+# ###### UPDATE
+
+def SetUploadStep(upload, illust_url, state, download=None):
+    """Checkpoint the illust URL of the upload. The download (md5, file_ext, size) is kept from earlier steps if not given."""
+    SetStepState(upload, illust_url, state, download)
+    upload.heartbeat = GetCurrentTime()
+    SESSION.commit()
+
+
+def StartUploadProcessing(upload):
+    upload.status = 'processing'
+    upload.heartbeat = GetCurrentTime()
+    SESSION.commit()
+
+
+def ResumeUpload(upload):
+    upload.status = 'pending'
+    upload.resumes += 1
+    upload.heartbeat = None
+    SESSION.commit()
+
+
+def UpdateUploadHeartbeats(upload_ids):
+    if len(upload_ids) == 0:
+        return
+    models.Upload.query.filter(models.Upload.id.in_(upload_ids)).update({'heartbeat': GetCurrentTime()}, synchronize_session=False)
+    SESSION.commit()
+
+
+# #### Query functions
+
+def GetStalledUploads(timeout, exclude_ids=None):
+    """Uploads left in processing without a recent heartbeat, i.e. whose worker is gone or hung"""
+    q = models.Upload.query.filter_by(status='processing')
+    q = q.filter((models.Upload.heartbeat.is_(None)) | (models.Upload.heartbeat < SecondsAgo(timeout)))
+    if exclude_ids:
+        q = q.filter(models.Upload.id.not_in(list(exclude_ids)))
+    return q.all()
+
+
 # #### Misc functions
 
 
@@ -52,16 +93,37 @@ def SetUploadStatus(upload, status):
     SESSION.commit()
 
 
-def AddUploadSuccess(upload):
+def AddUploadSuccess(upload, illust_url=None):
+    """The illust URL is checkpointed in the same commit, so that a resumed upload never counts it twice"""
     upload.successes += 1
+    if illust_url is not None:
+        SetStepState(upload, illust_url, 'complete')
     SESSION.commit()
 
 
-def AddUploadFailure(upload):
+def AddUploadFailure(upload, illust_url=None):
     upload.failures += 1
+    if illust_url is not None:
+        SetStepState(upload, illust_url, 'failed')
     SESSION.commit()
 
 
 def UploadAppendPost(upload, post):
-    upload.posts.append(post)
+    if post not in upload.posts:
+        upload.posts.append(post)
     SESSION.commit()
+
+
+# #### Private functions
+
+def SetStepState(upload, illust_url, state, download=None):
+    step = upload.get_step(illust_url)
+    if step is None:
+        step = models.UploadStep(illust_url_id=illust_url.id)
+        upload.steps.append(step)
+    step.state = state
+    step.updated = GetCurrentTime()
+    if download is not None:
+        step.md5 = download['md5']
+        step.file_ext = download['file_ext']
+        step.size = download['size']
@@ -17,6 +17,10 @@ DB_PATH = r'db\prebooru.db'
 CACHE_PATH = r'db\cache.db'
 SIMILARITY_PATH = r'db\similarity.db'
 
+# Number of API data items kept in memory by each process, and the most seconds that an item stays there
+API_CACHE_SIZE = 2000
+API_CACHE_TTL = 300
+
 
 # ## NETWORK VARIABLES
 
@@ -35,6 +39,106 @@ IMAGE_PORT = 1234
 
 HAS_EXTERNAL_IMAGE_SERVER = False
 
+# Server used by images.py: 'auto' picks gunicorn when installed (not on Windows), then waitress, then the Flask server.
+# Worker processes only apply to gunicorn, and default to the number of cores when set to None.
+IMAGE_SERVER = 'auto'
+IMAGE_SERVER_WORKERS = None
+IMAGE_SERVER_THREADS = 8
+
+# Connections kept open to each host by the shared HTTP sessions; requests beyond this wait for a free connection
+NETWORK_HOST_CONNECTIONS = 8
+
+# Retries for connection errors, timeouts and server errors, waiting BACKOFF * 2^(retry - 1) seconds in between
+NETWORK_RETRIES = 3
+NETWORK_BACKOFF = 2.0
+
+# Seconds allowed for a single fetch by the fetch engine, including any retries
+NETWORK_FETCH_TIMEOUT = 300
+
+# Requests per second and burst size for each host, used as the starting point for the adaptive rate limiter.
+# Hosts that are not listed use the default.
+RATE_LIMITS = {
+    'www.pixiv.net': (1.0, 5),
+    'api.twitter.com': (1.0, 5),
+    'twitter.com': (1.0, 5),
+    'danbooru.donmai.us': (2.0, 10),
+}
+RATE_LIMIT_DEFAULT = (10.0, 20)
+
+# Lowest requests per second the rate limiter will back off to
+RATE_LIMIT_MINIMUM = 0.1
+
+
+# ## SIMILARITY VARIABLES
+
+# Candidate lookup for similarity queries: 'mih' (multi-index hashing) or 'scan' (full scan)
+SIMILARITY_CANDIDATE_GENERATOR = 'mih'
+
+# Number of disjoint substrings the hash is split into (must be a multiple of 4).
+# Recall is exact for Hamming distances below MIH_SUBSTRINGS * (radius + 1), with the
+# radius being chosen per query from the minimum score, up to MIH_MAX_RADIUS.
+MIH_SUBSTRINGS = 16
+MIH_MAX_RADIUS = 2
+
+# Number of processes used for hashing post images
+SIMILARITY_HASH_WORKERS = 4
+
+# Number of threads used for fetching the images of a similarity check
+SIMILARITY_FETCH_WORKERS = 8
+
+# ## UPLOAD VARIABLES
+
+# Number of uploads processed at the same time by the worker
+UPLOAD_WORKERS = 4
+
+# Maximum number of uploads processed at the same time for each site, by site key.
+# Sites that are not listed use the default.
+UPLOAD_SITE_WORKERS = {
+    'PIXIV': 2,
+    'TWITTER': 2,
+}
+UPLOAD_SITE_DEFAULT_WORKERS = 1
+
+# Uploads being processed get their heartbeat updated every interval (in seconds). Uploads left in processing
+# without a heartbeat for longer than the timeout are put back to pending, and resume from their last completed step.
+UPLOAD_HEARTBEAT_INTERVAL = 30
+UPLOAD_HEARTBEAT_TIMEOUT = 180
+
+# Number of times a stalled upload gets resumed before it is marked as an error instead
+UPLOAD_MAX_RESUMES = 3
+
+# Threads for downloading the images of uploads when aiohttp is not installed, shared across all uploads
+DOWNLOAD_WORKERS = 8
+
+# Maximum number of simultaneous downloads from a single host
+DOWNLOAD_HOST_CONNECTIONS = 4
+
+# Number of images downloaded ahead of the one currently being processed
+DOWNLOAD_PREFETCH_COUNT = 4
+
+# Previews and samples of uploaded images are created during the upload, or when enabled, by the worker in the
+# background using a pool of processes. Until the worker gets to them they only exist by way of images.py, which
+# creates any that are missing on request; leave this off when the images are served by another server (e.g. nginx).
+DERIVATIVE_BACKGROUND = False
+DERIVATIVE_WORKERS = 2
+
+# Encodings that previews and samples are saved in alongside the JPEG, for clients that accept them.
+# Formats that the installed Pillow can't encode are skipped (AVIF needs Pillow 11.3+ or pillow-avif-plugin).
+DERIVATIVE_FORMATS = ['webp']
+
+# Previews and samples are either kept as plain files in the sharded directories ('files'), or appended to segment
+# files in the packed directory ('packed'), which only the image server can send. Running "prebooru.py compact" moves
+# existing files into the segments, and reclaims the space left behind by derivatives that were replaced.
+DERIVATIVE_STORAGE = 'files'
+PACKED_SEGMENT_SIZE = 256 * 1024 * 1024
+# Segments with less than this fraction of their space still in use get rewritten by compaction
+PACKED_COMPACT_RATIO = 0.5
+
+# Pages of artists looked up on Danbooru at the same time when checking for new artist boorus
+BOORU_CHECK_WORKERS = 4
+BOORU_CHECK_PAGE_SIZE = 100
+
+
 # ## OTHER VARIABLES
 
 VERSION = '1.0.0'
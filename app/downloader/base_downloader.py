@@ -1,6 +1,7 @@
 # APP/DOWNLOADER/BASE_DOWNLOADER.PY
 
 # ##PYTHON IMPORTS
+import os
 import ffmpeg
 import filetype
 from PIL import Image
@@ -9,10 +10,13 @@ from io import BytesIO
 # ##LOCAL IMPORTS
 from ..logical.utility import GetBufferChecksum
 from ..logical.file import CreateDirectory, PutGetRaw
+from ..logical.derivatives import CreateDerivatives
 from ..database.upload_db import AddUploadSuccess, AddUploadFailure, UploadAppendPost
-from ..database.post_db import PostAppendIllustUrl, GetPostByMD5
+from ..database.post_db import CreatePostAndAddIllustUrl, PostAppendIllustUrl, GetPostByMD5
+from ..database.derivative_queue_db import EnqueueDerivatives
 from ..database.error_db import CreateError, CreateAndAppendError, ExtendErrors, IsError
 from .. import storage
+from ..config import DERIVATIVE_BACKGROUND
 
 
 # ##FUNCTIONS
@@ -24,36 +28,103 @@ def ConvertVideoUpload(illust, upload, source, create_video_func):
     if thumb_illust_url is None:
         CreateAndAppendError('logical.downloader.ConvertVideoUpload', "Did not find thumbnail for video on illust #%d" % illust.id, upload)
         return False
-    else:
-        post = create_video_func(video_illust_url, thumb_illust_url, upload, source)
-        return RecordOutcome(post, upload)
-
-
-def ConvertImageUpload(illust_urls, upload, source, create_image_func):
-    result = False
-    for illust_url in illust_urls:
-        post = create_image_func(illust_url, upload, source)
-        result = RecordOutcome(post, upload) or result
+    step = upload.get_step(video_illust_url)
+    if step is not None and step.is_finished:
+        return step.state == 'complete'
+    post = create_video_func(video_illust_url, thumb_illust_url, upload, source)
+    return RecordOutcome(post, upload, video_illust_url)
+
+
+def ConvertImageUpload(illust_urls, upload, source, create_image_func, prefetch_func=None):
+    """The prefetch function yields the downloaded media for each illust URL in order, which then gets
+    passed on to the create function. Posts are always created in the order of the illust URLs.
+    Illust URLs that were finished by an earlier run of the upload are skipped."""
+    steps = [upload.get_step(illust_url) for illust_url in illust_urls]
+    result = any(step is not None and step.state == 'complete' for step in steps)
+    illust_urls = [illust_url for (illust_url, step) in zip(illust_urls, steps) if step is None or not step.is_finished]
+    if prefetch_func is None:
+        for illust_url in illust_urls:
+            post = create_image_func(illust_url, upload, source)
+            result = RecordOutcome(post, upload, illust_url) or result
+        return result
+    for illust_url, media in zip(illust_urls, prefetch_func(illust_urls, upload, source)):
+        post = create_image_func(illust_url, upload, source, media)
+        result = RecordOutcome(post, upload, illust_url) or result
     return result
 
 
 # #### Helper functions
 
-def RecordOutcome(post, upload):
+def RecordOutcome(post, upload, illust_url=None):
     if isinstance(post, list):
         post_errors = post
         valid_errors = [error for error in post_errors if IsError(error)]
         if len(valid_errors) != len(post_errors):
             print("\aInvalid data returned in outcome:", [item for item in post_errors if not IsError(item)])
         ExtendErrors(upload, valid_errors)
-        AddUploadFailure(upload)
+        AddUploadFailure(upload, illust_url)
         return False
     else:
         UploadAppendPost(upload, post)
-        AddUploadSuccess(upload)
+        AddUploadSuccess(upload, illust_url)
         return True
 
 
+def GetResumedPost(md5, illust_url):
+    """The post may have already been created by an earlier run of the upload"""
+    post = GetPostByMD5(md5)
+    if post is not None and illust_url in post.illust_urls:
+        return post
+
+
+def SavedMedia(illust_url, upload):
+    """Returns the media that an earlier run of the upload already moved into the data directory, or None"""
+    step = upload.get_step(illust_url)
+    if step is None or step.state != 'saved':
+        return None
+    filepath = storage.DataFilepath(step.md5, step.file_ext)
+    if not os.path.exists(filepath) or os.path.getsize(filepath) != step.size:
+        return None
+    print("Resuming", illust_url.url, "from", step.state)
+    return {'filepath': filepath, 'md5': step.md5, 'size': step.size, 'step': step.state}, step.file_ext
+
+
+def CreateImagePostFromSaved(image_illust_url, download, file_ext):
+    """The image and its preview/sample are already in place, so only the post needs to be created"""
+    post = GetResumedPost(download['md5'], image_illust_url)
+    if post is not None:
+        return post
+    md5 = CheckExistingMD5(download['md5'], image_illust_url)
+    if IsError(md5):
+        return [md5]
+    post_errors = []
+    image = LoadImageFile(download['filepath'])
+    if IsError(image):
+        return [image]
+    with image:
+        image_width, image_height = CheckImageDimensions(image, image_illust_url, post_errors)
+    post = CreatePostAndAddIllustUrl(image_illust_url, image_width, image_height, file_ext, md5, download['size'])
+    if len(post_errors):
+        ExtendErrors(post, post_errors)
+    return post
+
+
+def CreateVideoPostFromSaved(video_illust_url, download, file_ext):
+    """The video and its thumbnail are already in place, so only the post needs to be created"""
+    post = GetResumedPost(download['md5'], video_illust_url)
+    if post is not None:
+        return post
+    md5 = CheckExistingMD5(download['md5'], video_illust_url)
+    if IsError(md5):
+        return [md5]
+    post_errors = []
+    video_width, video_height = CheckVideoDimensions(download['filepath'], video_illust_url, post_errors)
+    post = CreatePostAndAddIllustUrl(video_illust_url, video_width, video_height, file_ext, md5, download['size'])
+    if len(post_errors):
+        ExtendErrors(post, post_errors)
+    return post
+
+
 def LoadImage(buffer):
     try:
         file_imgdata = BytesIO(buffer)
@@ -63,6 +134,14 @@ def LoadImage(buffer):
     return image
 
 
+def LoadImageFile(filepath):
+    try:
+        image = Image.open(filepath)
+    except Exception as e:
+        return CreateError('utility.downloader.LoadImage', "Error processing image data: %s" % repr(e))
+    return image
+
+
 def CreatePostError(module, message, post_errors):
     error = CreateError(module, message)
     post_errors.append(error)
@@ -71,7 +150,10 @@ def CreatePostError(module, message, post_errors):
 # #### Validation functions
 
 def CheckExisting(buffer, illust_url):
-    md5 = GetBufferChecksum(buffer)
+    return CheckExistingMD5(GetBufferChecksum(buffer), illust_url)
+
+
+def CheckExistingMD5(md5, illust_url):
     post = GetPostByMD5(md5)
     if post is not None:
         PostAppendIllustUrl(post, illust_url)
@@ -80,6 +162,7 @@ def CheckExisting(buffer, illust_url):
 
 
 def CheckFiletype(buffer, file_ext, post_errors):
+    """The buffer can also be a filepath, in which case only the file headers get read"""
     try:
         guess = filetype.guess(buffer)
     except Exception as e:
@@ -117,34 +200,6 @@ def CheckVideoDimensions(filepath, video_illust_url, post_errors):
 
 # #### Create media functions
 
-def CreatePreview(image, md5, downsample=True):
-    print("Creating preview:", image, md5)
-    try:
-        preview = image.copy().convert("RGB")
-        if downsample:
-            preview.thumbnail(storage.PREVIEW_DIMENSIONS)
-        filepath = storage.DataDirectory('preview', md5) + md5 + '.jpg'
-        CreateDirectory(filepath)
-        print("Saving preview:", filepath)
-        preview.save(filepath, "JPEG")
-    except Exception as e:
-        return CreateError('utility.downloader.CreatePreview', "Error creating preview: %s" % repr(e))
-
-
-def CreateSample(image, md5, downsample=True):
-    print("Creating sample:", md5)
-    try:
-        sample = image.copy().convert("RGB")
-        if downsample:
-            sample.thumbnail(storage.SAMPLE_DIMENSIONS)
-        filepath = storage.DataDirectory('sample', md5) + md5 + '.jpg'
-        CreateDirectory(filepath)
-        print("Saving sample:", filepath)
-        sample.save(filepath, "JPEG")
-    except Exception as e:
-        return CreateError('utility.downloader.CreateSample', "Error creating sample: %s" % repr(e))
-
-
 def CreateData(buffer, md5, file_ext):
     print("Saving data:", md5)
     filepath = storage.DataDirectory('data', md5) + md5 + '.' + file_ext
@@ -162,6 +217,14 @@ def CreateVideo(buffer, md5, file_ext):
     return filepath
 
 
+def MoveData(temp_filepath, md5, file_ext):
+    filepath = storage.DataFilepath(md5, file_ext)
+    CreateDirectory(filepath)
+    print("Moving data:", filepath)
+    os.replace(temp_filepath, filepath)
+    return filepath
+
+
 # #### Save functions
 
 # ###### Image illust
@@ -172,17 +235,44 @@ def SaveImage(buffer, image, md5, image_file_ext, illust_url, post_errors):
     except Exception as e:
         CreatePostError('utility.downloader.SaveImage', "Error saving image to disk: %s" % repr(e), post_errors)
         return False
-    if storage.HasPreview(image.width, image.height):
-        error = CreatePreview(image, md5)
-        if error is not None:
-            post_errors.append(error)
-    if storage.HasSample(image.width, image.height):
-        error = CreateSample(image, md5)
-        if error is not None:
-            post_errors.append(error)
+    if DERIVATIVE_BACKGROUND:
+        EnqueueDerivatives([(md5, image_file_ext)])
+    else:
+        SaveImageDerivatives(image, md5, post_errors)
     return True
 
 
+def SaveImageFile(temp_filepath, md5, image_file_ext, illust_url, post_errors):
+    """Moves the downloaded file into place. The preview and sample are then either queued or created from the file on disk."""
+    try:
+        filepath = MoveData(temp_filepath, md5, image_file_ext)
+    except Exception as e:
+        CreatePostError('utility.downloader.SaveImage', "Error saving image to disk: %s" % repr(e), post_errors)
+        return False
+    if DERIVATIVE_BACKGROUND:
+        EnqueueDerivatives([(md5, image_file_ext)])
+        return True
+    image = LoadImageFile(filepath)
+    if IsError(image):
+        post_errors.append(image)
+        return True
+    with image:
+        SaveImageDerivatives(image, md5, post_errors)
+    return True
+
+
+def SaveImageDerivatives(image, md5, post_errors):
+    create_sample = storage.HasSample(image.width, image.height)
+    create_preview = storage.HasPreview(image.width, image.height)
+    if create_sample or create_preview:
+        AddDerivativeErrors(CreateDerivatives(image, md5, create_sample, create_preview), post_errors)
+
+
+def AddDerivativeErrors(messages, post_errors):
+    for message in messages:
+        CreatePostError('utility.downloader.CreateDerivatives', message, post_errors)
+
+
 # ###### Video illust
 
 def SaveVideo(buffer, md5, file_ext):
@@ -192,16 +282,17 @@ def SaveVideo(buffer, md5, file_ext):
         return CreateError('utility.downloader.SaveVideo', "Error saving video to disk: %s" % repr(e))
 
 
+def SaveVideoFile(temp_filepath, md5, file_ext):
+    try:
+        return MoveData(temp_filepath, md5, file_ext)
+    except Exception as e:
+        return CreateError('utility.downloader.SaveVideo', "Error saving video to disk: %s" % repr(e))
+
+
 def SaveThumb(buffer, md5, source, post_errors):
+    """Videos always get a preview and sample from the thumb, at full size if the thumb is small enough"""
     image = LoadImage(buffer)
     if IsError(image):
         post_errors.append(image)
         return
-    downsample = storage.HasPreview(image.width, image.height)
-    error = CreatePreview(image, md5, downsample)
-    if error is not None:
-        post_errors.append(error)
-    downsample = storage.HasSample(image.width, image.height)
-    error = CreateSample(image, md5, downsample)
-    if error is not None:
-        post_errors.append(error)
+    AddDerivativeErrors(CreateDerivatives(image, md5, True, True), post_errors)
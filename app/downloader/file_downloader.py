@@ -4,9 +4,11 @@
 from ..logical.utility import GetFileExtension
 from ..logical.file import PutGetRaw
 from ..database.post_db import CreatePostAndAddIllustUrl
+from ..database.upload_db import SetUploadStep
 from ..database.error_db import CreateAndAppendError, ExtendErrors, IsError
 from .base_downloader import ConvertImageUpload, ConvertVideoUpload, LoadImage, CheckExisting, CheckFiletype,\
-    CheckImageDimensions, CheckVideoDimensions, SaveImage, SaveVideo, SaveThumb
+    CheckImageDimensions, CheckVideoDimensions, SaveImage, SaveVideo, SaveThumb, SavedMedia, CreateImagePostFromSaved,\
+    CreateVideoPostFromSaved
 
 # ##FUNCTIONS
 
@@ -28,6 +30,9 @@ def ConvertFileUpload(upload, source):
 # #### Post creation functions
 
 def CreateImagePost(image_illust_url, upload, source):
+    saved = SavedMedia(image_illust_url, upload)
+    if saved is not None:
+        return CreateImagePostFromSaved(image_illust_url, *saved)
     file_ext = GetFileExtension(upload.media_filepath)
     buffer = PutGetRaw(upload.media_filepath, 'rb')
     md5 = CheckExisting(buffer, image_illust_url)
@@ -41,6 +46,7 @@ def CreateImagePost(image_illust_url, upload, source):
     image_width, image_height = CheckImageDimensions(image, image_illust_url, post_errors)
     if not SaveImage(buffer, image, md5, image_file_ext, image_illust_url, post_errors):
         return post_errors
+    SetUploadStep(upload, image_illust_url, 'saved', {'md5': md5, 'file_ext': image_file_ext, 'size': len(buffer)})
     post = CreatePostAndAddIllustUrl(image_illust_url, image_width, image_height, image_file_ext, md5, len(buffer))
     if len(post_errors):
         ExtendErrors(post, post_errors)
@@ -48,6 +54,9 @@ def CreateImagePost(image_illust_url, upload, source):
 
 
 def CreateVideoPost(video_illust_url, thumb_illust_url, upload, source):
+    saved = SavedMedia(video_illust_url, upload)
+    if saved is not None:
+        return CreateVideoPostFromSaved(video_illust_url, *saved)
     file_ext = GetFileExtension(upload.media_filepath)
     buffer = PutGetRaw(upload.media_filepath, 'rb')
     md5 = CheckExisting(buffer, video_illust_url)
@@ -61,6 +70,7 @@ def CreateVideoPost(video_illust_url, thumb_illust_url, upload, source):
     video_width, video_height = CheckVideoDimensions(filepath, video_illust_url, post_errors)
     thumb_binary = PutGetRaw(upload.sample_filepath, 'rb')
     SaveThumb(thumb_binary, md5, source, post_errors)
+    SetUploadStep(upload, video_illust_url, 'saved', {'md5': md5, 'file_ext': video_file_ext, 'size': len(buffer)})
     post = CreatePostAndAddIllustUrl(video_illust_url, video_width, video_height, video_file_ext, md5, len(buffer))
     if len(post_errors):
         ExtendErrors(post, post_errors)
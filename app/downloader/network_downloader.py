@@ -1,14 +1,19 @@
 # APP/DOWNLOADER/NETWORK_DOWNLOADER.PY
 
 # ##PYTHON IMPORTS
-import requests
+import os
+import functools
 
 # ##LOCAL IMPORTS
-from ..logical.network import GetHTTPFile
+from ..logical.fetch_engine import SubmitFetch, SubmitFetchFile, WaitFetch
+from ..logical.file import CreateDirectory
 from ..database.post_db import CreatePostAndAddIllustUrl
+from ..database.upload_db import SetUploadStep
 from ..database.error_db import CreateError, CreateAndAppendError, ExtendErrors, IsError
-from .base_downloader import ConvertImageUpload, ConvertVideoUpload, LoadImage, CheckExisting, CheckFiletype,\
-    CheckImageDimensions, CheckVideoDimensions, SaveImage, SaveVideo, SaveThumb
+from .base_downloader import ConvertImageUpload, ConvertVideoUpload, LoadImageFile, CheckExistingMD5, CheckFiletype,\
+    CheckImageDimensions, CheckVideoDimensions, SaveImageFile, SaveVideoFile, SaveThumb, CreateImagePostFromSaved, CreateVideoPostFromSaved
+from .. import storage
+from ..config import DOWNLOAD_PREFETCH_COUNT
 
 
 # ##FUNCTIONS
@@ -22,60 +27,186 @@ def ConvertNetworkUpload(illust, upload, source):
         all_upload_urls = [source.NormalizeImageURL(upload_url.url) for upload_url in upload.image_urls]
         image_illust_urls = [illust_url for illust_url in source.ImageIllustDownloadUrls(illust)
                              if (len(all_upload_urls) == 0) or (illust_url.url in all_upload_urls)]
-        return ConvertImageUpload(image_illust_urls, upload, source, CreateImagePost)
+        return ConvertImageUpload(image_illust_urls, upload, source, CreateImagePost, PrefetchMedia)
     CreateAndAppendError('downloader.file_uploader.ConvertFileUpload', "No valid illust URLs.", upload)
     return False
 
 
 # #### Network functions
 
-def DownloadMedia(illust_url, source):
+def PrepareDownload(illust_url, source):
     download_url = source.GetFullUrl(illust_url)
     file_ext = source.GetMediaExtension(download_url)
     if file_ext not in ['jpg', 'png', 'mp4']:
         return CreateError('downloader.network_downloader.DownloadMedia', "Unsupported file format: %s" % file_ext), None
+    return download_url, file_ext
+
+
+def FetchMedia(download_url, headers):
+    """Returns the buffer and an error message"""
+    print("Downloading", download_url)
+    return WaitFetch(SubmitFetch(download_url, headers))
+
+
+def SubmitMediaFile(download_url, headers, temp_filepath):
+    """Streams the media into the temp file using the fetch engine. Returns a future of the download and an error message."""
+    CreateDirectory(storage.TEMP_DIRECTORY)
     print("Downloading", download_url)
-    buffer = GetHTTPFile(download_url, headers=source.IMAGE_HEADERS)
-    if isinstance(buffer, Exception):
-        return CreateError('downloader.network_downloader.DownloadMedia', str(buffer)), None
-    if isinstance(buffer, requests.Response):
-        return CreateError('downloader.network_downloader.DownloadMedia', "HTTP %d - %s" % (buffer.status_code, buffer.reason)), None
+    return SubmitFetchFile(download_url, temp_filepath, headers), temp_filepath
+
+
+def UploadTempFilepath(upload, illust_url):
+    """Each illust URL of an upload downloads to the same temp file, so that a resumed upload can pick it up again"""
+    return storage.TEMP_DIRECTORY + 'upload-%d-%d.part' % (upload.id, illust_url.id)
+
+
+def ResumeMedia(illust_url, upload):
+    """Returns the media left behind by an earlier run of the upload, or None if it needs to be downloaded.
+    The download gets the step it was resumed from, so that it isn't checkpointed again."""
+    step = upload.get_step(illust_url)
+    if step is None:
+        return None
+    if step.state == 'saved':
+        filepath = storage.DataFilepath(step.md5, step.file_ext)
+    elif step.state == 'downloaded':
+        filepath = UploadTempFilepath(upload, illust_url)
+    else:
+        return None
+    if not os.path.exists(filepath) or os.path.getsize(filepath) != step.size:
+        return None
+    print("Resuming", illust_url.url, "from", step.state)
+    return {'filepath': filepath, 'md5': step.md5, 'size': step.size, 'step': step.state}, step.file_ext
+
+
+def CheckpointDownload(upload, illust_url, download, file_ext):
+    if 'step' not in download:
+        SetUploadStep(upload, illust_url, 'downloaded', dict(download, file_ext=file_ext))
+
+
+def RemoveTempFile(temp_filepath):
+    """Downloads that were moved into the data directory are already gone"""
+    if os.path.exists(temp_filepath):
+        os.remove(temp_filepath)
+
+
+def FetchResult(buffer, message, file_ext):
+    if message is not None:
+        return CreateError('downloader.network_downloader.DownloadMedia', message), None
     return buffer, file_ext
 
 
+def DownloadMedia(illust_url, source):
+    download_url, file_ext = PrepareDownload(illust_url, source)
+    if IsError(download_url):
+        return download_url, None
+    return FetchResult(*FetchMedia(download_url, source.IMAGE_HEADERS), file_ext)
+
+
+def DownloadMediaFile(illust_url, upload, source):
+    media = ResumeMedia(illust_url, upload)
+    if media is not None:
+        return media
+    download_url, file_ext = PrepareDownload(illust_url, source)
+    if IsError(download_url):
+        return download_url, None
+    future, _ = SubmitMediaFile(download_url, source.IMAGE_HEADERS, UploadTempFilepath(upload, illust_url))
+    return FetchResult(*WaitFetch(future), file_ext)
+
+
+def PrefetchMedia(illust_urls, upload, source):
+    """Yields the DownloadMediaFile result for each illust URL in order, with the downloads running in the
+    fetch engine up to DOWNLOAD_PREFETCH_COUNT images ahead of the caller."""
+    downloads = [PrepareDownload(illust_url, source) for illust_url in illust_urls]
+    resumed = [ResumeMedia(illust_url, upload) for illust_url in illust_urls]
+    fetches = [None] * len(downloads)
+    submit_index = 0
+    try:
+        for i, (download_url, file_ext) in enumerate(downloads):
+            while submit_index < len(downloads) and submit_index <= i + DOWNLOAD_PREFETCH_COUNT:
+                if not IsError(downloads[submit_index][0]) and resumed[submit_index] is None:
+                    temp_filepath = UploadTempFilepath(upload, illust_urls[submit_index])
+                    fetches[submit_index] = SubmitMediaFile(downloads[submit_index][0], source.IMAGE_HEADERS, temp_filepath)
+                submit_index += 1
+            if resumed[i] is not None:
+                yield resumed[i]
+                continue
+            if IsError(download_url):
+                yield download_url, None
+                continue
+            download, message = WaitFetch(fetches[i][0])
+            fetches[i] = None
+            yield FetchResult(download, message, file_ext)
+    finally:
+        # Cancel the downloads that never got handed out, and don't leave behind their temp files
+        for fetch in fetches:
+            if fetch is not None:
+                future, temp_filepath = fetch
+                future.cancel()
+                future.add_done_callback(functools.partial(DiscardPrefetch, temp_filepath))
+
+
+def DiscardPrefetch(temp_filepath, future):
+    try:
+        RemoveTempFile(temp_filepath)
+    except OSError:
+        pass
+
+
 # #### Post creation functions
 
-def CreateImagePost(image_illust_url, upload, source):
-    buffer, file_ext = DownloadMedia(image_illust_url, source)
-    if IsError(buffer):
-        return [buffer]
-    md5 = CheckExisting(buffer, image_illust_url)
+def CreateImagePost(image_illust_url, upload, source, media=None):
+    download, file_ext = media if media is not None else DownloadMediaFile(image_illust_url, upload, source)
+    if IsError(download):
+        return [download]
+    try:
+        return CreateImagePostFromFile(image_illust_url, upload, download, file_ext)
+    finally:
+        RemoveTempFile(UploadTempFilepath(upload, image_illust_url))
+
+
+def CreateImagePostFromFile(image_illust_url, upload, download, file_ext):
+    if download.get('step') == 'saved':
+        return CreateImagePostFromSaved(image_illust_url, download, file_ext)
+    CheckpointDownload(upload, image_illust_url, download, file_ext)
+    md5 = CheckExistingMD5(download['md5'], image_illust_url)
     if IsError(md5):
         return [md5]
     post_errors = []
-    image_file_ext = CheckFiletype(buffer, file_ext, post_errors)
-    image = LoadImage(buffer)
+    image_file_ext = CheckFiletype(download['filepath'], file_ext, post_errors)
+    image = LoadImageFile(download['filepath'])
     if IsError(image):
         return post_errors + [image]
-    image_width, image_height = CheckImageDimensions(image, image_illust_url, post_errors)
-    if not SaveImage(buffer, image, md5, image_file_ext, image_illust_url, post_errors):
+    with image:
+        image_width, image_height = CheckImageDimensions(image, image_illust_url, post_errors)
+    if not SaveImageFile(download['filepath'], md5, image_file_ext, image_illust_url, post_errors):
         return post_errors
-    post = CreatePostAndAddIllustUrl(image_illust_url, image_width, image_height, image_file_ext, md5, len(buffer))
+    SetUploadStep(upload, image_illust_url, 'saved', {'md5': md5, 'file_ext': image_file_ext, 'size': download['size']})
+    post = CreatePostAndAddIllustUrl(image_illust_url, image_width, image_height, image_file_ext, md5, download['size'])
     if len(post_errors):
         ExtendErrors(post, post_errors)
     return post
 
 
 def CreateVideoPost(video_illust_url, thumb_illust_url, upload, source):
-    buffer, file_ext = DownloadMedia(video_illust_url, source)
-    if IsError(buffer):
-        return [buffer]
-    md5 = CheckExisting(buffer, video_illust_url)
+    download, file_ext = DownloadMediaFile(video_illust_url, upload, source)
+    if IsError(download):
+        return [download]
+    try:
+        return CreateVideoPostFromFile(video_illust_url, thumb_illust_url, upload, download, file_ext, source)
+    finally:
+        RemoveTempFile(UploadTempFilepath(upload, video_illust_url))
+
+
+def CreateVideoPostFromFile(video_illust_url, thumb_illust_url, upload, download, file_ext, source):
+    if download.get('step') == 'saved':
+        return CreateVideoPostFromSaved(video_illust_url, download, file_ext)
+    CheckpointDownload(upload, video_illust_url, download, file_ext)
+    md5 = CheckExistingMD5(download['md5'], video_illust_url)
     if IsError(md5):
         return [md5]
     post_errors = []
-    video_file_ext = CheckFiletype(buffer, file_ext, post_errors)
-    filepath = SaveVideo(buffer, md5, video_file_ext)
+    video_file_ext = CheckFiletype(download['filepath'], file_ext, post_errors)
+    filepath = SaveVideoFile(download['filepath'], md5, video_file_ext)
     if IsError(filepath):
         return post_errors + [filepath]
     video_width, video_height = CheckVideoDimensions(filepath, video_illust_url, post_errors)
@@ -83,7 +214,8 @@ def CreateVideoPost(video_illust_url, thumb_illust_url, upload, source):
     if IsError(thumb_binary):
         return post_errors + [thumb_binary]
     SaveThumb(thumb_binary, md5, source, post_errors)
-    post = CreatePostAndAddIllustUrl(video_illust_url, video_width, video_height, video_file_ext, md5, len(buffer))
+    SetUploadStep(upload, video_illust_url, 'saved', {'md5': md5, 'file_ext': video_file_ext, 'size': download['size']})
+    post = CreatePostAndAddIllustUrl(video_illust_url, video_width, video_height, video_file_ext, md5, download['size'])
     if len(post_errors):
         ExtendErrors(post, post_errors)
     return post
@@ -0,0 +1,198 @@
+# APP/LOGICAL/DERIVATIVES.PY
+
+# ##PYTHON IMPORTS
+import os
+from io import BytesIO
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+
+# ##LOCAL IMPORTS
+from .. import storage
+from ..config import DERIVATIVE_WORKERS, DERIVATIVE_FORMATS
+
+
+# ##GLOBAL VARIABLES
+
+# Nothing in here touches the database, so that the functions can be run in the process pool
+# by the worker as well as on demand by the image server.
+
+# Resizes first reduce the image by an integer factor down to this multiple of the final size, which is much
+# faster than resampling the full image and indistinguishable from it at this gap.
+DERIVATIVE_REDUCING_GAP = 3.0
+
+# Originals that derivatives can be made from; video previews/samples come from thumbs, which aren't kept
+IMAGE_EXTENSIONS = ['jpg', 'png', 'gif']
+
+# Encodings that derivatives can be saved in, by file extension. The JPEG is always created, since that is the
+# file that gets linked to; the image server swaps in one of the others when the request accepts it.
+DERIVATIVE_ENCODINGS = {
+    'jpg': {'format': 'JPEG', 'mimetype': 'image/jpeg', 'options': {}},
+    'webp': {'format': 'WEBP', 'mimetype': 'image/webp', 'options': {'quality': 80, 'method': 4}},
+    'avif': {'format': 'AVIF', 'mimetype': 'image/avif', 'options': {'quality': 60}},
+}
+
+# Smallest encodings first
+ENCODING_PREFERENCE = ['avif', 'webp', 'jpg']
+
+ENABLED_FORMATS = None
+
+DERIVATIVE_POOL = None
+
+
+# ##FUNCTIONS
+
+# #### Image functions
+
+def DecodeDerivativeImage(image, size):
+    """Decode the image only once, at the smallest JPEG scale that still covers the size"""
+    if image.format == 'JPEG':
+        image.draft('RGB', size)
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+    image.load()
+    return image
+
+
+def ResizeDerivative(image, size):
+    if image.size == size:
+        return image
+    return image.resize(size, Image.BICUBIC, reducing_gap=DERIVATIVE_REDUCING_GAP)
+
+
+def DerivativeSize(width, height, dimensions):
+    """Size of the image when fit inside the dimensions, keeping the aspect ratio; images are never enlarged"""
+    ratio = min(dimensions[0] / width, dimensions[1] / height, 1.0)
+    return max(round(width * ratio), 1), max(round(height * ratio), 1)
+
+
+def CreateDerivatives(image, md5, create_sample, create_preview):
+    """The sample is resized from the decoded image, and the preview from the sample. Returns a list of error messages."""
+    sample_size = DerivativeSize(image.width, image.height, storage.SAMPLE_DIMENSIONS)
+    preview_size = DerivativeSize(image.width, image.height, storage.PREVIEW_DIMENSIONS)
+    print("Creating derivatives:", image, md5)
+    try:
+        decoded = DecodeDerivativeImage(image, sample_size if create_sample else preview_size)
+    except Exception as e:
+        return ["Error decoding image: %s" % repr(e)]
+    errors = []
+    if create_sample:
+        try:
+            decoded = ResizeDerivative(decoded, sample_size)
+            SaveDerivative(decoded, 'sample', md5)
+        except Exception as e:
+            errors.append("Error creating sample: %s" % repr(e))
+    if create_preview:
+        try:
+            SaveDerivative(ResizeDerivative(decoded, preview_size), 'preview', md5)
+        except Exception as e:
+            errors.append("Error creating preview: %s" % repr(e))
+    return errors
+
+
+def SaveDerivative(image, type, md5):
+    """The JPEG is saved last, since its existence is what marks the derivative as done"""
+    for file_ext in reversed(GetDerivativeFormats()):
+        SaveDerivativeFile(image, type, md5, file_ext)
+
+
+def SaveDerivativeFile(image, type, md5, file_ext):
+    encoding = DERIVATIVE_ENCODINGS[file_ext]
+    print("Saving:", storage.DerivativeFilepath(type, md5, file_ext))
+    buffer = BytesIO()
+    image.save(buffer, encoding['format'], **encoding['options'])
+    storage.GetDerivativeStore().save(type, md5, file_ext, buffer.getvalue())
+
+
+# #### Format functions
+
+def GetDerivativeFormats():
+    """JPEG, along with whichever of the configured formats the installed Pillow is able to encode"""
+    global ENABLED_FORMATS
+    if ENABLED_FORMATS is None:
+        Image.init()
+        ENABLED_FORMATS = ['jpg'] + [file_ext for file_ext in DERIVATIVE_FORMATS if file_ext != 'jpg' and file_ext in DERIVATIVE_ENCODINGS
+                                     and DERIVATIVE_ENCODINGS[file_ext]['format'] in Image.SAVE]
+    return ENABLED_FORMATS
+
+
+def DerivativeExists(type, md5):
+    store = storage.GetDerivativeStore()
+    return all(store.exists(type, md5, file_ext) for file_ext in GetDerivativeFormats())
+
+
+def NegotiateDerivativeFormat(accept_mimetypes):
+    """Pick the smallest enabled encoding that the client lists explicitly, as long as it doesn't prefer JPEG.
+    Wildcards only count for JPEG, since older browsers send image/* without being able to decode the newer formats."""
+    listed = {mimetype: quality for (mimetype, quality) in accept_mimetypes}
+    jpeg_quality = accept_mimetypes['image/jpeg'] if len(listed) else 1
+    formats = [file_ext for file_ext in ENCODING_PREFERENCE if file_ext != 'jpg' and file_ext in GetDerivativeFormats()]
+    best_ext, best_quality = 'jpg', jpeg_quality
+    for file_ext in formats:
+        quality = listed.get(DERIVATIVE_ENCODINGS[file_ext]['mimetype'], 0)
+        # On a tie, the smaller encoding wins over JPEG, and an earlier one over a later one
+        if quality > 0 and (quality > best_quality or (quality == best_quality and best_ext == 'jpg')):
+            best_ext, best_quality = file_ext, quality
+    return best_ext
+
+
+def DerivativeMimetype(file_ext):
+    return DERIVATIVE_ENCODINGS[file_ext]['mimetype']
+
+
+# #### File functions
+
+def FindImageFilepath(md5):
+    for file_ext in IMAGE_EXTENSIONS:
+        filepath = storage.DataFilepath(md5, file_ext)
+        if os.path.exists(filepath):
+            return filepath
+
+
+def GenerateDerivatives(md5, file_ext):
+    """Create whichever of the sample and preview the image needs and doesn't already have"""
+    retdata = {'md5': md5, 'errors': []}
+    try:
+        with Image.open(storage.DataFilepath(md5, file_ext)) as image:
+            create_sample = storage.HasSample(image.width, image.height) and not DerivativeExists('sample', md5)
+            create_preview = storage.HasPreview(image.width, image.height) and not DerivativeExists('preview', md5)
+            if create_sample or create_preview:
+                retdata['errors'] = CreateDerivatives(image, md5, create_sample, create_preview)
+    except Exception as e:
+        retdata['errors'] = ["Error opening image: %s" % repr(e)]
+    return retdata
+
+
+def GenerateDerivative(type, md5):
+    """Create a single missing sample or preview from the original, in all formats. Returns whether the JPEG now exists."""
+    filepath = FindImageFilepath(md5)
+    if filepath is None:
+        return False
+    with Image.open(filepath) as image:
+        errors = CreateDerivatives(image, md5, type == 'sample', type == 'preview')
+    if len(errors):
+        print("Unable to create %s for %s:" % (type, md5), errors)
+    return storage.GetDerivativeStore().exists(type, md5, 'jpg')
+
+
+# #### Pool functions
+
+def GetDerivativePool():
+    global DERIVATIVE_POOL
+    if DERIVATIVE_POOL is None:
+        DERIVATIVE_POOL = ProcessPoolExecutor(max_workers=DERIVATIVE_WORKERS)
+    return DERIVATIVE_POOL
+
+
+def ShutdownDerivativePool():
+    global DERIVATIVE_POOL
+    if DERIVATIVE_POOL is not None:
+        DERIVATIVE_POOL.shutdown(wait=True)
+        DERIVATIVE_POOL = None
+
+
+def GenerateDerivativesConcurrently(images):
+    """Create the derivatives of the images given as (md5, file_ext) in the process pool, returning the results in order"""
+    if len(images) == 0:
+        return []
+    md5s, file_exts = zip(*images)
+    return list(GetDerivativePool().map(GenerateDerivatives, md5s, file_exts))
@@ -0,0 +1,242 @@
+# APP/LOGICAL/FETCH_ENGINE.PY
+
+# ##PYTHON IMPORTS
+import os
+import urllib
+import asyncio
+import hashlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# ##LOCAL IMPORTS
+from .network import GetHTTPFile, DownloadHTTPFile, DOWNLOAD_CHUNK_SIZE, RETRY_STATUSES
+from .rate_limiter import GetRateLimiter
+from ..config import DOWNLOAD_WORKERS, DOWNLOAD_HOST_CONNECTIONS, NETWORK_RETRIES, NETWORK_BACKOFF, NETWORK_FETCH_TIMEOUT
+
+
+# ##GLOBAL VARIABLES
+
+# Media downloads run as tasks on a single event loop in a background thread. Requests are made with aiohttp,
+# which is in the requirements; without it the blocking requests from network.py get run in a thread executor,
+# which only works as a degraded mode with a thread held for every download in progress. Source metadata and API
+# requests stay on the pooled sessions from network.py, since they carry the site logins and are few per upload.
+
+ENGINE_LOOP = None
+ENGINE_THREAD = None
+ENGINE_LOCK = threading.Lock()
+
+# Only accessed from the engine thread
+ENGINE_EXECUTOR = None
+CLIENT_SESSION = None
+HOST_SEMAPHORES = {}
+
+
+# ##FUNCTIONS
+
+# #### Sync facade functions
+
+def SubmitFetch(url, headers=None, timeout=10):
+    """Returns a future of the buffer and an error message"""
+    return SubmitCoroutine(FetchAsync(url, headers or {}, timeout))
+
+
+def SubmitFetchFile(url, filepath, headers=None, timeout=10):
+    """Returns a future of the download (filepath, md5, size) and an error message. The file is removed on failure."""
+    return SubmitCoroutine(FetchFileAsync(url, filepath, headers or {}, timeout))
+
+
+def WaitFetch(future):
+    try:
+        return future.result()
+    except Exception as e:
+        return None, "Fetch error: %s" % repr(e)
+
+
+def CancelFetches(futures):
+    for future in futures:
+        future.cancel()
+
+
+# #### Engine functions
+
+def GetEngineLoop():
+    global ENGINE_LOOP, ENGINE_THREAD
+    with ENGINE_LOCK:
+        if ENGINE_LOOP is None:
+            if aiohttp is None:
+                print("Warning: aiohttp is not installed; fetches will be run on threads. Install it with: pip install -r requirements.txt")
+            ENGINE_LOOP = asyncio.new_event_loop()
+            ENGINE_THREAD = threading.Thread(target=RunEngineLoop, args=(ENGINE_LOOP,), name='fetch-engine', daemon=True)
+            ENGINE_THREAD.start()
+        return ENGINE_LOOP
+
+
+def RunEngineLoop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def SubmitCoroutine(coroutine):
+    return asyncio.run_coroutine_threadsafe(asyncio.wait_for(coroutine, NETWORK_FETCH_TIMEOUT), GetEngineLoop())
+
+
+def ShutdownFetchEngine():
+    global ENGINE_LOOP, ENGINE_THREAD
+    with ENGINE_LOCK:
+        if ENGINE_LOOP is None:
+            return
+        asyncio.run_coroutine_threadsafe(CloseEngineAsync(), ENGINE_LOOP).result(timeout=30)
+        ENGINE_LOOP.call_soon_threadsafe(ENGINE_LOOP.stop)
+        ENGINE_THREAD.join(timeout=30)
+        ENGINE_LOOP.close()
+        ENGINE_LOOP = ENGINE_THREAD = None
+
+
+# #### Coroutine functions
+
+async def FetchAsync(url, headers, timeout):
+    async with GetHostSemaphore(url):
+        if aiohttp is None:
+            buffer = await RunInExecutor(GetHTTPFile, url, headers, timeout)
+            return CheckExecutorResult(buffer)
+        return await ClientRequestAsync(url, headers, timeout, ReadResponseAsync)
+
+
+async def FetchFileAsync(url, filepath, headers, timeout):
+    cancelled = threading.Event()
+    try:
+        async with GetHostSemaphore(url):
+            if aiohttp is None:
+                download = await RunInExecutor(DownloadExecutorFile, url, filepath, headers, timeout, cancelled)
+                download, message = CheckExecutorResult(download)
+            else:
+                download, message = await ClientRequestAsync(url, headers, timeout, functools.partial(StreamResponseAsync, filepath=filepath))
+    except BaseException:
+        # Includes cancellation and timeouts
+        cancelled.set()
+        RemoveFile(filepath)
+        raise
+    if download is None:
+        RemoveFile(filepath)
+        return None, message
+    download['filepath'] = filepath
+    return download, None
+
+
+async def CloseEngineAsync():
+    global CLIENT_SESSION, ENGINE_EXECUTOR
+    if CLIENT_SESSION is not None:
+        await CLIENT_SESSION.close()
+        CLIENT_SESSION = None
+    if ENGINE_EXECUTOR is not None:
+        ENGINE_EXECUTOR.shutdown(wait=False)
+        ENGINE_EXECUTOR = None
+    HOST_SEMAPHORES.clear()
+
+
+# ###### aiohttp
+
+async def ClientRequestAsync(url, headers, timeout, handler):
+    """GET the URL, retrying on the same conditions as the sessions from network.py"""
+    client_timeout = aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+    limiter = GetRateLimiter(url)
+    for retry in range(NETWORK_RETRIES + 1):
+        if retry > 0:
+            await asyncio.sleep(NETWORK_BACKOFF * (2 ** (retry - 1)))
+        await asyncio.sleep(limiter.reserve())
+        try:
+            async with GetClientSession().get(url, headers=headers, timeout=client_timeout) as response:
+                limiter.record_response(response.status, response.headers)
+                if (response.status in RETRY_STATUSES or response.status == 429) and retry < NETWORK_RETRIES:
+                    continue
+                if response.status != 200:
+                    print("HTTP %d - %s" % (response.status, response.reason))
+                    return None, "HTTP %d - %s" % (response.status, response.reason)
+                return await handler(response), None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            limiter.record_error()
+            if retry == NETWORK_RETRIES:
+                print("Unexpected error:", e)
+                return None, repr(e)
+
+
+async def ReadResponseAsync(response):
+    return await response.read()
+
+
+async def StreamResponseAsync(response, filepath):
+    """The chunks are written and hashed on the executor, so that the disk never holds up the loop. A cancelled download
+    still lets the write in progress finish before the file gets closed."""
+    hasher = hashlib.md5()
+    size = 0
+    write = None
+    file = open(filepath, 'wb')
+    try:
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            write = asyncio.ensure_future(RunInExecutor(WriteChunk, file, hasher, chunk))
+            await asyncio.shield(write)
+            size += len(chunk)
+    finally:
+        if write is not None and not write.done():
+            await asyncio.wait([write])
+        file.close()
+    return {'md5': hasher.hexdigest(), 'size': size}
+
+
+def GetClientSession():
+    global CLIENT_SESSION
+    if CLIENT_SESSION is None:
+        CLIENT_SESSION = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, limit_per_host=DOWNLOAD_HOST_CONNECTIONS))
+    return CLIENT_SESSION
+
+
+# ###### Executor
+
+async def RunInExecutor(func, *args):
+    global ENGINE_EXECUTOR
+    if ENGINE_EXECUTOR is None:
+        ENGINE_EXECUTOR = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+    return await asyncio.get_running_loop().run_in_executor(ENGINE_EXECUTOR, func, *args)
+
+
+def DownloadExecutorFile(url, filepath, headers, timeout, cancelled):
+    """The thread can't be stopped once started, so it cleans up after itself if the fetch was abandoned"""
+    download = DownloadHTTPFile(url, filepath, headers, timeout)
+    if cancelled.is_set():
+        RemoveFile(filepath)
+    return download
+
+
+def WriteChunk(file, hasher, chunk):
+    hasher.update(chunk)
+    file.write(chunk)
+
+
+def CheckExecutorResult(result):
+    if isinstance(result, Exception):
+        return None, str(result)
+    if hasattr(result, 'status_code'):
+        return None, "HTTP %d - %s" % (result.status_code, result.reason)
+    return result, None
+
+
+# #### Helper functions
+
+def GetHostSemaphore(url):
+    hostname = urllib.parse.urlparse(url).netloc
+    if hostname not in HOST_SEMAPHORES:
+        HOST_SEMAPHORES[hostname] = asyncio.Semaphore(DOWNLOAD_HOST_CONNECTIONS)
+    return HOST_SEMAPHORES[hostname]
+
+
+def RemoveFile(filepath):
+    try:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+    except OSError:
+        pass
@@ -1,18 +1,101 @@
 # APP/LOGICAL/NETWORK.PY
 
 # ##PYTHON IMPORTS
-import time
+import os
+import urllib
+import hashlib
 import requests
+import threading
+import http.cookiejar
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# ##LOCAL IMPORTS
+from .rate_limiter import GetRateLimiter
+from ..config import NETWORK_HOST_CONNECTIONS, NETWORK_RETRIES, NETWORK_BACKOFF
+
+
+# ##GLOBAL VARIABLES
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+RETRY_STATUSES = [500, 502, 503, 504]
+
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
+
+# ##CLASSES
+
+class NoCookiesPolicy(http.cookiejar.DefaultCookiePolicy):
+    """Keeps the shared sessions stateless; cookies passed in with a request are still sent."""
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+class RateLimitedSession(requests.Session):
+    """Every request waits on the rate limiter of its host, which then gets adjusted from the response.
+    GET requests that got throttled are tried again once the limiter allows it."""
+    def request(self, method, url, *args, **kwargs):
+        limiter = GetRateLimiter(url)
+        attempts = NETWORK_RETRIES + 1 if method.upper() == 'GET' else 1
+        for i in range(attempts):
+            limiter.wait()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except Exception:
+                limiter.record_error()
+                raise
+            limiter.record_response(response.status_code, response.headers)
+            if response.status_code != 429 or i == attempts - 1:
+                return response
+            print("Throttled by %s, waiting on the rate limiter..." % limiter.hostname)
+            response.close()
 
 
 # ##FUNCTIONS
 
-def NetworkQuery(request_url, headers, timeout):
+# #### Session functions
+
+def GetSession(request_url):
+    """Shared session for the host of the URL, so that connections to the host get reused between requests"""
+    hostname = urllib.parse.urlparse(request_url).netloc
+    with SESSIONS_LOCK:
+        if hostname not in SESSIONS:
+            SESSIONS[hostname] = CreateSession()
+        return SESSIONS[hostname]
+
+
+def CreateSession():
+    # POST requests are not retried, since they may not be safe to repeat. Retry-After is left to the rate limiter,
+    # so that it holds back every request to the host instead of just the one that got the header.
+    retry = Retry(total=NETWORK_RETRIES, backoff_factor=NETWORK_BACKOFF, status_forcelist=RETRY_STATUSES, raise_on_status=False, respect_retry_after_header=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=NETWORK_HOST_CONNECTIONS, pool_block=True, max_retries=retry)
+    session = RateLimitedSession()
+    session.cookies.set_policy(NoCookiesPolicy())
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def CloseSessions():
+    with SESSIONS_LOCK:
+        for session in SESSIONS.values():
+            session.close()
+        SESSIONS.clear()
+
+
+# #### Request functions
+
+def NetworkQuery(request_url, headers, timeout, stream=False):
     try:
-        response = requests.get(request_url, headers=headers, timeout=timeout)
-    except requests.exceptions.ReadTimeout:
+        response = GetSession(request_url).get(request_url, headers=headers, timeout=timeout, stream=stream)
+    except requests.exceptions.ReadTimeout as e:
         print("\nDownload timed out!")
-        return False
+        return e
     except Exception as e:
         print("Unexpected error:", e)
         return e
@@ -22,21 +105,45 @@ def NetworkQuery(request_url, headers, timeout):
 def CheckHTTPResponse(response):
     if response.status_code == 200:
         return True
-    if response.status_code >= 500 and response.status_code < 600:
-        print("Server Error! Sleeping 5 seconds...")
-        time.sleep(5)
     print("HTTP %d - %s" % (response.status_code, response.reason))
     return False
 
 
 def GetHTTPFile(serverfilepath, headers=None, timeout=10):
     headers = headers if headers is not None else {}
-    for i in range(3):
-        response = NetworkQuery(serverfilepath, headers, timeout)
-        if response is False:
-            continue
-        if not isinstance(response, requests.Response):
-            return response
-        if CheckHTTPResponse(response):
-            return response.content
+    response = NetworkQuery(serverfilepath, headers, timeout)
+    if not isinstance(response, requests.Response):
+        return response
+    if CheckHTTPResponse(response):
+        return response.content
     return response
+
+
+def DownloadHTTPFile(serverfilepath, filepath, headers=None, timeout=10):
+    """Stream the file to disk without holding it in memory. Returns the MD5 checksum and size of the file on success."""
+    headers = headers if headers is not None else {}
+    response = NetworkQuery(serverfilepath, headers, timeout, stream=True)
+    if not isinstance(response, requests.Response):
+        return response
+    try:
+        if not CheckHTTPResponse(response):
+            return response
+        return StreamHTTPFile(response, filepath)
+    except Exception as e:
+        print("Error during download:", e)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        return e
+    finally:
+        response.close()
+
+
+def StreamHTTPFile(response, filepath):
+    hasher = hashlib.md5()
+    size = 0
+    with open(filepath, 'wb') as file:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            file.write(chunk)
+            size += len(chunk)
+    return {'md5': hasher.hexdigest(), 'size': size}
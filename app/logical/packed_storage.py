@@ -0,0 +1,253 @@
+# APP/LOGICAL/PACKED_STORAGE.PY
+
+# ##PYTHON IMPORTS
+import os
+import io
+import re
+import mmap
+import time
+import sqlite3
+import threading
+
+# ##LOCAL IMPORTS
+from .file import CreateDirectory
+from ..config import PACKED_SEGMENT_SIZE, PACKED_COMPACT_RATIO
+
+
+# ##GLOBAL VARIABLES
+
+# Files get appended to segment files, with an index giving the segment, offset and length of each one. Every process
+# appends to a segment of its own, so writes never have to be coordinated between processes; only the index is shared,
+# and SQLite takes care of that. Replaced files leave dead space behind in their segment until compaction.
+
+SEGMENT_RG = re.compile(r'^segment-\d+-\d+\.pack$')
+
+INDEX_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS entry (
+        type TEXT NOT NULL,
+        md5 TEXT NOT NULL,
+        file_ext TEXT NOT NULL,
+        segment TEXT NOT NULL,
+        offset INTEGER NOT NULL,
+        length INTEGER NOT NULL,
+        PRIMARY KEY (type, md5, file_ext)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS ix_entry_segment ON entry (segment)",
+]
+
+INSERT_ENTRY = "INSERT OR REPLACE INTO entry (type, md5, file_ext, segment, offset, length) VALUES (?, ?, ?, ?, ?, ?)"
+
+
+# ##CLASSES
+
+class SegmentFile(io.RawIOBase):
+    """Read-only file over a memoryview of the mapped segment, so that only the chunk being read gets copied"""
+
+    def __init__(self, view):
+        self.view = view
+        self.size = len(view)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        length = max(min(len(buffer), self.size - self.position), 0)
+        buffer[:length] = self.view[self.position:self.position + length]
+        self.position += length
+        return length
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(start + offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        """Releasing the view lets the segment map be closed"""
+        if not self.closed:
+            self.view.release()
+        super().close()
+
+
+class PackedStore():
+    """Keeps small files in append-only segments, and reads them back as views of the memory-mapped segment"""
+    plain_files = False
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_filepath = directory + 'index.db'
+        # Reentrant, since compaction reads the files it is saving
+        self.lock = threading.RLock()
+        self._reset()
+
+    # ## Instance functions
+
+    def exists(self, type, md5, file_ext):
+        return self._lookup(type, md5, file_ext) is not None
+
+    def open(self, type, md5, file_ext):
+        entry = self._lookup(type, md5, file_ext)
+        view = self._slice(*entry) if entry is not None else None
+        return SegmentFile(view) if view is not None else None
+
+    def read(self, type, md5, file_ext):
+        file = self.open(type, md5, file_ext)
+        if file is None:
+            return None
+        with file:
+            return file.read()
+
+    def save(self, type, md5, file_ext, data):
+        self.save_many([(type, md5, file_ext, data)])
+
+    def save_many(self, files):
+        """The files given as (type, md5, file_ext, data) are flushed to the segment before the index points at them,
+        so that a reader never gets a partial file"""
+        entries = []
+        with self.lock:
+            for (type, md5, file_ext, data) in files:
+                segment, offset = self._append(data)
+                entries.append((type, md5, file_ext, segment, offset, len(data)))
+            if len(entries) == 0:
+                return
+            self.segment_file.flush()
+            os.fsync(self.segment_file.fileno())
+        connection = self._connection()
+        with connection:
+            connection.executemany(INSERT_ENTRY, entries)
+
+    def compact(self):
+        """Rewrite the live files of segments that are mostly dead space, or too small to be worth keeping on their own,
+        into new segments and remove the old ones. Only to be run while no other process is using the store."""
+        self.close()
+        sizes = {segment: os.path.getsize(self.directory + segment) for segment in self.segments()}
+        connection = self._connection()
+        live = dict(connection.execute("SELECT segment, SUM(length) FROM entry GROUP BY segment"))
+        small = [segment for segment in sizes if sizes[segment] < PACKED_SEGMENT_SIZE * PACKED_COMPACT_RATIO]
+        compact = [segment for segment in sizes if live.get(segment, 0) < sizes[segment] * PACKED_COMPACT_RATIO
+                   or (len(small) > 1 and segment in small)]
+        retdata = {'segments': len(compact), 'files': 0, 'dropped': 0, 'reclaimed': 0}
+        for segment in compact:
+            rows = connection.execute("SELECT type, md5, file_ext, offset, length FROM entry WHERE segment = ?", (segment,)).fetchall()
+            files = [(type, md5, file_ext, self._slice(segment, offset, length)) for (type, md5, file_ext, offset, length) in rows]
+            files = [file for file in files if file[3] is not None]
+            self.save_many(files)
+            for file in files:
+                file[3].release()
+            retdata['files'] += len(files)
+            retdata['reclaimed'] += max(sizes[segment] - live.get(segment, 0), 0)
+        # Files cut short by a crash, or in segments that are gone, are dropped so that they get created again
+        changes = connection.total_changes
+        with connection:
+            missing = [segment for segment in live if segment not in sizes]
+            connection.executemany("DELETE FROM entry WHERE segment = ?", [(segment,) for segment in missing + compact])
+            retdata['dropped'] = connection.total_changes - changes
+        self.close()
+        for segment in compact:
+            os.remove(self.directory + segment)
+        return retdata
+
+    def segments(self):
+        if not os.path.exists(self.directory):
+            return []
+        return sorted(filename for filename in os.listdir(self.directory) if SEGMENT_RG.match(filename))
+
+    def close(self):
+        with self.lock:
+            if self.segment_file is not None:
+                self.segment_file.close()
+            for segment_map in self.maps.values():
+                _CloseMap(segment_map)
+            connection = getattr(self.local, 'connection', None)
+            if connection is not None:
+                connection.close()
+            self._reset()
+
+    # #### Private
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.local = threading.local()
+        self.maps = {}
+        self.segment = self.segment_file = None
+
+    def _check_process(self):
+        """Forked processes (e.g. gunicorn workers) can't share the segment, maps or connections of their parent"""
+        if self.pid != os.getpid():
+            self._reset()
+
+    def _connection(self):
+        self._check_process()
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            CreateDirectory(self.index_filepath)
+            connection = self.local.connection = sqlite3.connect(self.index_filepath, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                for statement in INDEX_SCHEMA:
+                    connection.execute(statement)
+        return connection
+
+    def _lookup(self, type, md5, file_ext):
+        return self._connection().execute("SELECT segment, offset, length FROM entry WHERE type = ? AND md5 = ? AND file_ext = ?",
+                                          (type, md5, file_ext)).fetchone()
+
+    def _drop_segment(self, segment):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM entry WHERE segment = ?", (segment,))
+
+    def _append(self, data):
+        self._check_process()
+        if self.segment_file is None or (self.segment_file.tell() > 0 and self.segment_file.tell() + len(data) > PACKED_SEGMENT_SIZE):
+            if self.segment_file is not None:
+                self.segment_file.close()
+            self.segment = 'segment-%d-%d.pack' % (time.time() * 1000, os.getpid())
+            CreateDirectory(self.directory + self.segment)
+            self.segment_file = open(self.directory + self.segment, 'ab')
+        offset = self.segment_file.tell()
+        self.segment_file.write(data)
+        return self.segment, offset
+
+    def _slice(self, segment, offset, length):
+        """Returns a memoryview of the file within the mapped segment. Segments only ever grow, so the map gets recreated
+        when it doesn't cover the file yet. Entries in segments that are missing or empty get dropped, so that the files
+        count as missing and get created again."""
+        with self.lock:
+            self._check_process()
+            segment_map = self.maps.get(segment)
+            if segment_map is None or offset + length > len(segment_map):
+                if segment == self.segment:
+                    self.segment_file.flush()
+                if segment_map is not None:
+                    _CloseMap(segment_map)
+                    del self.maps[segment]
+                try:
+                    with open(self.directory + segment, 'rb') as file:
+                        segment_map = self.maps[segment] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                except (FileNotFoundError, ValueError) as e:
+                    print("Unable to map segment %s: %s" % (segment, repr(e)))
+                    self._drop_segment(segment)
+                    return None
+            view = memoryview(segment_map)[offset:offset + length]
+        if len(view) == length:
+            return view
+        view.release()
+        return None
+
+
+# ##FUNCTIONS
+
+def _CloseMap(segment_map):
+    """Maps with views still open (e.g. files being sent) are left to be closed once the last view is released"""
+    try:
+        segment_map.close()
+    except BufferError:
+        pass
@@ -0,0 +1,149 @@
+# APP/LOGICAL/RATE_LIMITER.PY
+
+# ##PYTHON IMPORTS
+import time
+import urllib
+import threading
+import email.utils
+
+# ##LOCAL IMPORTS
+from ..config import RATE_LIMITS, RATE_LIMIT_DEFAULT, RATE_LIMIT_MINIMUM
+
+
+# ##GLOBAL VARIABLES
+
+THROTTLE_STATUSES = [429, 500, 502, 503, 504]
+
+# Multiplicative decrease of the rate after each throttle or error, and additive increase after each success
+RATE_DECREASE = 0.5
+RATE_INCREASE = 0.05
+
+LIMITERS = {}
+LIMITERS_LOCK = threading.Lock()
+
+
+# ##CLASSES
+
+class RateLimiter():
+    """Token bucket for a single host. Requests reserve a token ahead of time, and wait the returned delay before being sent."""
+    def __init__(self, hostname, rate, burst):
+        self.hostname = hostname
+        self.base_rate = self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'throttled': 0, 'errors': 0, 'waits': 0, 'wait_time': 0.0}
+
+    # ## Instance functions
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            delay = max(self.updated - now, 0) + (max(-self.tokens, 0) / self.rate)
+            self.counters['requests'] += 1
+            if delay > 0:
+                self.counters['waits'] += 1
+                self.counters['wait_time'] += delay
+            return delay
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record_response(self, status_code, headers):
+        """Adjust the rate from the response status and any rate limit headers"""
+        with self.lock:
+            block_seconds = RetryAfterSeconds(headers) if status_code in THROTTLE_STATUSES else None
+            remaining, reset_seconds = RateLimitHeaders(headers)
+            if remaining is not None and reset_seconds is not None:
+                if remaining <= 0:
+                    block_seconds = max(block_seconds or 0, reset_seconds)
+                elif reset_seconds > 0:
+                    # Spread the remaining requests over the rest of the window
+                    self.rate = max(min(self.rate, remaining / reset_seconds), RATE_LIMIT_MINIMUM)
+            if status_code in THROTTLE_STATUSES:
+                self.counters['throttled'] += 1
+                self._decrease()
+            elif status_code < 400 and (remaining is None or remaining > 0):
+                self.rate = min(self.rate + self.base_rate * RATE_INCREASE, self.base_rate)
+            if block_seconds:
+                self._block(block_seconds)
+
+    def record_error(self):
+        with self.lock:
+            self.counters['errors'] += 1
+            self._decrease()
+
+    def status(self):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            return dict(self.counters, hostname=self.hostname, rate=round(self.rate, 3), base_rate=self.base_rate, burst=self.burst,
+                        tokens=round(self.tokens, 2), blocked=round(max(self.updated - now, 0), 2), wait_time=round(self.counters['wait_time'], 2))
+
+    # #### Private
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+            self.updated = now
+
+    def _decrease(self):
+        self.rate = max(self.rate * RATE_DECREASE, RATE_LIMIT_MINIMUM)
+
+    def _block(self, seconds):
+        """Hold off all requests for the time given; no tokens accumulate while blocked"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 0)
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+
+# ##FUNCTIONS
+
+def GetRateLimiter(request_url):
+    hostname = urllib.parse.urlparse(request_url).netloc
+    with LIMITERS_LOCK:
+        if hostname not in LIMITERS:
+            rate, burst = RATE_LIMITS.get(hostname, RATE_LIMIT_DEFAULT)
+            LIMITERS[hostname] = RateLimiter(hostname, rate, burst)
+        return LIMITERS[hostname]
+
+
+def GetRateLimitStatus():
+    with LIMITERS_LOCK:
+        limiters = list(LIMITERS.values())
+    return [limiter.status() for limiter in limiters]
+
+
+# #### Header functions
+
+def RetryAfterSeconds(headers):
+    """The Retry-After header can be either a number of seconds or an HTTP date"""
+    retry_after = headers.get('retry-after')
+    if retry_after is None:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        retry_time = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_time.timestamp() - time.time(), 0)
+
+
+def RateLimitHeaders(headers):
+    """Returns the requests remaining and the seconds until the limit resets, as sent by Twitter"""
+    try:
+        remaining = headers.get('x-rate-limit-remaining')
+        reset = headers.get('x-rate-limit-reset')
+        remaining = int(remaining) if remaining is not None else None
+        reset_seconds = max(int(reset) - time.time(), 0) if reset is not None else None
+    except ValueError:
+        return None, None
+    return remaining, reset_seconds
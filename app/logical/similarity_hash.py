@@ -0,0 +1,210 @@
+# APP/LOGICAL/SIMILARITY_HASH.PY
+
+# ##PYTHON IMPORTS
+import hashlib
+import imagehash
+from io import BytesIO
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# ##LOCAL IMPORTS
+from .. import storage
+from ..similarity.similarity_data import HASH_SIZE
+from .similarity_index import HammingDistance, HashScore
+from ..config import SIMILARITY_HASH_WORKERS
+
+
+# ##GLOBAL VARIABLES
+
+# Images are decoded/reduced to no smaller than this before hashing. The whash is built from
+# block averages of the image, so hashing a reduced image gives effectively the same result.
+HASH_DECODE_SIZE = 512
+
+# Minimum score for an additional image variant to be considered a duplicate of an existing one
+VARIANT_MATCH_SCORE = 90.0
+
+# Identifies the hash function in the hash cache; change this whenever the hashes would come out different
+HASH_ALGORITHM = 'whash-haar'
+
+HASH_POOL = None
+HASH_POOL_WORKERS = None
+
+
+# ##FUNCTIONS
+
+# #### Hash functions
+
+def OpenHashImage(image):
+    """Shrink the image as cheaply as possible while it is being decoded"""
+    if image.format == 'JPEG':
+        image.draft('RGB', (HASH_DECODE_SIZE, HASH_DECODE_SIZE))
+    if image.mode not in ['L', 'RGB']:
+        image = image.convert("RGB")
+    factor = min(image.size) // HASH_DECODE_SIZE
+    if factor >= 2:
+        image = image.reduce(factor)
+    return image.convert("RGB")
+
+
+def HashImage(image):
+    return str(imagehash.whash(OpenHashImage(image), hash_size=HASH_SIZE))
+
+
+def HashImageFile(filepath):
+    with storage.OpenFile(filepath) as file, Image.open(file) as image:
+        return HashImage(image)
+
+
+def HashImageBuffer(buffer):
+    """Hash raw image bytes, along with the ratio of the full-size image"""
+    retdata = {'image_hash': None, 'ratio': None, 'error': None}
+    try:
+        with Image.open(BytesIO(buffer)) as image:
+            retdata['ratio'] = round(image.width / image.height, 4)
+            retdata['image_hash'] = HashImage(image)
+    except Exception as e:
+        retdata['error'] = "Error processing image data: %s" % repr(e)
+    return retdata
+
+
+def IsVariantHash(image_hash, image_hashes):
+    return any(HashScore(HammingDistance(image_hash, existing_hash)) >= VARIANT_MATCH_SCORE for existing_hash in image_hashes)
+
+
+# #### Post functions
+
+def PostHashData(post):
+    """Picklable description of the post files needed for hashing"""
+    post_data = {
+        'post_id': post.id,
+        'md5': post.md5,
+        'ratio': round(post.width / post.height, 4),
+        'file_ext': post.file_ext,
+        'file_path': post.file_path,
+        'sample_path': post.sample_path,
+        'preview_path': post.preview_path,
+        'digests': {},
+        'cached_hashes': {},
+    }
+    return post_data
+
+
+def DigestPostFiles(post_data):
+    return {variant: FileDigest(post_data['md5'], filepath) for (variant, filepath) in PostHashVariants(post_data)}
+
+
+def FileDigest(md5, filepath):
+    """Hashes are cached by the MD5 of the file that was hashed, so that previews and samples which get created again
+    are hashed again. Originals are named by their MD5 already."""
+    if storage.ParseDerivativeFilepath(filepath) is None:
+        return md5
+    buffer = storage.ReadFile(filepath)
+    return hashlib.md5(buffer).hexdigest() if buffer is not None else None
+
+
+def PostDigests(posts_data):
+    return [digest for post_data in posts_data for digest in post_data['digests'].values() if digest is not None]
+
+
+def SetCachedHashes(post_data, cached_hashes):
+    """Pick out the hashes of the post files from those returned by GetCachedHashes"""
+    post_data['cached_hashes'] = {variant: cached_hashes[digest][variant] for (variant, digest) in post_data['digests'].items()
+                                  if variant in cached_hashes.get(digest, {})}
+    return post_data
+
+
+def ComputedHashEntries(result):
+    """The hashes computed by HashPostImages, keyed by the digest of the hashed file and the variant"""
+    return {(result['digests'][variant], variant): image_hash for (variant, image_hash) in result['computed_hashes'].items()
+            if result['digests'].get(variant) is not None}
+
+
+def PostHashVariants(post_data):
+    """The image variants of the post to hash, in order of preference"""
+    variants = [('preview', post_data['preview_path'])]
+    if post_data['file_ext'] != 'mp4':
+        variants.append(('full', post_data['file_path']))
+    if post_data['file_path'] != post_data['sample_path']:
+        variants.append(('sample', post_data['sample_path']))
+    return variants
+
+
+def IsFullyCached(post_data):
+    return all(variant in post_data['cached_hashes'] for variant, _ in PostHashVariants(post_data))
+
+
+def HashPostImages(post_data):
+    """Hash the preview, full and sample images, keeping only the variants that differ from each other.
+    Images are only decoded when the hash is not already in the cached hashes."""
+    retdata = {'post_id': post_data['post_id'], 'md5': post_data['md5'], 'ratio': post_data['ratio'], 'hashes': [], 'computed_hashes': {},
+               'digests': post_data['digests'], 'error': None}
+    image_hashes = []
+    try:
+        for variant, filepath in PostHashVariants(post_data):
+            image_hash = post_data['cached_hashes'].get(variant)
+            if image_hash is None:
+                image_hash = retdata['computed_hashes'][variant] = HashImageFile(filepath)
+            if not IsVariantHash(image_hash, image_hashes):
+                image_hashes.append(image_hash)
+    except Exception as e:
+        retdata['error'] = "Error hashing post #%d: %s" % (post_data['post_id'], repr(e))
+        return retdata
+    retdata['hashes'] = image_hashes
+    return retdata
+
+
+# #### Pool functions
+
+def GetHashPool(workers=None):
+    global HASH_POOL, HASH_POOL_WORKERS
+    workers = workers or SIMILARITY_HASH_WORKERS
+    if HASH_POOL is not None and HASH_POOL_WORKERS != workers:
+        ShutdownHashPool()
+    if HASH_POOL is None:
+        HASH_POOL = ProcessPoolExecutor(max_workers=workers)
+        HASH_POOL_WORKERS = workers
+    return HASH_POOL
+
+
+def ShutdownHashPool():
+    global HASH_POOL
+    if HASH_POOL is not None:
+        HASH_POOL.shutdown(wait=True)
+        HASH_POOL = None
+
+
+def HashPostsConcurrently(posts_data, workers=None):
+    """Fan the posts that need decoding out to the process pool, yielding the results as each one finishes"""
+    uncached_data = []
+    for post_data in posts_data:
+        if IsFullyCached(post_data):
+            yield HashPostImages(post_data)
+        else:
+            uncached_data.append(post_data)
+    if len(uncached_data) == 0:
+        return
+    pool = GetHashPool(workers)
+    futures = [pool.submit(HashPostImages, post_data) for post_data in uncached_data]
+    for future in as_completed(futures):
+        yield future.result()
+
+
+def DigestPostsConcurrently(posts_data, workers=None):
+    """Reading and digesting the previews and samples is left to the process pool as well, so that the files of the
+    different posts get read in parallel. Sets the digests of each post, which are needed to look up its cached hashes."""
+    if len(posts_data) <= 1:
+        all_digests = [DigestPostFiles(post_data) for post_data in posts_data]
+    else:
+        pool = GetHashPool(workers)
+        all_digests = list(pool.map(DigestPostFiles, posts_data))
+    for post_data, digests in zip(posts_data, all_digests):
+        post_data['digests'] = digests
+    return posts_data
+
+
+def HashBuffersConcurrently(buffers, workers=None):
+    """Hash the image buffers in the process pool, returning the results in the same order"""
+    if len(buffers) <= 1:
+        return [HashImageBuffer(buffer) for buffer in buffers]
+    pool = GetHashPool(workers)
+    return list(pool.map(HashImageBuffer, buffers))
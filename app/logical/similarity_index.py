@@ -0,0 +1,403 @@
+# APP/LOGICAL/SIMILARITY_INDEX.PY
+
+# ##PYTHON IMPORTS
+import time
+import threading
+import itertools
+import numpy as np
+
+# ##LOCAL IMPORTS
+from .. import SESSION
+from ..similarity.similarity_data import SimilarityData, HASH_SIZE
+from ..config import SIMILARITY_CANDIDATE_GENERATOR, MIH_SUBSTRINGS, MIH_MAX_RADIUS
+
+
+# ##GLOBAL VARIABLES
+
+TOTAL_BITS = HASH_SIZE * HASH_SIZE
+WORDS_PER_HASH = TOTAL_BITS // 64
+
+INITIAL_CAPACITY = 1024
+
+# Rows appended since the last MIH build are scanned linearly until there are this many
+MIH_REBUILD_THRESHOLD = 4096
+
+# Tile dimensions for the all-pairs join; keeps each popcount block at a few MB
+ALL_PAIRS_ROW_TILE = 128
+ALL_PAIRS_COLUMN_TILE = 1024
+
+# Upper bound of how far apart two ratios can be while one is within the other's band
+MAX_RATIO_SPREAD = 1.0102
+
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+# ##FUNCTIONS
+
+# #### Hash functions
+
+def HashToWords(image_hash):
+    """Convert a hex hash string into an array of 64-bit words"""
+    return HashDataToWords([bytes.fromhex(image_hash)])[0]
+
+
+def HashDataToWords(hash_data):
+    """Convert packed hash blobs into a 2D array of 64-bit words"""
+    if len(hash_data) == 0:
+        return np.zeros((0, WORDS_PER_HASH), dtype=np.uint64)
+    return np.frombuffer(b''.join(hash_data), dtype='>u8').reshape(-1, WORDS_PER_HASH).astype(np.uint64)
+
+
+def Popcount(words):
+    """Count the set bits for each row of a 2D uint64 array"""
+    words = np.ascontiguousarray(words)
+    return POPCOUNT_TABLE[words.view(np.uint8)].reshape(words.shape[0], words.shape[1] * 8).sum(axis=1, dtype=np.int32)
+
+
+def HammingDistance(hash1, hash2):
+    return bin(int(hash1, 16) ^ int(hash2, 16)).count('1')
+
+
+def HashScore(mismatching_bits):
+    return round((1 - (mismatching_bits / TOTAL_BITS)) * 100, 2)
+
+
+def MaxMismatchingBits(min_score):
+    """The largest Hamming distance that still reaches the minimum score"""
+    return int(np.floor((1 - (min_score / 100)) * TOTAL_BITS + 1e-9))
+
+
+def RatioBand(ratio):
+    """Same bounds as SimilarityData.ratio_clause"""
+    return round(ratio * 99, 4) / 100, round(ratio * 101, 4) / 100
+
+
+def InRatioBand(ratios, target_ratios):
+    """Vectorized version of RatioBand; checks whether each ratio is within the band of the target ratio"""
+    return (ratios >= np.round(target_ratios * 99, 4) / 100) & (ratios <= np.round(target_ratios * 101, 4) / 100)
+
+
+# #### Join functions
+
+def AllPairsMatches(hashes, post_ids, ratios, min_score, row_tile=ALL_PAIRS_ROW_TILE, column_tile=ALL_PAIRS_COLUMN_TILE):
+    """Find the best score for every pair of posts with a hash pair at or above the minimum score.
+
+    Rows are sorted by ratio so that each tile of rows only needs to be compared
+    against the contiguous run of columns within its aspect-ratio band. A pair
+    matches when either ratio is within the band of the other, which mirrors
+    running PopulateSimilarityPools for both posts.
+    Returns the arrays (post_id1, post_id2, score, total_comparisons) with post_id1 < post_id2.
+    """
+    valid = ~np.isnan(ratios)
+    order = np.argsort(ratios[valid], kind='stable')
+    hashes = np.ascontiguousarray(hashes[valid][order])
+    post_ids = post_ids[valid][order]
+    ratios = ratios[valid][order]
+    max_bits = MaxMismatchingBits(min_score)
+    found_pairs = []
+    found_bits = []
+    total_comparisons = 0
+    for row_start in range(0, len(ratios), row_tile):
+        row_end = min(row_start + row_tile, len(ratios))
+        column_end = np.searchsorted(ratios, ratios[row_end - 1] * MAX_RATIO_SPREAD, side='right')
+        row_hashes = hashes[row_start:row_end]
+        row_indexes = np.arange(row_start, row_end)
+        for column_start in range(row_start, column_end, column_tile):
+            column_stop = min(column_start + column_tile, column_end)
+            column_indexes = np.arange(column_start, column_stop)
+            xor = row_hashes[:, None, :] ^ hashes[column_start:column_stop][None, :, :]
+            mismatching_bits = POPCOUNT_TABLE[xor.view(np.uint8)].sum(axis=2, dtype=np.int32)
+            total_comparisons += mismatching_bits.size
+            candidate_rows, candidate_columns = np.nonzero(mismatching_bits <= max_bits)
+            rows = row_indexes[candidate_rows]
+            columns = column_indexes[candidate_columns]
+            valid = (columns > rows) & (post_ids[rows] != post_ids[columns])
+            valid &= InRatioBand(ratios[columns], ratios[rows]) | InRatioBand(ratios[rows], ratios[columns])
+            if not valid.any():
+                continue
+            rows = rows[valid]
+            columns = columns[valid]
+            found_pairs.append(np.stack([np.minimum(post_ids[rows], post_ids[columns]), np.maximum(post_ids[rows], post_ids[columns])], axis=1))
+            found_bits.append(mismatching_bits[candidate_rows[valid], candidate_columns[valid]])
+    if len(found_pairs) == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([], dtype=np.float64), total_comparisons
+    pairs = np.concatenate(found_pairs)
+    bits = np.concatenate(found_bits)
+    # Keep the lowest Hamming distance for each post pair
+    best = np.lexsort((bits, pairs[:, 1], pairs[:, 0]))
+    pairs = pairs[best]
+    bits = bits[best]
+    first = np.ones(len(pairs), dtype=bool)
+    first[1:] = np.any(pairs[1:] != pairs[:-1], axis=1)
+    scores = np.round((1 - (bits[first] / TOTAL_BITS)) * 100, 2)
+    return pairs[first, 0], pairs[first, 1], scores, total_comparisons
+
+
+# #### Result functions
+
+def BestPostMatches(group_indexes, post_ids, scores, group_count, limit=None):
+    """Reduce the matches to the best score per post within each group, returning a (post_ids, scores)
+    pair of arrays for each group, best first. Only the top results are fully sorted when there is a limit."""
+    order = np.lexsort((-scores, post_ids, group_indexes))
+    group_indexes, post_ids, scores = group_indexes[order], post_ids[order], scores[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (group_indexes[1:] != group_indexes[:-1]) | (post_ids[1:] != post_ids[:-1])
+    group_indexes, post_ids, scores = group_indexes[first], post_ids[first], scores[first]
+    boundaries = np.searchsorted(group_indexes, np.arange(group_count + 1))
+    best_matches = []
+    for i in range(group_count):
+        group_post_ids = post_ids[boundaries[i]: boundaries[i + 1]]
+        group_scores = scores[boundaries[i]: boundaries[i + 1]]
+        if limit is not None and len(group_scores) > limit:
+            # Partial sort for the cutoff score; ties at the cutoff go to the lowest post IDs, which come first
+            cutoff_score = -np.partition(-group_scores, limit - 1)[limit - 1]
+            above = np.flatnonzero(group_scores > cutoff_score)
+            ties = np.flatnonzero(group_scores == cutoff_score)[:limit - len(above)]
+            top = np.concatenate([above, ties])
+            group_post_ids, group_scores = group_post_ids[top], group_scores[top]
+        top_order = np.lexsort((group_post_ids, -group_scores))
+        best_matches.append((group_post_ids[top_order], group_scores[top_order]))
+    return best_matches
+
+
+def ScoreHistogram(scores):
+    """Number of matches per whole score, highest first"""
+    buckets = np.floor(scores + 1e-9).astype(np.int64)
+    counts = np.bincount(buckets, minlength=101) if len(buckets) else np.zeros(101, dtype=np.int64)
+    return [{'score': score, 'count': int(counts[score])} for score in range(len(counts) - 1, -1, -1) if counts[score] > 0]
+
+
+# ##CLASSES
+
+class FullScanCandidates():
+    """Every row in the index is a candidate"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def candidates(self, words, min_score):
+        return np.arange(self.index.count)
+
+    def invalidate(self):
+        pass
+
+
+class MultiIndexHashCandidates():
+    """Multi-index hashing over disjoint substrings of the hash.
+
+    Each substring has its own table from substring value to rows, stored as a
+    sorted value array with the matching row order. By the pigeonhole principle,
+    any row within MIH_SUBSTRINGS * (radius + 1) - 1 bits of the query matches at
+    least one substring within the radius, so probing those neighbours is exact.
+    """
+
+    def __init__(self, index, substrings, max_radius):
+        if (substrings % WORDS_PER_HASH) or (64 % (TOTAL_BITS // substrings)):
+            raise ValueError("Number of MIH substrings must evenly divide the hash words: %d" % substrings)
+        self.index = index
+        self.substrings = substrings
+        self.max_radius = max_radius
+        self.bits = TOTAL_BITS // substrings
+        self.dtype = np.uint16 if self.bits <= 16 else np.uint32 if self.bits <= 32 else np.uint64
+        self._neighbor_masks = {}
+        self.invalidate()
+
+    def candidates(self, words, min_score):
+        radius = MaxMismatchingBits(min_score) // self.substrings
+        if radius > self.max_radius:
+            return np.arange(self.index.count)
+        if self.stale or (self.index.count - self.built_count) > MIH_REBUILD_THRESHOLD:
+            self.rebuild()
+        query_values = self._substring_values(words.reshape(1, -1))[0]
+        masks = self._get_neighbor_masks(radius)
+        found = [np.arange(self.built_count, self.index.count)]
+        for i in range(self.substrings):
+            neighbors = query_values[i] ^ masks
+            left = np.searchsorted(self.values[i], neighbors, side='left')
+            right = np.searchsorted(self.values[i], neighbors, side='right')
+            for start, end in zip(left[right > left], right[right > left]):
+                found.append(self.rows[i][start:end])
+        return np.unique(np.concatenate(found))
+
+    def invalidate(self):
+        self.stale = True
+        self.built_count = 0
+        self.values = []
+        self.rows = []
+
+    def rebuild(self):
+        starttime = time.time()
+        count = self.index.count
+        substring_values = self._substring_values(self.index.hashes)
+        self.values = []
+        self.rows = []
+        for i in range(self.substrings):
+            order = np.argsort(substring_values[:, i], kind='stable').astype(np.int32)
+            self.values.append(substring_values[order, i])
+            self.rows.append(order)
+        self.built_count = count
+        self.stale = False
+        print("MultiIndexHashCandidates: built %d tables over %d hashes in %.2f seconds." % (self.substrings, count, time.time() - starttime))
+
+    # #### Private
+
+    def _substring_values(self, hashes):
+        per_word = 64 // self.bits
+        mask = np.uint64((1 << self.bits) - 1)
+        values = np.empty((hashes.shape[0], self.substrings), dtype=self.dtype)
+        for i in range(self.substrings):
+            shift = np.uint64(64 - (self.bits * ((i % per_word) + 1)))
+            values[:, i] = (hashes[:, i // per_word] >> shift) & mask
+        return values
+
+    def _get_neighbor_masks(self, radius):
+        if radius not in self._neighbor_masks:
+            masks = [sum(1 << bit for bit in bits) for distance in range(radius + 1) for bits in itertools.combinations(range(self.bits), distance)]
+            self._neighbor_masks[radius] = np.array(masks, dtype=self.dtype)
+        return self._neighbor_masks[radius]
+
+
+class SimilarityIndex():
+    """In-memory packed copy of the similarity data, scored with a vectorized XOR + popcount"""
+
+    def __init__(self, generator=SIMILARITY_CANDIDATE_GENERATOR):
+        self.lock = threading.RLock()
+        self.loaded = False
+        self._reset(INITIAL_CAPACITY)
+        if generator == 'mih':
+            self.generator = MultiIndexHashCandidates(self, MIH_SUBSTRINGS, MIH_MAX_RADIUS)
+        elif generator == 'scan':
+            self.generator = FullScanCandidates(self)
+        else:
+            raise ValueError("Unknown similarity candidate generator: %s" % generator)
+
+    # ## Property methods
+
+    @property
+    def hashes(self):
+        return self._hashes[:self.count]
+
+    @property
+    def post_ids(self):
+        return self._post_ids[:self.count]
+
+    @property
+    def ratios(self):
+        return self._ratios[:self.count]
+
+    # ## Methods
+
+    def load(self):
+        starttime = time.time()
+        rows = SESSION.query(SimilarityData.post_id, SimilarityData.ratio, SimilarityData.hash_data).all()
+        with self.lock:
+            count = len(rows)
+            self._reset(max(count, INITIAL_CAPACITY))
+            if count > 0:
+                post_ids, ratios, hash_data = zip(*rows)
+                self._hashes[:count] = HashDataToWords(hash_data)
+                self._post_ids[:count] = post_ids
+                self._ratios[:count] = [ratio if ratio is not None else np.nan for ratio in ratios]
+                self.count = count
+            self.loaded = True
+            self.generator.invalidate()
+        print("SimilarityIndex: loaded %d hashes in %.2f seconds." % (self.count, time.time() - starttime))
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def append(self, sdata_items):
+        """Add newly created similarity data. A no-op until the index has been loaded."""
+        with self.lock:
+            if not self.loaded:
+                return
+            for sdata in sdata_items:
+                self._add(sdata.post_id, sdata.ratio, sdata.hash_data)
+
+    def remove(self, post_id):
+        self.remove_many([post_id])
+
+    def remove_many(self, post_ids):
+        with self.lock:
+            if not self.loaded:
+                return
+            keep = ~np.isin(self.post_ids, list(post_ids))
+            count = int(keep.sum())
+            self._hashes[:count] = self.hashes[keep]
+            self._post_ids[:count] = self.post_ids[keep]
+            self._ratios[:count] = self.ratios[keep]
+            self.count = count
+            self.generator.invalidate()
+
+    def query(self, image_hash, ratio, min_score, exclude_post_id=None):
+        """Return the score results at or above the minimum score, best first"""
+        return self.query_many([image_hash], [ratio], min_score, exclude_post_id)[0]
+
+    def query_many(self, image_hashes, ratios, min_score, exclude_post_id=None):
+        """Score several hashes in a single vectorized pass, returning a result list for each hash in the same order"""
+        query_indexes, post_ids, scores = self._score_many(image_hashes, ratios, min_score, exclude_post_id)
+        order = np.lexsort((-scores, query_indexes))
+        boundaries = np.searchsorted(query_indexes[order], np.arange(len(image_hashes) + 1))
+        return [[{'post_id': int(post_ids[i]), 'score': float(scores[i])} for i in order[boundaries[j]: boundaries[j + 1]]]
+                for j in range(len(image_hashes))]
+
+    def query_best(self, hash_groups, min_score, limit=None, exclude_post_id=None, histogram=False):
+        """Score each group of (image_hash, ratio) pairs, returning the best score of each matching post across
+        the group, best first and cut off at the limit. The histogram counts every matching hash per whole score."""
+        hash_items = [hash_item for hash_group in hash_groups for hash_item in hash_group]
+        hash_group_indexes = np.repeat(np.arange(len(hash_groups)), [len(hash_group) for hash_group in hash_groups])
+        query_indexes, post_ids, scores = self._score_many([item[0] for item in hash_items], [item[1] for item in hash_items], min_score, exclude_post_id)
+        group_indexes = hash_group_indexes[query_indexes]
+        best_matches = BestPostMatches(group_indexes, post_ids, scores, len(hash_groups), limit)
+        results = [{'post_results': [{'post_id': int(post_id), 'score': float(score)} for post_id, score in zip(*best_match)]}
+                   for best_match in best_matches]
+        if histogram:
+            for i, result in enumerate(results):
+                result['histogram'] = ScoreHistogram(scores[group_indexes == i])
+        return results
+
+    # #### Private
+
+    def _score_many(self, image_hashes, ratios, min_score, exclude_post_id):
+        """Returns the query index, post ID and score arrays of all matches"""
+        self.ensure_loaded()
+        if len(image_hashes) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        query_words = HashDataToWords([bytes.fromhex(image_hash) for image_hash in image_hashes])
+        query_ratios = np.array([ratio if ratio is not None else np.nan for ratio in ratios], dtype=np.float64)
+        with self.lock:
+            row_groups = [self.generator.candidates(words, min_score) for words in query_words]
+            query_indexes = np.repeat(np.arange(len(row_groups)), [len(rows) for rows in row_groups])
+            rows = np.concatenate(row_groups).astype(np.int64)
+            mask = InRatioBand(self.ratios[rows], query_ratios[query_indexes])
+            if exclude_post_id is not None:
+                mask &= (self.post_ids[rows] != exclude_post_id)
+            rows = rows[mask]
+            query_indexes = query_indexes[mask]
+            mismatching_bits = Popcount(self.hashes[rows] ^ query_words[query_indexes])
+            post_ids = self.post_ids[rows]
+        scores = np.round((1 - (mismatching_bits / TOTAL_BITS)) * 100, 2)
+        matches = scores >= min_score
+        return query_indexes[matches], post_ids[matches], scores[matches]
+
+    def _reset(self, capacity):
+        self.count = 0
+        self._hashes = np.zeros((capacity, WORDS_PER_HASH), dtype=np.uint64)
+        self._post_ids = np.zeros(capacity, dtype=np.int64)
+        self._ratios = np.zeros(capacity, dtype=np.float64)
+
+    def _add(self, post_id, ratio, hash_data):
+        if self.count == len(self._post_ids):
+            self._grow()
+        self._hashes[self.count] = HashDataToWords([hash_data])[0]
+        self._post_ids[self.count] = post_id
+        self._ratios[self.count] = ratio if ratio is not None else np.nan
+        self.count += 1
+
+    def _grow(self):
+        capacity = len(self._post_ids) * 2
+        self._hashes = np.resize(self._hashes, (capacity, WORDS_PER_HASH))
+        self._post_ids = np.resize(self._post_ids, capacity)
+        self._ratios = np.resize(self._ratios, capacity)
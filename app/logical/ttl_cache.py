@@ -0,0 +1,61 @@
+# APP/LOGICAL/TTL_CACHE.PY
+
+# ##PYTHON IMPORTS
+import datetime
+import threading
+from collections import OrderedDict
+
+# ##LOCAL IMPORTS
+from .utility import GetCurrentTime
+
+
+# ##CLASSES
+
+class TTLCache():
+    """Thread-safe LRU cache where each entry also expires after the TTL, or earlier if given its own expiration"""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+
+    # ## Instance functions
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= GetCurrentTime():
+                del self.entries[key]
+                self.counters['expired'] += 1
+                entry = None
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return entry[0]
+
+    def set(self, key, value, expires=None):
+        max_expires = GetCurrentTime() + self.ttl
+        expires = min(expires, max_expires) if expires is not None else max_expires
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def status(self):
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            hit_rate = round(self.counters['hits'] / lookups * 100, 2) if lookups > 0 else None
+            return dict(self.counters, size=len(self.entries), maxsize=self.maxsize, hit_rate=hit_rate)
@@ -96,6 +96,10 @@ def MinutesAgo(minutes):
     return GetCurrentTime() - datetime.timedelta(minutes=minutes)
 
 
+def SecondsAgo(seconds):
+    return GetCurrentTime() - datetime.timedelta(seconds=seconds)
+
+
 def SecondsFromNowLocal(seconds):
     return datetime.datetime.now() + datetime.timedelta(seconds=seconds)
 
@@ -21,6 +21,7 @@ from .booru import Booru  # noqa: F401
 from .error import Error  # noqa: F401
 from .post import Post  # noqa: F401
 from .upload_url import UploadUrl  # noqa: F401
+from .upload_step import UploadStep  # noqa: F401
 from .upload import Upload  # noqa: F401
 from .notation import Notation  # noqa: F401
 from .pool import Pool  # noqa: F401
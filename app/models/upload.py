@@ -10,8 +10,9 @@ from sqlalchemy.ext.associationproxy import association_proxy
 # ##LOCAL IMPORTS
 from .. import DB
 from ..logical.utility import UniqueObjects
-from ..base_model import JsonModel, IntOrNone, StrOrNone
+from ..base_model import JsonModel, IntOrNone, StrOrNone, DateTimeOrNull
 from .upload_url import UploadUrl
+from .upload_step import UploadStep
 from .post import Post
 from .error import Error
 
@@ -54,16 +55,19 @@ class Upload(JsonModel):
     status: str
     successes: int
     failures: int
+    resumes: int
     image_urls: List
     post_ids: List[int]
     errors: List
     created: datetime.datetime.isoformat
+    heartbeat: DateTimeOrNull
 
     # #### Columns
     id = DB.Column(DB.Integer, primary_key=True)
     request_url = DB.Column(DB.String(255), nullable=True)
     successes = DB.Column(DB.Integer, nullable=False)
     failures = DB.Column(DB.Integer, nullable=False)
+    resumes = DB.Column(DB.Integer, nullable=False, server_default='0')
     type = DB.Column(DB.String(255), nullable=False)
     status = DB.Column(DB.String(255), nullable=False)
     media_filepath = DB.Column(DB.String(255), nullable=True)
@@ -71,11 +75,13 @@ class Upload(JsonModel):
     illust_url_id = DB.Column(DB.Integer, DB.ForeignKey('illust_url.id'), nullable=True)
     subscription_id = DB.Column(DB.Integer, DB.ForeignKey('subscription.id'), nullable=True)
     created = DB.Column(DB.DateTime(timezone=False), nullable=False)
+    heartbeat = DB.Column(DB.DateTime(timezone=False), nullable=True)
 
     # #### Relationships
     image_urls = DB.relationship(UploadUrl, secondary=UploadUrls, lazy=True, uselist=True, backref=DB.backref('upload', lazy=True, uselist=False), cascade='all,delete')
     posts = DB.relationship(Post, secondary=UploadPosts, backref=DB.backref('uploads', lazy=True), lazy=True)
     errors = DB.relationship(Error, secondary=UploadErrors, lazy=True, cascade='all,delete')
+    steps = DB.relationship(UploadStep, lazy=True, backref=DB.backref('upload', lazy=True), cascade='all,delete')
 
     # #### Association proxies
     post_ids = association_proxy('posts', 'id')
@@ -116,8 +122,13 @@ class Upload(JsonModel):
             return GetSourceById(self.illust_url.site_id)
         raise Exception("Unable to find source for upload #%d" % self.id)
 
+    # ## Methods
+
+    def get_step(self, illust_url):
+        return next((step for step in self.steps if step.illust_url_id == illust_url.id), None)
+
     # ## Class properties
 
-    basic_attributes = ['id', 'successes', 'failures', 'subscription_id', 'illust_url_id', 'request_url', 'type', 'status', 'media_filepath', 'sample_filepath', 'created']
+    basic_attributes = ['id', 'successes', 'failures', 'resumes', 'subscription_id', 'illust_url_id', 'request_url', 'type', 'status', 'media_filepath', 'sample_filepath', 'created', 'heartbeat']
     relation_attributes = ['image_urls', 'posts', 'errors']
     searchable_attributes = basic_attributes + relation_attributes
@@ -0,0 +1,58 @@
+# APP/MODELS/UPLOAD_STEP.PY
+
+# ## PYTHON IMPORTS
+import datetime
+from dataclasses import dataclass
+
+# ## LOCAL IMPORTS
+from .. import DB
+from ..base_model import JsonModel, IntOrNone, StrOrNone
+
+
+# ## GLOBAL VARIABLES
+
+# downloaded -> saved -> complete, with failed being a terminal state. Each illust URL of an upload
+# gets a checkpoint, so that a restarted upload resumes from the last step that was completed.
+UPLOAD_STEP_STATES = ['downloaded', 'saved', 'complete', 'failed']
+
+
+# ## CLASSES
+
+@dataclass
+class UploadStep(JsonModel):
+    # ## Declarations
+
+    # #### JSON format
+    id: int
+    upload_id: int
+    illust_url_id: int
+    state: str
+    md5: StrOrNone
+    file_ext: StrOrNone
+    size: IntOrNone
+    updated: datetime.datetime.isoformat
+
+    # #### SqlAlchemy
+    __table_args__ = (
+        DB.Index('ix_upload_step_upload_id_illust_url_id', 'upload_id', 'illust_url_id', unique=True),
+    )
+
+    # #### Columns
+    id = DB.Column(DB.Integer, primary_key=True)
+    upload_id = DB.Column(DB.Integer, DB.ForeignKey('upload.id'), nullable=False)
+    illust_url_id = DB.Column(DB.Integer, DB.ForeignKey('illust_url.id'), nullable=False)
+    state = DB.Column(DB.String(16), nullable=False)
+    md5 = DB.Column(DB.String(32), nullable=True)
+    file_ext = DB.Column(DB.String(6), nullable=True)
+    size = DB.Column(DB.Integer, nullable=True)
+    updated = DB.Column(DB.DateTime(timezone=False), nullable=False)
+
+    # ## Property methods
+
+    @property
+    def is_finished(self):
+        return self.state in ['complete', 'failed']
+
+    # ## Class properties
+
+    searchable_attributes = ['id', 'upload_id', 'illust_url_id', 'state', 'md5', 'file_ext', 'size', 'updated']
@@ -4,6 +4,8 @@
 from .similarity_data import SimilarityData  # noqa: F401
 from .similarity_pool import SimilarityPool  # noqa: F401
 from .similarity_pool_element import SimilarityPoolElement  # noqa: F401
+from .similarity_hash_cache import SimilarityHashCache  # noqa: F401
+from .similarity_queue import SimilarityQueue  # noqa: F401
 
 
 # GLOBAL VARIABLES
@@ -0,0 +1,35 @@
+# APP/SIMILARITY/SIMILARITY_HASH_CACHE.PY
+
+# ##LOCAL IMPORTS
+from .. import DB
+
+
+# ##CLASSES
+
+class SimilarityHashCache(DB.Model):
+    # ## Declarations
+
+    # #### SqlAlchemy
+    __bind_key__ = 'similarity'
+    __table_args__ = (
+        DB.Index('ix_similarity_hash_cache_lookup', 'md5', 'variant', 'algorithm', 'hash_size', unique=True),
+    )
+
+    # #### Columns
+    id = DB.Column(DB.Integer, primary_key=True)
+    # MD5 of the file that was hashed, which for previews and samples isn't the MD5 of the post
+    md5 = DB.Column(DB.String(32), nullable=False)
+    variant = DB.Column(DB.String(16), nullable=False)
+    algorithm = DB.Column(DB.String(16), nullable=False)
+    hash_size = DB.Column(DB.Integer, nullable=False)
+    hash_data = DB.Column(DB.LargeBinary, nullable=False)
+
+    # ## Property methods
+
+    @property
+    def image_hash(self):
+        return self.hash_data.hex()
+
+    @image_hash.setter
+    def image_hash(self, image_hash):
+        self.hash_data = bytes.fromhex(image_hash)
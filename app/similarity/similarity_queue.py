@@ -0,0 +1,31 @@
+# APP/SIMILARITY/SIMILARITY_QUEUE.PY
+
+# ##LOCAL IMPORTS
+from .. import DB
+
+
+# ##GLOBAL VARIABLES
+
+# pending -> hashed -> pooled, with failed being a terminal state until the post is enqueued again
+QUEUE_STATES = ['pending', 'hashed', 'pooled', 'failed']
+
+
+# ##CLASSES
+
+class SimilarityQueue(DB.Model):
+    # ## Declarations
+
+    # #### SqlAlchemy
+    __bind_key__ = 'similarity'
+    __table_args__ = (
+        DB.Index('ix_similarity_queue_post_id', 'post_id', unique=True),
+        DB.Index('ix_similarity_queue_state_id', 'state', 'id'),
+    )
+
+    # #### Columns
+    id = DB.Column(DB.Integer, primary_key=True)
+    post_id = DB.Column(DB.Integer, nullable=False)
+    state = DB.Column(DB.String(8), nullable=False)
+    error = DB.Column(DB.String(255), nullable=True)
+    created = DB.Column(DB.DateTime(timezone=False), nullable=False)
+    updated = DB.Column(DB.DateTime(timezone=False), nullable=False)
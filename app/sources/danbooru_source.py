@@ -1,26 +1,20 @@
 # APP/SOURCES/TWITTER.PY
 
 # ##PYTHON IMPORTS
-import time
 import requests
 
 # ##LOCAL IMPORTS
 from ..config import DANBOORU_HOSTNAME
+from ..logical.network import GetSession
 from ..logical.utility import AddDictEntry
 
 
 # ##FUNCTIONS
 
 def DanbooruRequest(url, params=None):
-    for i in range(3):
-        try:
-            response = requests.get(DANBOORU_HOSTNAME + url, params=params, timeout=10)
-        except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError):
-            print("Pausing for network timeout...")
-            time.sleep(5)
-            continue
-        break
-    else:
+    try:
+        response = GetSession(DANBOORU_HOSTNAME).get(DANBOORU_HOSTNAME + url, params=params, timeout=10)
+    except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError):
         return {'error': True, 'message': "Connection errors exceeded."}
     if response.status_code == 200:
         return {'error': False, 'json': response.json()}
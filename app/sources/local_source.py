@@ -36,3 +36,18 @@ def SimilarityRegeneratePost(post_id):
     if resp.status_code != 200:
         return {'error': True, 'message': "Similarity server - HTTP %d: %s" % (resp.status_code, resp.reason)}
     return resp.json()
+
+
+def SimilarityCheckFile(filepath, score=90.0):
+    data = {
+        'score': score,
+    }
+    try:
+        with open(filepath, 'rb') as file:
+            resp = requests.post('http://127.0.0.1:%d/check_similarity_file.json' % SIMILARITY_PORT, files={'file': file}, data=data, timeout=10)
+    except Exception as e:
+        return {'error': True, 'message': "Unable to contact similarity server: %s" % str(e)}
+    if resp.status_code != 200:
+        return {'error': True, 'message': "Similarity server - HTTP %d: %s" % (resp.status_code, resp.reason)}
+    return resp.json()
+
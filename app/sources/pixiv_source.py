@@ -2,15 +2,15 @@
 
 # ##PYTHON IMPORTS
 import re
-import time
 import urllib
 import requests
 import datetime
 
 # ##LOCAL IMPORTS
 from ..logical.utility import GetCurrentTime, GetFileExtension, GetHTTPFilename, SafeGet, FixupCRLF, ProcessUTCTimestring
+from ..logical.network import GetSession
 from ..database.error_db import CreateError, IsError
-from ..database.cache_db import GetApiArtist, GetApiIllust, GetApiData, SaveApiData
+from ..database.cache_db import GetApiArtist, GetApiIllust, GetApiItem, GetApiItems, SaveApiData
 from ..config import PIXIV_PHPSESSID
 from ..sites import Site, GetSiteDomain, GetSiteId
 
@@ -281,18 +281,12 @@ def NormalizeImageURL(image_url):
 #   Network
 
 def PixivRequest(url):
-    for i in range(3):
-        try:
-            response = requests.get(url, headers=API_HEADERS, cookies=API_JAR, timeout=10)
-        except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError) as e:
-            if i == 2:
-                print("Connection errors exceeded!")
-                return {'error': True, 'message': repr(e)}
-            print("Pausing for network timeout...")
-            time.sleep(5)
-            continue
-        if response.status_code == 200:
-            break
+    try:
+        response = GetSession(url).get(url, headers=API_HEADERS, cookies=API_JAR, timeout=10)
+    except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError) as e:
+        print("Connection errors exceeded!")
+        return {'error': True, 'message': repr(e)}
+    if response.status_code != 200:
         print("\n%s\nHTTP %d: %s (%s)" % (url, response.status_code, response.reason, response.text))
         return {'error': True, 'message': "HTTP %d - %s" % (response.status_code, response.reason)}
     try:
@@ -448,26 +442,22 @@ def GetArtistParametersFromPxuser(pxuser, artwork):
 # Data lookup functions
 
 def GetPageData(site_illust_id):
-    page_data = GetApiData([site_illust_id], SITE_ID, 'page')
-    if len(page_data) == 0:
+    page_data = GetApiItem(site_illust_id, SITE_ID, 'page')
+    if page_data is None:
         page_data = GetPixivPageData(site_illust_id)
         if IsError(page_data):
             return
         SaveApiData([page_data], 'illustId', SITE_ID, 'page')
-    else:
-        page_data = page_data[0].data
     return page_data
 
 
 def GetProfileData(site_artist_id):
-    profile_data = GetApiData([site_artist_id], SITE_ID, 'profile')
-    if len(profile_data) == 0:
+    profile_data = GetApiItem(site_artist_id, SITE_ID, 'profile')
+    if profile_data is None:
         profile_data = GetPixivProfileData(site_artist_id)
         if IsError(profile_data):
             return
         SaveApiData([profile_data], 'userId', SITE_ID, 'profile')
-    else:
-        profile_data = profile_data[0].data
     return profile_data
 
 
@@ -491,9 +481,9 @@ def GetArtistData(site_artist_id):
     if not IsError(profile_data):
         artwork_ids = [int(artwork_id) for artwork_id in (SafeGet(profile_data, 'profile', 'illusts') or {}).keys()]
         if len(artwork_ids):
-            artworks = GetApiData(artwork_ids, SITE_ID, 'illust')
+            artworks = GetApiItems(artwork_ids, SITE_ID, 'illust')
             if len(artworks):
-                artwork = artworks[0].data
+                artwork = artworks[0]
             else:
                 artwork = GetIllustApiData(artwork_ids[0])
     return GetArtistParametersFromPxuser(pxuser, artwork)
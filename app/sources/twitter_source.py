@@ -3,7 +3,6 @@
 # ##PYTHON IMPORTS
 import os
 import re
-import time
 import json
 import urllib
 import requests
@@ -12,6 +11,7 @@ import datetime
 # ##LOCAL IMPORTS
 from ..logical.utility import GetCurrentTime, GetFileExtension, GetHTTPFilename, SafeGet, DecodeJSON, FixupCRLF
 from ..logical.file import LoadDefault, PutGetJSON
+from ..logical.network import GetSession
 from ..database.error_db import CreateError, IsError
 from ..database.cache_db import GetApiArtist, GetApiIllust, SaveApiData
 from ..database.illust_db import GetSiteIllust
@@ -148,11 +148,6 @@ https?://t\.co                         # Hostname
 
 # #### Network variables
 
-REQUEST_METHODS = {
-    'GET': requests.get,
-    'POST': requests.post
-}
-
 TWITTER_GUEST_AUTH = "AAAAAAAAAAAAAAAAAAAAANRILgAAAAAAnNwIzUejRCOuH5E6I8xnZz4puTs%3D1Zv7ttfk8LF81IUq16cHjhLTvJu4FA33AGWWjCpTnA"
 
 TWITTER_SEARCH_PARAMS = {
@@ -556,22 +551,16 @@ def ReauthenticationCheck(response):
 
 @CheckGuestAuth
 def TwitterRequest(url, method='GET'):
-    reauthenticated = False
-    for i in range(3):
+    for reauthenticated in [False, True]:
         try:
-            response = REQUEST_METHODS[method](url, headers=TWITTER_HEADERS, timeout=10)
+            response = GetSession(url).request(method, url, headers=TWITTER_HEADERS, timeout=10)
         except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError) as e:
-            if i == 2:
-                print("Connection errors exceeded!")
-                return {'error': True, 'message': repr(e)}
-            print("Pausing for network timeout...")
-            time.sleep(5)
-            continue
+            print("Connection errors exceeded!")
+            return {'error': True, 'message': repr(e)}
         if response.status_code == 200:
             break
         if not reauthenticated and ReauthenticationCheck(response):
             AuthenticateGuest(True)
-            reauthenticated = True
         else:
             print("\n%s\nHTTP %d: %s (%s)" % (url, response.status_code, response.reason, response.text))
             return {'error': True, 'message': "HTTP %d - %s" % (response.status_code, response.reason)}
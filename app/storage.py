@@ -1,8 +1,15 @@
 # APP/STORAGE.PY
 
+# ## PYTHON IMPORTS
+import os
+import re
+import errno
+import tempfile
+
 # ## LOCAL IMPORTS
 from . import SERVER_INFO
-from .config import WORKING_DIRECTORY, IMAGE_FILEPATH, IMAGE_PORT
+from .logical.file import CreateDirectory
+from .config import WORKING_DIRECTORY, IMAGE_FILEPATH, IMAGE_PORT, DERIVATIVE_STORAGE
 
 # ### GLOBAL VARIABLES
 
@@ -13,6 +20,68 @@ SAMPLE_DIMENSIONS = (1280, 1920)
 
 CACHE_DATA_DIRECTORY = IMAGE_DIRECTORY + 'cache\\'
 
+# Downloads in progress; kept alongside the data directories so that finished files can be renamed into place
+TEMP_DIRECTORY = IMAGE_DIRECTORY + 'temp\\'
+
+# Segments and index of the packed derivative store
+PACKED_DIRECTORY = IMAGE_DIRECTORY + 'packed\\'
+
+DERIVATIVE_TYPES = ['preview', 'sample']
+
+DERIVATIVE_FILENAME_RG = re.compile(r'^([0-9a-f]{32})\.(\w+)$')
+DERIVATIVE_FILEPATH_RG = re.compile(re.escape(IMAGE_DIRECTORY) + r'(preview|sample)[\\/][0-9a-f]{2}[\\/][0-9a-f]{2}[\\/]([0-9a-f]{32})\.(\w+)$')
+
+# Originals are always plain files; the previews and samples made from them are kept by the configured store
+DERIVATIVE_STORES = {
+    'files': lambda: FileStore(),
+    'packed': lambda: _PackedStore(),
+}
+
+DERIVATIVE_STORE = None
+
+
+# ## CLASSES
+
+class FileStore():
+    """Each file is kept on its own in the sharded data directories"""
+    plain_files = True
+
+    def exists(self, type, md5, file_ext):
+        return os.path.exists(DerivativeFilepath(type, md5, file_ext))
+
+    def open(self, type, md5, file_ext):
+        try:
+            return open(DerivativeFilepath(type, md5, file_ext), 'rb')
+        except FileNotFoundError:
+            return None
+
+    def read(self, type, md5, file_ext):
+        file = self.open(type, md5, file_ext)
+        if file is None:
+            return None
+        with file:
+            return file.read()
+
+    def save(self, type, md5, file_ext, data):
+        """Written to a temp file which is then renamed into place, so that a partial file is never served"""
+        filepath = DerivativeFilepath(type, md5, file_ext)
+        CreateDirectory(filepath)
+        handle, temp_filepath = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(filepath))
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                file.write(data)
+            os.replace(temp_filepath, filepath)
+        except Exception:
+            os.remove(temp_filepath)
+            raise
+
+    def save_many(self, files):
+        for (type, md5, file_ext, data) in files:
+            self.save(type, md5, file_ext, data)
+
+    def close(self):
+        pass
+
 
 # ## FUNCTIONS
 
@@ -20,6 +89,20 @@ def DataDirectory(type, md5):
     return IMAGE_DIRECTORY + '%s\\%s\\%s\\' % (type, md5[0:2], md5[2:4])
 
 
+def DataFilepath(md5, file_ext):
+    return DataDirectory('data', md5) + md5 + '.' + file_ext
+
+
+def DerivativeFilepath(type, md5, file_ext='jpg'):
+    return DataDirectory(type, md5) + md5 + '.' + file_ext
+
+
+def ParseDerivativeFilepath(filepath):
+    """Returns the type, MD5 and file extension of a path to a preview or sample, otherwise None"""
+    match = DERIVATIVE_FILEPATH_RG.match(filepath)
+    return match.groups() if match is not None else None
+
+
 def NetworkDirectory(type, md5):
     return _ImageServerUrl() + '/%s/%s/%s/' % (type, md5[0:2], md5[2:4])
 
@@ -36,7 +119,64 @@ def HasPreview(width, height):
     return width > PREVIEW_DIMENSIONS[0] or height > PREVIEW_DIMENSIONS[1]
 
 
+# #### Store functions
+
+def GetDerivativeStore():
+    global DERIVATIVE_STORE
+    if DERIVATIVE_STORE is None:
+        DERIVATIVE_STORE = DERIVATIVE_STORES[DERIVATIVE_STORAGE]()
+    return DERIVATIVE_STORE
+
+
+def OpenFile(filepath):
+    """Open a file from the image directory for reading, wherever the store keeps it"""
+    derivative = ParseDerivativeFilepath(filepath)
+    if derivative is None:
+        return open(filepath, 'rb')
+    file = GetDerivativeStore().open(*derivative)
+    if file is None:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), filepath)
+    return file
+
+
+def ReadFile(filepath):
+    """Returns None when the file doesn't exist"""
+    try:
+        with OpenFile(filepath) as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def PackDerivativeFiles(store, batch_size=1000):
+    """Move the previews and samples that are plain files into the store, removing the emptied directories"""
+    count = 0
+    for type in DERIVATIVE_TYPES:
+        for dirpath, dirnames, filenames in os.walk(IMAGE_DIRECTORY + type + '\\', topdown=False):
+            filepaths = [os.path.join(dirpath, filename) for filename in filenames if DERIVATIVE_FILENAME_RG.match(filename)]
+            for i in range(0, len(filepaths), batch_size):
+                batch = filepaths[i: i + batch_size]
+                store.save_many(_PlainDerivativeFile(type, filepath) for filepath in batch)
+                for filepath in batch:
+                    os.remove(filepath)
+                count += len(batch)
+            if len(os.listdir(dirpath)) == 0:
+                os.rmdir(dirpath)
+    return count
+
+
 # #### Private functions
 
+def _PackedStore():
+    from .logical.packed_storage import PackedStore
+    return PackedStore(PACKED_DIRECTORY)
+
+
+def _PlainDerivativeFile(type, filepath):
+    md5, file_ext = DERIVATIVE_FILENAME_RG.match(os.path.basename(filepath)).groups()
+    with open(filepath, 'rb') as file:
+        return (type, md5, file_ext, file.read())
+
+
 def _ImageServerUrl():
     return 'http://' + SERVER_INFO.addr + ':' + str(IMAGE_PORT)
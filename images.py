@@ -2,15 +2,30 @@
 
 # ## PYTHON IMPORTS
 import os
+import re
+import time
 import sys
 import atexit
 from argparse import ArgumentParser
-from flask import Flask, send_from_directory
+from flask import Flask, request, send_from_directory, abort
+from werkzeug.wsgi import wrap_file
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+try:
+    import waitress
+except ImportError:
+    waitress = None
+try:
+    import gunicorn.app.base
+except ImportError:
+    gunicorn = None
 
 # ## LOCAL IMPORTS
 from app.logical.file import LoadDefault, PutGetJSON
-from app.storage import IMAGE_DIRECTORY
-from app.config import WORKING_DIRECTORY, DATA_FILEPATH, IMAGE_PORT, DEBUG_MODE, VERSION
+from app.logical.ttl_cache import TTLCache
+from app.logical.derivatives import GenerateDerivative, NegotiateDerivativeFormat, DerivativeMimetype
+from app.storage import IMAGE_DIRECTORY, GetDerivativeStore
+from app.config import WORKING_DIRECTORY, DATA_FILEPATH, IMAGE_PORT, DEBUG_MODE, VERSION, IMAGE_SERVER, IMAGE_SERVER_WORKERS,\
+    IMAGE_SERVER_THREADS
 
 
 # #### Python Check
@@ -25,6 +40,19 @@ if sys.version_info.major == 3 and sys.version_info.minor < 7:
 SERVER_PID_FILE = WORKING_DIRECTORY + DATA_FILEPATH + 'images-server-pid.json'
 SERVER_PID = next(iter(LoadDefault(SERVER_PID_FILE, [])), None)
 
+DERIVATIVE_PATH_RG = re.compile(r'^(preview|sample)/[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{32})\.jpg$')
+CONTENT_PATH_RG = re.compile(r'^(?:data/[0-9a-f]{2}/[0-9a-f]{2}|cache)/([0-9a-f]{32})\.\w+$')
+
+# Files are named by the MD5 of their content, so a URL always refers to the same file
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+SERVER_CHOICES = ['auto', 'gunicorn', 'waitress', 'flask']
+
+# Derivatives that couldn't be created in a format (e.g. video previews, which have no original image to be made from),
+# so that the original doesn't get decoded again on every request for them. Entries expire, so that the ones created
+# since by the worker, or by another server process, get sent in the end.
+UNAVAILABLE_DERIVATIVES = TTLCache(10000, 3600)
+
 IMAGES_APP = Flask(__name__)
 IMAGES_APP.config.from_mapping(
     DEBUG=DEBUG_MODE,
@@ -36,16 +64,87 @@ IMAGES_APP.config.from_mapping(
 
 @IMAGES_APP.route('/<path:path>')
 def send_file(path):
+    match = DERIVATIVE_PATH_RG.match(path)
+    if match is not None:
+        return SendDerivative(path, *match.groups())
+    match = CONTENT_PATH_RG.match(path)
+    if match is not None:
+        return SendContentFile(path, match.group(1))
     return send_from_directory(IMAGE_DIRECTORY, path)
 
 
+# #### Helper functions
+
+def SendDerivative(path, type, md5):
+    """Previews and samples are linked to as JPEGs, but get sent in the smallest format that the request accepts.
+    Any that haven't been created yet are made from the original on first request."""
+    store = GetDerivativeStore()
+    file_ext = NegotiateDerivativeFormat(request.accept_mimetypes)
+    key = (type, md5, file_ext)
+    if store.exists(*key):
+        UNAVAILABLE_DERIVATIVES.discard(key)
+    elif UNAVAILABLE_DERIVATIVES.get(key) is not None:
+        file_ext = 'jpg'
+    else:
+        GenerateDerivative(type, md5)
+        if not store.exists(*key):
+            UNAVAILABLE_DERIVATIVES.set(key, True)
+            file_ext = 'jpg'
+    etag = '%s-%s-%s' % (md5, type, file_ext)
+    if store.plain_files:
+        response = SendContentFile(os.path.splitext(path)[0] + '.' + file_ext, etag, DerivativeMimetype(file_ext))
+    else:
+        response = SendPackedFile(store, type, md5, file_ext, etag)
+    response.vary.add('Accept')
+    return response
+
+
+def SendPackedFile(store, type, md5, file_ext, etag):
+    """The file is streamed from a view of the memory-mapped segment, one chunk at a time. send_file only knows the size
+    of a BytesIO, so the response is put together here in order to keep handling Range requests."""
+    file = store.open(type, md5, file_ext)
+    if file is None:
+        # The index entry was dropped, e.g. its segment has gone missing
+        GenerateDerivative(type, md5)
+        file = store.open(type, md5, file_ext)
+    if file is None:
+        abort(404)
+    response = IMAGES_APP.response_class(wrap_file(request.environ, file), mimetype=DerivativeMimetype(file_ext), direct_passthrough=True)
+    response.content_length = file.size
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.expires = int(time.time() + IMMUTABLE_MAX_AGE)
+    response.set_etag(etag)
+    try:
+        response = response.make_conditional(request.environ, accept_ranges=True, complete_length=file.size)
+    except RequestedRangeNotSatisfiable:
+        file.close()
+        raise
+    return SetImmutable(response)
+
+
+def SendContentFile(path, etag, mimetype=None):
+    """Content-addressed files can be cached forever, and get a strong ETag from their MD5. Range and conditional
+    requests are handled by send_file, and servers with a wsgi.file_wrapper get to send the file themselves."""
+    response = send_from_directory(IMAGE_DIRECTORY, path, mimetype=mimetype, etag=etag, max_age=IMMUTABLE_MAX_AGE)
+    return SetImmutable(response)
+
+
+def SetImmutable(response):
+    response.cache_control.immutable = True
+    # Werkzeug only adds this to responses for range requests, but players need it up front to know they can seek
+    response.accept_ranges = 'bytes'
+    return response
+
+
 # #### Initialization
 
 os.environ['FLASK_ENV'] = 'development' if DEBUG_MODE else 'production'
 
 @atexit.register
 def Cleanup():
-    if SERVER_PID is not None:
+    # Forked gunicorn workers exit through here as well
+    if SERVER_PID is not None and SERVER_PID == os.getpid():
         PutGetJSON(SERVER_PID_FILE, 'w', [])
 
 
@@ -63,10 +162,43 @@ def StartServer(args):
         print("\n========== Starting server - Images-%s ==========" % VERSION)
         SERVER_PID = os.getpid()
         PutGetJSON(SERVER_PID_FILE, 'w', [SERVER_PID])
-    if args.public:
-        IMAGES_APP.run(threaded=True, port=IMAGE_PORT, host="0.0.0.0")
+    host = "0.0.0.0" if args.public else "127.0.0.1"
+    server = ChooseServer(args.server)
+    print("Serving images with %s" % server)
+    if server == 'gunicorn':
+        RunGunicorn(host)
+    elif server == 'waitress':
+        waitress.serve(IMAGES_APP, host=host, port=IMAGE_PORT, threads=IMAGE_SERVER_THREADS)
     else:
-        IMAGES_APP.run(threaded=True, port=IMAGE_PORT)
+        IMAGES_APP.run(threaded=True, port=IMAGE_PORT, host=host)
+
+
+def ChooseServer(server):
+    if server == 'auto':
+        if gunicorn is not None and os.name != 'nt':
+            return 'gunicorn'
+        if waitress is not None:
+            return 'waitress'
+        print("Warning: neither gunicorn nor waitress is installed; falling back to the Flask development server. Install waitress with: pip install -r requirements.txt")
+        return 'flask'
+    if (server == 'gunicorn' and gunicorn is None) or (server == 'waitress' and waitress is None):
+        print("%s is not installed; falling back to the Flask server." % server)
+        return 'flask'
+    return server
+
+
+def RunGunicorn(host):
+    """Worker processes each with their own threads; gunicorn sends files with os.sendfile where it can"""
+    class ImageServerApplication(gunicorn.app.base.BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', '%s:%d' % (host, IMAGE_PORT))
+            self.cfg.set('workers', IMAGE_SERVER_WORKERS or os.cpu_count())
+            self.cfg.set('threads', IMAGE_SERVER_THREADS)
+
+        def load(self):
+            return IMAGES_APP
+
+    ImageServerApplication().run()
 
 
 # ## EXECUTION START
@@ -75,5 +207,6 @@ if __name__ == "__main__":
     parser = ArgumentParser(description="Worker to process uploads.")
     parser.add_argument('--title', required=False, default=False, action="store_true", help="Adds server title to console window.")
     parser.add_argument('--public', required=False, default=False, action="store_true", help="Makes the server visible to other computers.")
+    parser.add_argument('--server', required=False, default=IMAGE_SERVER, choices=SERVER_CHOICES, help="WSGI server to run under.")
     args = parser.parse_args()
     StartServer(args)
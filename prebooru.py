@@ -93,10 +93,28 @@ def InitDB(args):
         stamp()
 
 
+def CompactStorage(args):
+    """Moves any previews and samples that are plain files into the packed store, then compacts its segments.
+    The other servers need to be stopped first, since their segments may get rewritten."""
+    from app.config import DERIVATIVE_STORAGE
+    from app.storage import GetDerivativeStore, PackDerivativeFiles
+    if DERIVATIVE_STORAGE != 'packed':
+        print("Previews and samples are kept as plain files; set DERIVATIVE_STORAGE to 'packed' to use the packed store.")
+        return
+    store = GetDerivativeStore()
+    print("Packing files...")
+    print("Files packed:", PackDerivativeFiles(store))
+    print("Compacting segments...")
+    results = store.compact()
+    print("Segments rewritten: %d; Files moved: %d; Files dropped: %d; Bytes reclaimed: %d" %
+          (results['segments'], results['files'], results['dropped'], results['reclaimed']))
+
+
 def Main(args):
     switcher = {
         'server': StartServer,
         'init': InitDB,
+        'compact': CompactStorage,
     }
     switcher[args.type](args)
 
@@ -133,7 +151,7 @@ PREBOORU_APP.jinja_env.add_extension('jinja2.ext.loopcontrols')
 
 if __name__ == '__main__':
     parser = ArgumentParser(description="Server to process network requests.")
-    parser.add_argument('type', choices=['init', 'server'])
+    parser.add_argument('type', choices=['init', 'server', 'compact'])
     parser.add_argument('--new', required=False, default=False, action="store_true", help="Start with a new database file.")
     parser.add_argument('--extension', required=False, default=False, action="store_true", help="Enable Chrome extension.")
     parser.add_argument('--title', required=False, default=False, action="store_true", help="Adds server title to console window.")
@@ -8,30 +8,36 @@ import atexit
 import threading
 from PIL import Image
 import imagehash
-import distance
 import requests
 from io import BytesIO
-from sqlalchemy import func
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy.orm import selectinload
 from argparse import ArgumentParser
 from apscheduler.schedulers.background import BackgroundScheduler
 
 # ## LOCAL IMPORTS
 from app import PREBOORU_APP, SESSION
-import app.models
 from app.models import Post
 from app.cache import MediaFile
 from app.similarity.similarity_data import SimilarityData, HASH_SIZE
 from app.similarity.similarity_pool import SimilarityPool
 from app.similarity.similarity_pool_element import SimilarityPoolElement
-from app.logical.file import PutGetRaw, CreateDirectory
-from app.logical.utility import GetCurrentTime, GetBufferChecksum, DaysFromNow, SetError, SecondsFromNowLocal
-from app.logical.network import GetHTTPFile
+from app.logical.file import PutGetRaw
+from app.logical.utility import GetCurrentTime, GetBufferChecksum, DaysFromNow, SetError, SecondsFromNowLocal, UniqueObjects
+from app.logical.network import GetHTTPFile, CloseSessions
+from app.logical.similarity_index import SimilarityIndex, HammingDistance, HashScore, AllPairsMatches
+from app.logical.similarity_hash import PostHashData, DigestPostsConcurrently, PostDigests, SetCachedHashes, HashPostImages,\
+    HashPostsConcurrently, HashImageFile, ShutdownHashPool, HashBuffersConcurrently, IsVariantHash, ComputedHashEntries, HASH_ALGORITHM
+from app.logical.logger import LogError
 from app.logical.file import LoadDefault, PutGetJSON
 from app.sources.base_source import GetImageSource, NoSource
 from app.database.similarity_pool_element_db import BatchDeleteSimilarityPoolElement
+from app.database.similarity_pool_db import BulkReplaceSimilarityPools
+from app.database.similarity_hash_cache_db import GetCachedHashes, AddCachedHashes
+from app.database.similarity_queue_db import GetSimilarityQueueBatch, GetQueuedPostIDs, EnqueueSimilarityPosts, SetSimilarityQueueState,\
+    ResetSimilarityQueueState, DeleteSimilarityQueuePosts
 from app.storage import CACHE_DATA_DIRECTORY
-from app.config import WORKING_DIRECTORY, DATA_FILEPATH, SIMILARITY_PORT, DEBUG_MODE, VERSION
+from app.config import WORKING_DIRECTORY, DATA_FILEPATH, SIMILARITY_PORT, SIMILARITY_FETCH_WORKERS, DEBUG_MODE, VERSION
 
 
 # ## GLOBAL VARIABLES
@@ -43,7 +49,13 @@ SCHED = None
 SIMILARITY_SEM = threading.Semaphore()
 GENERATE_SEM = threading.Semaphore()
 
-TOTAL_BITS = HASH_SIZE * HASH_SIZE
+FETCH_POOL = None
+
+SIMILARITY_INDEX = SimilarityIndex()
+
+SIMILARITY_WRITE_BATCH = 100
+
+SIMILARITY_QUEUE_BATCH = 100
 
 
 # ## FUNCTIONS
@@ -56,45 +68,71 @@ def check_similarity():
     request_score = request.args.get('score', type=float, default=90.0)
     use_original = request.args.get('use_original', type=bool, default=False)
     include_posts = request.args.get('include_posts', type=bool, default=False)
+    request_limit = request.args.get('limit', type=int)
+    include_histogram = request.args.get('histogram', type=bool, default=False)
     retdata = {'error': False}
-    if request_urls is None:
+    if len(request_urls) == 0:
         return SetError(retdata, "Must include url.")
+    if request_limit is not None and request_limit < 1:
+        return SetError(retdata, "Limit must be a positive number.")
+    image_checks = [CreateImageCheck(image_url, use_original) for image_url in request_urls]
+    error = FetchSimilarityImages(image_checks)
+    if error is not None:
+        return SetError(retdata, error)
+    hash_results = HashBuffersConcurrently([check['buffer'] for check in image_checks])
+    error = next((result['error'] for result in hash_results if result['error'] is not None), None)
+    if error is not None:
+        return SetError(retdata, error)
+    hash_groups = [[(result['image_hash'], result['ratio'])] for result in hash_results]
+    check_results = CheckSimilarityHashes(hash_groups, request_score, include_posts, request_limit, include_histogram)
     similar_results = []
-    for image_url in request_urls:
-        source = GetImageSource(image_url) or NoSource()
-        download_url = source.SmallImageUrl(image_url) if source is not None and not use_original else image_url
-        media = MediaFile.query.filter_by(media_url=download_url).first()
-        if media is None:
-            media, image = CreateNewMedia(download_url, source)
-            if type(image) is str:
-                return SetError(retdata, image)
-        else:
-            image = Image.open(media.file_path)
-        image = image.copy().convert("RGB")
-        image_hash = str(imagehash.whash(image, hash_size=HASH_SIZE))
-        ratio = round(image.width / image.height, 4)
-        smatches = SimilarityData.query.filter(SimilarityData.ratio_clause(ratio), SimilarityData.cross_similarity_clause2(image_hash)).all()
-        score_results = CheckSimilarMatchScores(smatches, image_hash, request_score)
-        all_post_ids = set(result['post_id'] for result in score_results)
-        final_results = []
-        for post_id in all_post_ids:
-            post_results = [result for result in score_results if result['post_id'] == post_id]
-            if len(post_results) > 1:
-                post_results = sorted(post_results, key=lambda x: x['score'], reverse=True)
-            final_results.append(post_results[0])
-        final_results = sorted(final_results, key=lambda x: x['score'], reverse=True)
-        if include_posts:
-            post_ids = [result['post_id'] for result in final_results]
-            posts = app.models.Post.query.filter(app.models.Post.id.in_(post_ids)).all()
-            for result in final_results:
-                post = next(filter(lambda x: x.id == result['post_id'], posts), None)
-                result['post'] = post.to_json() if post is not None else post
-        normalized_url = source.NormalizedImageUrl(image_url) if not use_original else image_url
-        similar_results.append({'image_url': normalized_url, 'post_results': final_results, 'cache': media.file_url})
+    for check, check_result in zip(image_checks, check_results):
+        similar_results.append(dict(image_url=check['normalized_url'], cache=check['cache_url'], **check_result))
     retdata['similar_results'] = similar_results
     return retdata
 
 
+@PREBOORU_APP.route('/check_similarity_file.json', methods=['POST'])
+def check_similarity_file():
+    request_score = request.values.get('score', type=float, default=90.0)
+    include_posts = request.values.get('include_posts', type=bool, default=False)
+    request_limit = request.values.get('limit', type=int)
+    include_histogram = request.values.get('histogram', type=bool, default=False)
+    retdata = {'error': False}
+    if 'file' not in request.files:
+        return SetError(retdata, "Must include file.")
+    if request_limit is not None and request_limit < 1:
+        return SetError(retdata, "Limit must be a positive number.")
+    upload_file = request.files['file']
+    hash_result = HashBuffersConcurrently([upload_file.read()])[0]
+    if hash_result['error'] is not None:
+        return SetError(retdata, hash_result['error'])
+    check_result = CheckSimilarityHashes([[(hash_result['image_hash'], hash_result['ratio'])]], request_score, include_posts, request_limit, include_histogram)[0]
+    retdata['similar_results'] = [dict(filename=upload_file.filename, **check_result)]
+    return retdata
+
+
+@PREBOORU_APP.route('/check_similarity_post.json', methods=['GET'])
+def check_similarity_post():
+    post_id = request.args.get('post_id', type=int)
+    request_score = request.args.get('score', type=float, default=90.0)
+    include_posts = request.args.get('include_posts', type=bool, default=False)
+    request_limit = request.args.get('limit', type=int)
+    include_histogram = request.args.get('histogram', type=bool, default=False)
+    retdata = {'error': False}
+    if post_id is None:
+        return SetError(retdata, "Must include post_id.")
+    if request_limit is not None and request_limit < 1:
+        return SetError(retdata, "Limit must be a positive number.")
+    sdata_items = SimilarityData.query.filter_by(post_id=post_id).all()
+    if len(sdata_items) == 0:
+        return SetError(retdata, "No similarity data found for post #%d." % post_id)
+    hash_group = [(sdata.image_hash, sdata.ratio) for sdata in sdata_items]
+    check_result = CheckSimilarityHashes([hash_group], request_score, include_posts, request_limit, include_histogram, exclude_post_id=post_id)[0]
+    retdata['similar_results'] = [dict(post_id=post_id, **check_result)]
+    return retdata
+
+
 @PREBOORU_APP.route('/generate_similarity.json', methods=['POST'])
 def generate_similarity():
     data = request.get_json()
@@ -108,13 +146,20 @@ def generate_similarity():
             print("Regenerating post #", post.id)
             SimilarityData.query.filter_by(post_id=post.id).delete()
             SESSION.commit()
-            GeneratePostSimilarity(post)
+            SIMILARITY_INDEX.remove(post.id)
             pool = SimilarityPool.query.filter_by(post_id=post.id).first()
             if pool is not None and len(pool.elements) > 0:
                 print("Deleting similarity pool elements:", len(pool.elements))
                 BatchDeleteSimilarityPoolElement(pool.elements)
+            errors = GeneratePostSimilarity(post)
+            if post.id in errors:
+                print("Unable to hash post #", post.id, errors[post.id])
+                EnqueueSimilarityPosts([post.id], 'failed')
+                SetSimilarityQueueState([post.id], 'failed', errors[post.id])
+                continue
             sdata_items = SimilarityData.query.filter_by(post_id=post.id).all()
             PopulateSimilarityPools(sdata_items)
+            EnqueueSimilarityPosts([post.id], 'pooled')
     finally:
         GENERATE_SEM.release()
         print("\n<generate semaphore release>\n")
@@ -129,10 +174,6 @@ def check_posts():
 
 # #### Helper functions
 
-def HexToBinary(inhex):
-    return bin(int(inhex, 16))[2:].zfill(len(inhex * 4))
-
-
 def LoadImage(buffer):
     try:
         file_imgdata = BytesIO(buffer)
@@ -142,6 +183,24 @@ def LoadImage(buffer):
     return image
 
 
+def IncludePostResults(all_post_results):
+    post_ids = set(result['post_id'] for post_results in all_post_results for result in post_results)
+    posts = Post.query.filter(Post.id.in_(post_ids)).all() if len(post_ids) else []
+    post_json_by_id = {post.id: post.to_json() for post in posts}
+    for post_results in all_post_results:
+        for result in post_results:
+            result['post'] = post_json_by_id.get(result['post_id'])
+
+
+def CheckSimilarityHashes(hash_groups, request_score, include_posts, request_limit=None, include_histogram=False, exclude_post_id=None):
+    """Scoring path shared by all of the check routes. Each group is a list of (image_hash, ratio)
+    pairs, and gets back the top results for each similar post across all of its hashes."""
+    check_results = SIMILARITY_INDEX.query_best(hash_groups, request_score, request_limit, exclude_post_id, include_histogram)
+    if include_posts:
+        IncludePostResults([check_result['post_results'] for check_result in check_results])
+    return check_results
+
+
 # #### Auxiliary functions
 
 def ChooseSimilarityResult():
@@ -160,53 +219,89 @@ def ChooseSimilarityResult():
         return sresult
 
 
-def CheckSimilarMatchScores(similarity_results, image_hash, min_score):
-    found_results = []
-    image_binary_string = HexToBinary(image_hash)
-    hamming_time = 0
-    for sresult in similarity_results:
-        sresult_binary_string = HexToBinary(sresult.image_hash)
-        starttime = time.time()
-        mismatching_bits = distance.hamming(image_binary_string, sresult_binary_string)
-        endtime = time.time()
-        hamming_time += (endtime - starttime)
-        miss_ratio = mismatching_bits / TOTAL_BITS
-        score = round((1 - miss_ratio) * 100, 2)
-        if score >= min_score:
-            data = {
-                'post_id': sresult.post_id,
-                'score': score,
-            }
-            found_results.append(data)
-    return sorted(found_results, key=lambda x: x['score'], reverse=True)
-
-
-def GetSimilarMatches(image_hash, ratio):
-    ratio_low = round(ratio * 99, 4) / 100
-    ratio_high = round(ratio * 101, 4) / 100
-    q = SimilarityData.query
-    q = q.filter(SimilarityData.ratio.between(ratio_low, ratio_high))
-    q = q.filter(SimilarityData.cross_similarity_clause2(image_hash))
-    return q.all()
-
-
-def CreateNewMedia(download_url, source):
-    buffer = GetHTTPFile(download_url, headers=source.IMAGE_HEADERS)
+def CreateImageCheck(image_url, use_original):
+    source = GetImageSource(image_url) or NoSource()
+    return {
+        'download_url': source.SmallImageUrl(image_url) if not use_original else image_url,
+        'normalized_url': source.NormalizedImageUrl(image_url) if not use_original else image_url,
+        'headers': source.IMAGE_HEADERS,
+        'extension': None,
+        'file_path': None,
+        'cache_url': None,
+        'buffer': None,
+        'md5': None,
+        'error': None,
+    }
+
+
+def GetFetchPool():
+    global FETCH_POOL
+    if FETCH_POOL is None:
+        FETCH_POOL = ThreadPoolExecutor(max_workers=SIMILARITY_FETCH_WORKERS)
+    return FETCH_POOL
+
+
+def FetchSimilarityImages(image_checks):
+    """Read or download the images of all checks concurrently. New downloads get their media records
+    created here on the calling thread, since the fetch threads do not touch the database."""
+    download_urls = list(set(check['download_url'] for check in image_checks))
+    media_by_url = {media.media_url: media for media in MediaFile.query.filter(MediaFile.media_url.in_(download_urls)).all()}
+    fetches = {}
+    for download_url in download_urls:
+        check = next(check for check in image_checks if check['download_url'] == download_url)
+        fetch = fetches[download_url] = dict(check)
+        media = media_by_url.get(download_url)
+        if media is not None:
+            fetch['file_path'] = media.file_path
+            fetch['cache_url'] = media.file_url
+        else:
+            fetch['extension'] = (GetImageSource(download_url) or NoSource()).GetMediaExtension(download_url)
+    list(GetFetchPool().map(FetchSimilarityImage, fetches.values()))
+    error = next((fetch['error'] for fetch in fetches.values() if fetch['error'] is not None), None)
+    if error is not None:
+        return error
+    new_media = []
+    for fetch in fetches.values():
+        if fetch['md5'] is None:
+            continue
+        media = media_by_url.get(fetch['download_url'])
+        if media is None:
+            media = MediaFile(media_url=fetch['download_url'])
+            new_media.append(media)
+        # Cached files that went missing were downloaded again, so their record gets pointed at the new file
+        media.md5 = fetch['md5']
+        media.file_ext = fetch['extension']
+        media.expires = DaysFromNow(1)
+        fetch['cache_url'] = media.file_url
+    if any(fetch['md5'] is not None for fetch in fetches.values()):
+        SESSION.add_all(new_media)
+        SESSION.commit()
+    for check in image_checks:
+        fetch = fetches[check['download_url']]
+        check.update({'buffer': fetch['buffer'], 'cache_url': fetch['cache_url']})
+
+
+def FetchSimilarityImage(fetch):
+    """Runs in the fetch pool. Reads the cached media file when there is one, otherwise downloads the image."""
+    if fetch['file_path'] is not None:
+        fetch['buffer'] = PutGetRaw(fetch['file_path'], 'rb')
+        if fetch['buffer'] is not None:
+            return
+        fetch['extension'] = os.path.splitext(fetch['file_path'])[1][1:]
+    buffer = GetHTTPFile(fetch['download_url'], headers=fetch['headers'])
     if isinstance(buffer, Exception):
-        return None, "Exception processing download: %s" % repr(buffer)
+        fetch['error'] = "Exception processing download: %s" % repr(buffer)
+        return
     if isinstance(buffer, requests.Response):
-        return None, "HTTP %d - %s" % (buffer.status_code, buffer.reason)
+        fetch['error'] = "HTTP %d - %s" % (buffer.status_code, buffer.reason)
+        return
     image = LoadImage(buffer)
     if type(image) is str:
-        return None, image
-    md5 = GetBufferChecksum(buffer)
-    extension = source.GetMediaExtension(download_url)
-    media = MediaFile(md5=md5, file_ext=extension, media_url=download_url, expires=DaysFromNow(1))
-    CreateDirectory(CACHE_DATA_DIRECTORY)
-    PutGetRaw(media.file_path, 'wb', buffer)
-    SESSION.add(media)
-    SESSION.commit()
-    return media, image
+        fetch['error'] = image
+        return
+    fetch['buffer'] = buffer
+    fetch['md5'] = GetBufferChecksum(buffer)
+    PutGetRaw(CACHE_DATA_DIRECTORY + fetch['md5'] + '.' + fetch['extension'], 'wb', buffer)
 
 
 def ProcessSimilarity():
@@ -227,80 +322,105 @@ def ProcessSimilarity():
 # #### Similarity data functions
 
 def RegeneratePostSimilarity(result, post):
-    image = Image.open(post.preview_path)
-    image_hash = imagehash.whash(image, hash_size=HASH_SIZE)
-    result.image_hash = str(image_hash)
+    result.image_hash = HashImageFile(post.preview_path)
     SESSION.commit()
 
 
 def GeneratePostSimilarity(post):
-    ratio = round(post.width / post.height, 4)
-    preview_image = Image.open(post.preview_path)
-    preview_image = preview_image.convert("RGB")
-    preview_image_hash = str(imagehash.whash(preview_image, hash_size=HASH_SIZE))
-    print("PREVIEW SIZE ADD")
-    simresult = SimilarityData(post_id=post.id, image_hash=preview_image_hash, ratio=ratio)
-    SESSION.add(simresult)
+    return GeneratePostsSimilarity([post])
+
+
+def GeneratePostsSimilarity(posts, workers=None):
+    """Returns a dictionary of post ID -> error for the posts that could not be hashed"""
+    posts_data = DigestPostsConcurrently([PostHashData(post) for post in posts], workers)
+    cached_hashes = GetCachedHashes(PostDigests(posts_data), HASH_ALGORITHM, HASH_SIZE)
+    posts_data = [SetCachedHashes(post_data, cached_hashes) for post_data in posts_data]
+    return SaveSimilarityResults(HashPostsConcurrently(posts_data, workers))
+
+
+def SaveSimilarityResults(hash_results):
+    """Single writer for the hashing stage, which inserts the similarity data in batches"""
+    sdata_items = []
+    cache_entries = {}
+    errors = {}
+    for result in hash_results:
+        cache_entries.update(ComputedHashEntries(result))
+        if result['error'] is not None:
+            print(result['error'])
+            LogError('similarity.SaveSimilarityResults', result['error'])
+            errors[result['post_id']] = result['error']
+            continue
+        print("Post #%d: %d hashes" % (result['post_id'], len(result['hashes'])))
+        sdata_items += [SimilarityData(post_id=result['post_id'], image_hash=image_hash, ratio=result['ratio']) for image_hash in result['hashes']]
+        if len(sdata_items) >= SIMILARITY_WRITE_BATCH:
+            AddCachedHashes(cache_entries, HASH_ALGORITHM, HASH_SIZE)
+            CommitSimilarityData(sdata_items)
+            sdata_items = []
+            cache_entries = {}
+    AddCachedHashes(cache_entries, HASH_ALGORITHM, HASH_SIZE)
+    CommitSimilarityData(sdata_items)
+    return errors
+
+
+def CommitSimilarityData(sdata_items):
+    SESSION.add_all(sdata_items)
+    SESSION.flush()
+    SIMILARITY_INDEX.append(sdata_items)
     SESSION.commit()
-    simresults = [simresult]
-    if post.file_ext != 'mp4':
-        full_image = Image.open(post.file_path)
-        full_image = full_image.convert("RGB")
-        full_image_hash = str(imagehash.whash(full_image, hash_size=HASH_SIZE))
-        score_results = CheckSimilarMatchScores(simresults, full_image_hash, 90.0)
-        if len(score_results) == 0:
-            print("FULL SIZE ADD")
-            simresult = SimilarityData(post_id=post.id, image_hash=full_image_hash, ratio=ratio)
-            SESSION.add(simresult)
-            SESSION.commit()
-            simresults.append(simresult)
-    if post.file_path != post.sample_path:
-        sample_image = Image.open(post.sample_path)
-        sample_image = sample_image.convert("RGB")
-        sample_image_hash = str(imagehash.whash(sample_image, hash_size=HASH_SIZE))
-        score_results = CheckSimilarMatchScores(simresults, sample_image_hash, 90.0)
-        if len(score_results) == 0:
-            print("SAMPLE SIZE ADD")
-            simresult = SimilarityData(post_id=post.id, image_hash=sample_image_hash, ratio=ratio)
-            SESSION.add(simresult)
-            SESSION.commit()
 
 
-def ProcessSimilaritySet():
-    max_post_id = SESSION.query(func.max(SimilarityData.post_id)).scalar() or 0
-    page = Post.query.filter(Post.id > max_post_id).paginate(per_page=100)
-    if len(page.items) == 0:
+def DeletePostsSimilarityData(post_ids):
+    """Clears out any existing hashes, such as for posts that have been queued again"""
+    existing_post_ids = [x[0] for x in SESSION.query(SimilarityData.post_id).filter(SimilarityData.post_id.in_(post_ids)).distinct().all()]
+    if len(existing_post_ids) == 0:
+        return existing_post_ids
+    SimilarityData.query.filter(SimilarityData.post_id.in_(existing_post_ids)).delete(synchronize_session=False)
+    SESSION.commit()
+    SIMILARITY_INDEX.remove_many(existing_post_ids)
+    return existing_post_ids
+
+
+def ProcessSimilaritySet(workers=None):
+    queue_items = GetSimilarityQueueBatch('pending', SIMILARITY_QUEUE_BATCH)
+    if len(queue_items) == 0:
         print("ProcessSimilaritySet: no posts to process")
         return False
+    post_ids = [item.post_id for item in queue_items]
+    posts = Post.query.filter(Post.id.in_(post_ids)).all()
+    found_post_ids = set(post.id for post in posts)
+    deleted_post_ids = [post_id for post_id in post_ids if post_id not in found_post_ids]
+    if len(deleted_post_ids):
+        print("Removing similarity records of deleted posts:", deleted_post_ids)
+        DeletePostsSimilarityData(deleted_post_ids)
+        DeletePostsSimilarityPools(deleted_post_ids, True)
+        DeleteSimilarityQueuePosts(deleted_post_ids)
+    if len(posts) == 0:
+        return True
+    regenerated_post_ids = DeletePostsSimilarityData(list(found_post_ids))
+    if len(regenerated_post_ids):
+        DeletePostsSimilarityPools(regenerated_post_ids, False)
     print("Generating post similarity data.")
-    while True:
-        for post in page.items:
-            GeneratePostSimilarity(post)
-        if not page.has_next:
-            return True
-        page = page.next()
+    errors = GeneratePostsSimilarity(posts, workers)
+    for post_id, error in errors.items():
+        SetSimilarityQueueState([post_id], 'failed', error)
+    SetSimilarityQueueState([post_id for post_id in found_post_ids if post_id not in errors], 'hashed')
+    return True
 
 
 # #### Similarity pool functions
 
 def PopulateSimilarityPools(sdata_items):
+    if len(sdata_items) == 0:
+        return
     print("Generating post similarity pool.")
-    total_matches = []
-    score_results = []
-    for sdata in sdata_items:
-        smatches = SimilarityData.query.filter(SimilarityData.ratio_clause(sdata.ratio), SimilarityData.cross_similarity_clause2(sdata.image_hash), SimilarityData.post_id != sdata.post_id).all()
-        score_results += CheckSimilarMatchScores(smatches, sdata.image_hash, 90.0)
-        total_matches += smatches
-    sibling_post_ids = set(result['post_id'] for result in score_results)
+    post_id = sdata_items[0].post_id
+    hash_group = [(sdata.image_hash, sdata.ratio) for sdata in sdata_items]
+    final_results = SIMILARITY_INDEX.query_best([hash_group], 90.0, exclude_post_id=post_id)[0]['post_results']
+    sibling_post_ids = [result['post_id'] for result in final_results]
     sibling_pools = SimilarityPool.query.options(selectinload(SimilarityPool.elements)).filter(SimilarityPool.post_id.in_(sibling_post_ids)).all()
-    final_results = []
-    for post_id in sibling_post_ids:
-        post_results = [result for result in score_results if result['post_id'] == post_id]
-        post_result = sorted(post_results, key=lambda x: x['score'], reverse=True)[0]
-        final_results.append(post_result)
-    main_pool, index = CreateSimilarityPools(sdata.post_id, final_results, sibling_pools)
+    main_pool, index = CreateSimilarityPools(post_id, final_results, sibling_pools)
     if index is not None:
-        CreateSimilarityPairings(sdata.post_id, final_results, main_pool, sibling_pools, index)
+        CreateSimilarityPairings(post_id, final_results, main_pool, sibling_pools, index)
 
 
 def CreateSimilarityPools(post_id, score_results, sibling_pools):
@@ -313,12 +433,12 @@ def CreateSimilarityPools(post_id, score_results, sibling_pools):
     SESSION.commit()
     if len(score_results) == 0:
         return main_pool, None
-    sibling_post_ids = [spool.post_id for spool in sibling_pools]
+    sibling_post_ids = [result['post_id'] for result in score_results]
     INDEX_POOL_BY_POST_ID = {pool.post_id: pool for pool in sibling_pools}
     add_pools = []
     for post_id in sibling_post_ids:
         if post_id not in INDEX_POOL_BY_POST_ID:
-            pool = SimilarityPool(post_id=post_id, created=current_time, updated=current_time)
+            pool = SimilarityPool(post_id=post_id, created=current_time, updated=current_time, element_count=0)
             add_pools.append(pool)
             INDEX_POOL_BY_POST_ID[post_id] = pool
     if len(add_pools) > 0:
@@ -359,18 +479,61 @@ def CreateSimilarityPairings(post_id, score_results, main_pool, sibling_pools, i
         SESSION.commit()
 
 
+def DeletePostsSimilarityPools(post_ids, delete_pools):
+    """Remove the pool elements of the posts, along with their siblings and any other elements pointing to the posts"""
+    pools = SimilarityPool.query.options(selectinload(SimilarityPool.elements)).filter(SimilarityPool.post_id.in_(post_ids)).all()
+    elements = [element for pool in pools for element in pool.elements]
+    elements += SimilarityPoolElement.query.filter(SimilarityPoolElement.post_id.in_(post_ids)).all()
+    elements = UniqueObjects(elements)
+    if len(elements):
+        BatchDeleteSimilarityPoolElement(elements)
+    if delete_pools and len(pools):
+        for pool in pools:
+            SESSION.delete(pool)
+        SESSION.commit()
+
+
 def ProcessSimilarityPool():
-    max_post_id = SESSION.query(func.max(SimilarityPool.post_id)).scalar() or 0
-    page = Post.query.filter(Post.id > max_post_id).with_entities(Post.id).paginate(per_page=100)
-    while True:
-        all_post_ids = [x[0] for x in page.items]
-        all_sdata_items = SimilarityData.query.filter(SimilarityData.post_id.in_(all_post_ids)).all()
-        for post_id in all_post_ids:
-            sdata_items = [sdata for sdata in all_sdata_items if sdata.post_id == post_id]
-            PopulateSimilarityPools(sdata_items)
-        if not page.has_next:
-            break
-        page = page.next()
+    queue_items = GetSimilarityQueueBatch('hashed', SIMILARITY_QUEUE_BATCH)
+    if len(queue_items) == 0:
+        print("ProcessSimilarityPool: no posts to process")
+        return False
+    post_ids = [item.post_id for item in queue_items]
+    sdata_items_by_post_id = {}
+    for sdata in SimilarityData.query.filter(SimilarityData.post_id.in_(post_ids)).all():
+        sdata_items_by_post_id.setdefault(sdata.post_id, []).append(sdata)
+    pooled_post_ids = []
+    for post_id in post_ids:
+        try:
+            PopulateSimilarityPools(sdata_items_by_post_id.get(post_id, []))
+        except Exception as e:
+            SESSION.rollback()
+            message = "Error populating the similarity pool of post #%d: %s" % (post_id, repr(e))
+            print(message)
+            LogError('similarity.ProcessSimilarityPool', message)
+            SetSimilarityQueueState([post_id], 'failed', message)
+            continue
+        pooled_post_ids.append(post_id)
+    SetSimilarityQueueState(pooled_post_ids, 'pooled')
+    return True
+
+
+def BackfillSimilarityQueue(args=None):
+    """Put every post not yet on the similarity queue onto it, with the state taken from the existing similarity records.
+    Entries of posts that no longer exist are set back to pending, so that draining the queue removes their records."""
+    queued_post_ids = GetQueuedPostIDs()
+    all_post_ids = set(x[0] for x in SESSION.query(Post.id).all())
+    hashed_post_ids = set(x[0] for x in SESSION.query(SimilarityData.post_id).distinct().all())
+    pooled_post_ids = set(x[0] for x in SESSION.query(SimilarityPool.post_id).all())
+    new_post_ids = all_post_ids - queued_post_ids
+    queue_states = {
+        'pooled': [post_id for post_id in new_post_ids if post_id in hashed_post_ids and post_id in pooled_post_ids],
+        'hashed': [post_id for post_id in new_post_ids if post_id in hashed_post_ids and post_id not in pooled_post_ids],
+        'pending': [post_id for post_id in new_post_ids if post_id not in hashed_post_ids] + list(queued_post_ids - all_post_ids),
+    }
+    for state, post_ids in queue_states.items():
+        print("Queueing %d posts as %s." % (len(post_ids), state))
+        EnqueueSimilarityPosts(post_ids, state)
 
 
 # #### Main execution functions
@@ -379,36 +542,50 @@ def GenerateSimilarityResults(args):
     if args.expunge:
         SimilarityData.query.delete()
         SESSION.commit()
-    max_post_id = SESSION.query(func.max(SimilarityData.post_id)).scalar() or 0
-    page = Post.query.filter(Post.id > max_post_id).paginate(per_page=100)
+        ResetSimilarityQueueState(['hashed', 'pooled', 'failed'], 'pending')
+    BackfillSimilarityQueue()
     while True:
-        print("\n%d/%d" % (page.page, page.pages))
-        for post in page.items:
-            GeneratePostSimilarity(post)
-        if not page.has_next:
+        if not ProcessSimilaritySet(args.workers):
             break
-        page = page.next()
     print("Done!")
 
 
 def GenerateSimilarityPools(args):
+    if args.bulk:
+        GenerateSimilarityPoolsBulk()
+        return
     if args.expunge:
         SimilarityPoolElement.query.delete()  # This may not work due to the sibling relationship; may need to do a mass update first
         SESSION.commit()
         SimilarityPool.query.delete()
         SESSION.commit()
-    max_post_id = SESSION.query(func.max(SimilarityPool.post_id)).scalar() or 0
-    page = Post.query.filter(Post.id > max_post_id).with_entities(Post.id).paginate(per_page=100)
+        ResetSimilarityQueueState(['pooled'], 'hashed')
     while True:
-        print("\n%d/%d" % (page.page, page.pages))
-        all_post_ids = [x[0] for x in page.items]
-        all_sdata_items = SimilarityData.query.filter(SimilarityData.post_id.in_(all_post_ids)).all()
-        for post_id in all_post_ids:
-            sdata_items = [sdata for sdata in all_sdata_items if sdata.post_id == post_id]
-            PopulateSimilarityPools(sdata_items)
-        if not page.has_next:
+        if not ProcessSimilarityPool():
             break
-        page = page.next()
+    print("Done!")
+
+
+def GenerateSimilarityPoolsBulk():
+    print("Loading similarity data.")
+    SIMILARITY_INDEX.load()
+    hashes, post_ids, ratios = SIMILARITY_INDEX.hashes, SIMILARITY_INDEX.post_ids, SIMILARITY_INDEX.ratios
+    print("Joining %d hashes." % len(post_ids))
+    starttime = time.time()
+    post_ids1, post_ids2, scores, total_comparisons = AllPairsMatches(hashes, post_ids, ratios, 90.0)
+    join_time = time.time() - starttime
+    print("Writing similarity pools.")
+    starttime = time.time()
+    pair_results = zip(post_ids1.tolist(), post_ids2.tolist(), scores.tolist())
+    pool_count, element_count = BulkReplaceSimilarityPools(post_ids.tolist(), pair_results)
+    ResetSimilarityQueueState(['hashed'], 'pooled')
+    write_time = time.time() - starttime
+    print("\nHashes: %d" % len(post_ids))
+    print("Hash comparisons: %d (%.0f per second)" % (total_comparisons, total_comparisons / max(join_time, 1e-6)))
+    print("Similar post pairs: %d" % len(scores))
+    print("Join time: %.2f seconds" % join_time)
+    print("Pools written: %d, Elements written: %d (%.0f rows per second)" % (pool_count, element_count, (pool_count + element_count) / max(write_time, 1e-6)))
+    print("Write time: %.2f seconds" % write_time)
     print("Done!")
 
 
@@ -417,7 +594,6 @@ def ComparePostSimilarity(args):
     if sresult is None:
         return
     print("Result hash:", sresult.image_hash)
-    sresult_binary_string = HexToBinary(sresult.image_hash)
     while True:
         keyinput = input("Image URL: ")
         if not keyinput:
@@ -434,10 +610,9 @@ def ComparePostSimilarity(args):
         image.copy().convert("RGB")
         image_hash = str(imagehash.whash(image, hash_size=HASH_SIZE))
         print("Image hash:", image_hash)
-        image_binary_string = HexToBinary(image_hash)
-        mismatching_bits = distance.hamming(image_binary_string, sresult_binary_string)
-        miss_ratio = mismatching_bits / TOTAL_BITS
-        score = round((1 - miss_ratio) * 100, 2)
+        mismatching_bits = HammingDistance(image_hash, sresult.image_hash)
+        miss_ratio = mismatching_bits / (HASH_SIZE * HASH_SIZE)
+        score = HashScore(mismatching_bits)
         print("Mismatching:", mismatching_bits, "Ratio:", miss_ratio, "Score:", score)
 
 
@@ -445,36 +620,25 @@ def ComparePosts(args):
     page = Post.query.order_by(Post.id.asc()).paginate(per_page=100)
     while True:
         print("\n%d/%d" % (page.page, page.pages))
-        for post in page.items:
+        posts_data = DigestPostsConcurrently([PostHashData(post) for post in page.items])
+        cached_hashes = GetCachedHashes(PostDigests(posts_data), HASH_ALGORITHM, HASH_SIZE)
+        for post, post_data in zip(page.items, posts_data):
             print("Post #", post.id)
             starttime = time.time()
-            ratio = round(post.width / post.height, 4)
+            result = HashPostImages(SetCachedHashes(post_data, cached_hashes))
+            print("Hash time:", time.time() - starttime)
+            if result['error'] is not None:
+                print(result['error'])
+                continue
+            AddCachedHashes(ComputedHashEntries(result), HASH_ALGORITHM, HASH_SIZE)
             simresults = SimilarityData.query.filter_by(post_id=post.id).all()
-            if post.file_ext != 'mp4':
-                full_image = Image.open(post.file_path)
-                full_image = full_image.convert("RGB")
-                full_image_hash = str(imagehash.whash(full_image, hash_size=HASH_SIZE))
-                print("Full convert time:", time.time() - starttime)
-                score_results = CheckSimilarMatchScores(simresults, full_image_hash, 90.0)
-                if len(score_results) == 0:
-                    print("FULL SIZE ADD")
-                    simresult = SimilarityData(post_id=post.id, image_hash=full_image_hash, ratio=ratio)
-                    SESSION.add(simresult)
-                    SESSION.commit()
-                    simresults.append(simresult)
-                if post.file_path == post.sample_path:
-                    continue
-            starttime = time.time()
-            sample_image = Image.open(post.sample_path)
-            sample_image = sample_image.convert("RGB")
-            sample_image_hash = str(imagehash.whash(sample_image, hash_size=HASH_SIZE))
-            print("Sample convert time:", time.time() - starttime)
-            score_results = CheckSimilarMatchScores(simresults, sample_image_hash, 90.0)
-            if len(score_results) == 0:
-                print("SAMPLE SIZE ADD")
-                simresult = SimilarityData(post_id=post.id, image_hash=sample_image_hash, ratio=ratio)
-                SESSION.add(simresult)
-                SESSION.commit()
+            existing_hashes = [sdata.image_hash for sdata in simresults]
+            for image_hash in result['hashes']:
+                if not IsVariantHash(image_hash, existing_hashes):
+                    print("VARIANT ADD")
+                    SESSION.add(SimilarityData(post_id=post.id, image_hash=image_hash, ratio=result['ratio']))
+                    existing_hashes.append(image_hash)
+            SESSION.commit()
         if not page.has_next:
             break
         page = page.next()
@@ -489,6 +653,9 @@ def StartServer(args):
         print("\n========== Starting server - Similarity-%s ==========" % VERSION)
         SERVER_PID = os.getpid()
         PutGetJSON(SERVER_PID_FILE, 'w', [SERVER_PID])
+        SIMILARITY_INDEX.load()
+        # Posts from before the queue existed, or added while the server was down without being queued
+        BackfillSimilarityQueue()
         SCHED = BackgroundScheduler(daemon=True)
         SCHED.add_job(ProcessSimilarity, next_run_time=SecondsFromNowLocal(5))
         SCHED.start()
@@ -502,10 +669,15 @@ os.environ['FLASK_ENV'] = 'development' if DEBUG_MODE else 'production'
 
 @atexit.register
 def Cleanup():
-    if SERVER_PID is not None:
+    # Spawned hash pool processes re-import this script on Windows, and exit through here as well
+    if SERVER_PID is not None and SERVER_PID == os.getpid():
         PutGetJSON(SERVER_PID_FILE, 'w', [])
     if SCHED is not None and SCHED.running:
         SCHED.shutdown()
+    if FETCH_POOL is not None:
+        FETCH_POOL.shutdown(wait=False)
+    ShutdownHashPool()
+    CloseSessions()
 
 
 # #### Main function
@@ -516,6 +688,7 @@ def Main(args):
         'pools': GenerateSimilarityPools,
         'compare': ComparePostSimilarity,
         'compareposts': ComparePosts,
+        'backfill': BackfillSimilarityQueue,
         'server': StartServer,
     }
     switcher[args.type](args)
@@ -525,9 +698,10 @@ def Main(args):
 
 if __name__ == '__main__':
     parser = ArgumentParser(description="Worker to process uploads.")
-    parser.add_argument('type', choices=['generate', 'pools', 'compare', 'compareposts', 'server'])
+    parser.add_argument('type', choices=['generate', 'pools', 'compare', 'compareposts', 'backfill', 'server'])
     parser.add_argument('--expunge', required=False, default=False, action="store_true", help="Expunge all similarity records.")
+    parser.add_argument('--bulk', required=False, default=False, action="store_true", help="Rebuild all similarity pools in a single vectorized pass.")
     parser.add_argument('--title', required=False, default=False, action="store_true", help="Adds server title to console window.")
-    parser.add_argument('--lastid', required=False, type=int, help="Sets the last post ID to use.")
+    parser.add_argument('--workers', required=False, type=int, help="Number of processes used for hashing images.")
     args = parser.parse_args()
     Main(args)
@@ -10,28 +10,40 @@ import atexit
 import random
 import threading
 import itertools
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from apscheduler.schedulers.background import BackgroundScheduler
 from argparse import ArgumentParser
 
 # ## LOCAL IMPORTS
-from app import database
 from app import DB, SESSION, PREBOORU_APP
 from app.cache import ApiData, MediaFile
-from app.models import Upload, Illust, Artist, Booru
+from app.models import Upload, Illust, Artist
 from app.database.artist_db import UpdateArtistFromSource
-from app.database.booru_db import CreateBooruFromParameters, BooruAppendArtist
+from app.database.booru_db import BatchAppendBooruArtists
 from app.database.illust_db import CreateIllustFromSource, UpdateIllustFromSource
-from app.database.upload_db import IsDuplicate, SetUploadStatus
+from app.database.upload_db import IsDuplicate, SetUploadStatus, StartUploadProcessing, ResumeUpload, UpdateUploadHeartbeats,\
+    GetStalledUploads
 from app.database.error_db import AppendError, CreateAndAppendError
+from app.database.similarity_queue_db import EnqueueSimilarityPosts
+from app.database.cache_db import GetApiCacheStatus
+from app.database.derivative_queue_db import GetDerivativeQueueBatch, SetDerivativeQueueFailed, DeleteDerivativeQueueEntries
+from app.sites import GetSiteKey
 from app.sources.base_source import GetPostSource, GetSourceById
-from app.sources.local_source import SimilarityCheckPosts
+from app.sources.local_source import SimilarityCheckPosts, SimilarityCheckFile
 from app.sources.danbooru_source import GetArtistsByMultipleUrls
-from app.logical.utility import MinutesAgo, GetCurrentTime, SecondsFromNowLocal
+from app.logical.utility import GetCurrentTime, SecondsFromNowLocal, AddDictEntry
 from app.logical.file import LoadDefault, PutGetJSON
+from app.logical.network import CloseSessions
+from app.logical.fetch_engine import ShutdownFetchEngine
+from app.logical.rate_limiter import GetRateLimitStatus
+from app.logical.derivatives import GenerateDerivativesConcurrently, ShutdownDerivativePool
 from app.logical.logger import LogError
 from app.downloader.network_downloader import ConvertNetworkUpload
 from app.downloader.file_downloader import ConvertFileUpload
-from app.config import WORKING_DIRECTORY, DATA_FILEPATH, WORKER_PORT, DEBUG_MODE, VERSION
+from app.config import WORKING_DIRECTORY, DATA_FILEPATH, WORKER_PORT, DEBUG_MODE, VERSION, UPLOAD_WORKERS, UPLOAD_SITE_WORKERS,\
+    UPLOAD_SITE_DEFAULT_WORKERS, BOORU_CHECK_WORKERS, BOORU_CHECK_PAGE_SIZE, UPLOAD_HEARTBEAT_INTERVAL, UPLOAD_HEARTBEAT_TIMEOUT,\
+    UPLOAD_MAX_RESUMES
 
 
 # ## GLOBAL VARIABLES
@@ -42,6 +54,19 @@ SERVER_PID = next(iter(LoadDefault(SERVER_PID_FILE, [])), None)
 SCHED = None
 UPLOAD_SEM = threading.Semaphore()
 BOORU_SEM = threading.Semaphore()
+DERIVATIVE_SEM = threading.Semaphore()
+
+UPLOAD_POOL = None
+
+DERIVATIVE_BATCH_SIZE = 50
+
+# (site_id, site_illust_id) of the illusts currently being uploaded
+ILLUST_LOCKS = set()
+ILLUST_LOCKS_LOCK = threading.Lock()
+
+# IDs of the uploads currently being processed by this worker, which get their heartbeat updated
+ACTIVE_UPLOADS = set()
+ACTIVE_UPLOADS_LOCK = threading.Lock()
 
 BOORU_ARTISTS_DATA = None
 BOORU_ARTISTS_FILE = WORKING_DIRECTORY + DATA_FILEPATH + 'booru_artists_file.json'
@@ -59,6 +84,16 @@ def check_uploads():
     return jsonify(UPLOAD_SEM._value > 0)
 
 
+@PREBOORU_APP.route('/rate_limits')
+def rate_limits():
+    return jsonify(GetRateLimitStatus())
+
+
+@PREBOORU_APP.route('/api_cache')
+def api_cache():
+    return jsonify(GetApiCacheStatus())
+
+
 # #### Helper functions
 
 def CheckRequery(instance):
@@ -80,6 +115,24 @@ def GetUploadWait(upload_id):
         time.sleep(0.5)
 
 
+def LockIllust(illust_key):
+    with ILLUST_LOCKS_LOCK:
+        if illust_key in ILLUST_LOCKS:
+            return False
+        ILLUST_LOCKS.add(illust_key)
+        return True
+
+
+def UnlockIllust(illust_key):
+    with ILLUST_LOCKS_LOCK:
+        ILLUST_LOCKS.discard(illust_key)
+
+
+def GetActiveUploadIDs():
+    with ACTIVE_UPLOADS_LOCK:
+        return list(ACTIVE_UPLOADS)
+
+
 def SaveLastCheckArtistId(max_artist_id):
     BOORU_ARTISTS_DATA['last_checked_artist_id'] = max_artist_id
     PutGetJSON(BOORU_ARTISTS_FILE, 'w', BOORU_ARTISTS_DATA)
@@ -109,7 +162,7 @@ def ProcessUploadWrap(upload):
 
 
 def ProcessUpload(upload):
-    SetUploadStatus(upload, 'processing')
+    StartUploadProcessing(upload)
     if upload.type == 'post':
         ProcessNetworkUpload(upload)
     elif upload.type == 'file':
@@ -151,21 +204,157 @@ def ProcessFileUpload(upload):
         UpdateIllustFromSource(illust, source)
     if CheckRequery(illust.artist):
         UpdateArtistFromSource(illust.artist, source)
+    CheckFileSimilarity(upload)
     if ConvertFileUpload(upload, source):
         SetUploadStatus(upload, 'complete')
     else:
         SetUploadStatus(upload, 'error')
 
 
+def CheckFileSimilarity(upload):
+    """The local file gets sent straight to the similarity server, and any similar posts are noted on the upload"""
+    filepath = upload.sample_filepath if upload.sample_filepath is not None else upload.media_filepath
+    results = SimilarityCheckFile(filepath)
+    if results['error']:
+        print("Similarity check failed on upload #%d: %s" % (upload.id, results['message']))
+        return
+    post_results = [result for result in results['similar_results'][0]['post_results'] if result['post_id'] not in upload.post_ids]
+    if len(post_results) == 0:
+        return
+    similar_posts = ', '.join("post #%d (%0.2f)" % (result['post_id'], result['score']) for result in post_results)
+    CreateAndAppendError('worker.CheckFileSimilarity', "Similar to existing posts: %s" % similar_posts, upload)
+
+
+# #### Upload pool functions
+
+def GetUploadPool():
+    global UPLOAD_POOL
+    if UPLOAD_POOL is None:
+        UPLOAD_POOL = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+    return UPLOAD_POOL
+
+
+def GetUploadTask(upload_id, upload):
+    """The site and illust of an upload, used to limit which uploads can run at the same time"""
+    task = {'upload_id': upload_id, 'site_key': None, 'illust_key': None}
+    if upload is None:
+        return task
+    if upload.type == 'post':
+        source = GetPostSource(upload.request_url)
+        if source is None:
+            return task
+        site_id, site_illust_id = source.SITE_ID, source.GetIllustId(upload.request_url)
+    else:
+        illust = upload.illust_url.illust
+        site_id, site_illust_id = illust.site_id, illust.site_illust_id
+    task['site_key'] = GetSiteKey(site_id)
+    task['illust_key'] = (site_id, site_illust_id)
+    return task
+
+
+def StartUploadTask(task, site_counts):
+    site_limit = UPLOAD_SITE_WORKERS.get(task['site_key'], UPLOAD_SITE_DEFAULT_WORKERS)
+    if site_counts[task['site_key']] >= site_limit:
+        return False
+    if task['illust_key'] is not None and not LockIllust(task['illust_key']):
+        return False
+    site_counts[task['site_key']] += 1
+    return True
+
+
+def FinishUploadTask(task, site_counts):
+    site_counts[task['site_key']] -= 1
+    if task['illust_key'] is not None:
+        UnlockIllust(task['illust_key'])
+
+
+def ProcessUploadTask(upload_id):
+    """Runs in the upload pool. Each pool thread works with its own scoped session, which is removed afterwards."""
+    with ACTIVE_UPLOADS_LOCK:
+        ACTIVE_UPLOADS.add(upload_id)
+    try:
+        # Must retrieve the upload with Flask session object for updating/appending to work
+        upload = GetUploadWait(upload_id)
+        if upload is None:
+            raise Exception("\aUnable to find upload with upload id: %d" % upload_id)
+        if not ProcessUploadWrap(upload):
+            return False, []
+        return True, list(upload.post_ids)
+    finally:
+        with ACTIVE_UPLOADS_LOCK:
+            ACTIVE_UPLOADS.discard(upload_id)
+        SESSION.remove()
+
+
+def ProcessUploadsConcurrently(upload_ids):
+    """Run the uploads in the pool, keeping within the per-site limits and never running two uploads
+    of the same illust at once. No new uploads are started after one has failed. Returns the post IDs,
+    whether all uploads succeeded, and the number of uploads that were started."""
+    uploads = Upload.query.filter(Upload.id.in_(upload_ids)).all()
+    upload_by_id = {upload.id: upload for upload in uploads}
+    pending_tasks = [GetUploadTask(upload_id, upload_by_id.get(upload_id)) for upload_id in upload_ids]
+    pool = GetUploadPool()
+    running_tasks = {}
+    site_counts = Counter()
+    post_ids = []
+    success = True
+    started = 0
+    try:
+        while True:
+            if success:
+                for task in list(pending_tasks):
+                    if len(running_tasks) >= UPLOAD_WORKERS:
+                        break
+                    if StartUploadTask(task, site_counts):
+                        pending_tasks.remove(task)
+                        running_tasks[pool.submit(ProcessUploadTask, task['upload_id'])] = task
+                        started += 1
+            if len(running_tasks) == 0:
+                break
+            done, _ = wait(running_tasks, return_when=FIRST_COMPLETED)
+            for future in done:
+                upload_success, upload_post_ids = FinishUploadFuture(future, running_tasks.pop(future), site_counts)
+                post_ids.extend(upload_post_ids)
+                success = success and upload_success
+    finally:
+        # The illust locks of any uploads still running must be released, or their illusts could never be uploaded again
+        for future in list(running_tasks):
+            _, upload_post_ids = FinishUploadFuture(future, running_tasks.pop(future), site_counts)
+            post_ids.extend(upload_post_ids)
+    return post_ids, success, started
+
+
+def FinishUploadFuture(future, task, site_counts):
+    """Waits on the upload, releasing its task; an upload that raised counts as a failure"""
+    try:
+        return future.result()
+    except Exception as e:
+        print("\a\aProcessUploadTask: Exception occured in worker!\n", e)
+        LogError('worker.ProcessUploadTask', "Unhandled exception occurred on upload #%d: %s" % (task['upload_id'], e))
+        return False, []
+    finally:
+        FinishUploadTask(task, site_counts)
+
+
 # #### Booru functions
 
-def AddDanbooruArtists(url, danbooru_artists, db_boorus, db_artists):
-    artist = next(filter(lambda x: x.booru_search_url == url, db_artists))
-    for danbooru_artist in danbooru_artists:
-        booru = next(filter(lambda x: x.danbooru_id == danbooru_artist['id'], db_boorus), None)
-        if booru is None:
-            booru = CreateBooruFromParameters({'danbooru_id': danbooru_artist['id'], 'current_name': danbooru_artist['name']})
-        BooruAppendArtist(booru, artist)
+def GetBooruCheckPage(last_artist_id):
+    """Pages by ID instead of offset, since artists drop out of the query once they get a booru"""
+    artists = Artist.query.filter(Artist.id > last_artist_id, not_(Artist.boorus.any())).order_by(Artist.id).limit(BOORU_CHECK_PAGE_SIZE).all()
+    artist_ids_by_url = {}
+    for artist in artists:
+        AddDictEntry(artist_ids_by_url, artist.booru_search_url, artist.id)
+    return artist_ids_by_url, (artists[-1].id if len(artists) else None)
+
+
+def AddDanbooruArtists(artist_ids_by_url, danbooru_data):
+    artist_ids = set(itertools.chain(*[artist_ids_by_url[url] for url in danbooru_data if url in artist_ids_by_url]))
+    if len(artist_ids) == 0:
+        return
+    artists = {artist.id: artist for artist in Artist.query.filter(Artist.id.in_(artist_ids)).all()}
+    artist_matches = [(artists[artist_id], danbooru_artist) for url, danbooru_artists in danbooru_data.items()
+                      for artist_id in artist_ids_by_url.get(url, []) for danbooru_artist in danbooru_artists]
+    BatchAppendBooruArtists(artist_matches)
 
 
 # #### Scheduled functions
@@ -178,22 +367,25 @@ def CheckPendingUploads():
         while True:
             print("Current upload count:", SESSION.query(Upload).count())
             upload_ids = GetPendingUploadIDs()
-            for upload_id in upload_ids:
-                # Must retrieve the upload with Flask session object for updating/appending to work
-                upload = GetUploadWait(upload_id)
-                if upload is None:
-                    raise Exception("\aUnable to find upload with upload id: %d" % upload_id)
-                if not ProcessUploadWrap(upload):
-                    return
-                post_ids.extend(upload.post_ids)
-            else:
+            if len(upload_ids) == 0:
                 print("No pending uploads.")
                 break
-            time.sleep(5)
+            upload_post_ids, success, started = ProcessUploadsConcurrently(upload_ids)
+            post_ids.extend(upload_post_ids)
+            if not success:
+                return
+            if started == 0:
+                # Nothing could be started, so the same uploads would only come back again
+                print("Unable to start any of the pending uploads.")
+                break
     finally:
         if len(post_ids) > 0:
+            # Similarity hashing reads the previews, so the new posts need their derivatives first
+            ProcessDerivativeQueue()
+            EnqueueSimilarityPosts(post_ids)
             SCHED.add_job(ContactSimilarityServer)
             SCHED.add_job(CheckForNewArtistBoorus)
+        SESSION.remove()
         UPLOAD_SEM.release()
         print("\n<upload semaphore release>\n")
 
@@ -209,39 +401,78 @@ def CheckForNewArtistBoorus():
     print("<\nbooru semaphore acquire>\n")
     try:
         LoadBooruArtistData()
-        page = Artist.query.filter(Artist.id > BOORU_ARTISTS_DATA['last_checked_artist_id'], not_(Artist.boorus.any())).paginate(per_page=100)
-        max_artist_id = 0
-        while True:
-            if len(page.items) == 0:
-                break
-            query_urls = [artist.booru_search_url for artist in page.items]
-            results = GetArtistsByMultipleUrls(query_urls)
-            if results['error']:
-                print("Danbooru error:", results)
-                break
-            booru_artist_ids = set(artist['id'] for artist in itertools.chain(*[results['data'][url] for url in results['data']]))
-            boorus = Booru.query.filter(Booru.danbooru_id.in_(booru_artist_ids)).all()
-            for url in results['data']:
-                AddDanbooruArtists(url, results['data'][url], boorus, page.items)
-            max_artist_id = max(max_artist_id, *[artist.id for artist in page.items])
-            SaveLastCheckArtistId(max_artist_id)
-            if not page.has_next:
-                break
-            page = page.next()
+        last_artist_id = BOORU_ARTISTS_DATA['last_checked_artist_id']
+        # The Danbooru lookups for the next few pages run while the current one is being saved. Pages are saved
+        # in order, so that the checkpoint only ever covers pages which have been fully processed.
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=BOORU_CHECK_WORKERS) as pool:
+            while True:
+                while last_artist_id is not None and len(pending) < BOORU_CHECK_WORKERS:
+                    artist_ids_by_url, last_artist_id = GetBooruCheckPage(last_artist_id)
+                    if last_artist_id is not None:
+                        pending.append((artist_ids_by_url, last_artist_id, pool.submit(GetArtistsByMultipleUrls, list(artist_ids_by_url.keys()))))
+                if len(pending) == 0:
+                    break
+                artist_ids_by_url, page_artist_id, future = pending.popleft()
+                results = future.result()
+                if results['error']:
+                    print("Danbooru error:", results)
+                    for *_, pending_future in pending:
+                        pending_future.cancel()
+                    break
+                AddDanbooruArtists(artist_ids_by_url, results['data'])
+                SaveLastCheckArtistId(page_artist_id)
     finally:
         BOORU_SEM.release()
         print("\n<booru semaphore release>\n")
 
 
+def UploadHeartbeat():
+    try:
+        UpdateUploadHeartbeats(GetActiveUploadIDs())
+    finally:
+        SESSION.remove()
+
+
+def ProcessDerivativeQueue():
+    DERIVATIVE_SEM.acquire()
+    print("\n<derivative semaphore acquire>\n")
+    try:
+        while True:
+            entries = GetDerivativeQueueBatch(DERIVATIVE_BATCH_SIZE)
+            if len(entries) == 0:
+                break
+            print("Creating derivatives for %d images" % len(entries))
+            results = GenerateDerivativesConcurrently([(entry.md5, entry.file_ext) for entry in entries])
+            for result in results:
+                if len(result['errors']):
+                    SetDerivativeQueueFailed(result['md5'], '; '.join(result['errors']))
+            DeleteDerivativeQueueEntries([result['md5'] for result in results if len(result['errors']) == 0])
+    finally:
+        SESSION.remove()
+        DERIVATIVE_SEM.release()
+        print("\n<derivative semaphore release>\n")
+
+
 def ExpireUploads():
+    """Uploads whose worker stopped sending heartbeats are put back to pending, so that they resume from the last
+    completed step. Uploads that keep on stalling are marked as errors instead."""
     time.sleep(random.random() * 5)
     print("\nExpireUploads")
-    expired_uploads = Upload.query.filter(Upload.created < MinutesAgo(5)).filter_by(status="processing").all()
-    if len(expired_uploads):
-        print("Found %d uploads to expire!" % len(expired_uploads))
-    for upload in expired_uploads:
-        SetUploadStatus(upload, 'complete')
-        database.local.CreateAndAppendError('worker.ExpireUploads', "Upload has expired.", upload)
+    try:
+        stalled_uploads = GetStalledUploads(UPLOAD_HEARTBEAT_TIMEOUT, GetActiveUploadIDs())
+        if len(stalled_uploads) == 0:
+            return
+        print("Found %d stalled uploads!" % len(stalled_uploads))
+        for upload in stalled_uploads:
+            if upload.resumes >= UPLOAD_MAX_RESUMES:
+                SetUploadStatus(upload, 'error')
+                CreateAndAppendError('worker.ExpireUploads', "Upload stalled after being resumed %d times." % upload.resumes, upload)
+            else:
+                ResumeUpload(upload)
+        SCHED.add_job(CheckPendingUploads)
+    finally:
+        SESSION.remove()
 
 
 def ExpungeCacheRecords():
@@ -269,10 +500,16 @@ os.environ['FLASK_ENV'] = 'development' if DEBUG_MODE else 'production'
 
 @atexit.register
 def Cleanup():
-    if SERVER_PID is not None:
+    # Spawned derivative pool processes re-import this script on Windows, and exit through here as well
+    if SERVER_PID is not None and SERVER_PID == os.getpid():
         PutGetJSON(SERVER_PID_FILE, 'w', [])
     if SCHED is not None and SCHED.running:
         SCHED.shutdown()
+    if UPLOAD_POOL is not None:
+        UPLOAD_POOL.shutdown(wait=False)
+    ShutdownFetchEngine()
+    ShutdownDerivativePool()
+    CloseSessions()
 
 
 # #### Main function
@@ -298,6 +535,8 @@ def Main(args):
         SCHED.add_job(CheckPendingUploads, 'interval', minutes=5, next_run_time=SecondsFromNowLocal(15))
         SCHED.add_job(CheckForNewArtistBoorus, 'interval', minutes=5)
         SCHED.add_job(ExpireUploads, 'interval', minutes=1)
+        SCHED.add_job(UploadHeartbeat, 'interval', seconds=UPLOAD_HEARTBEAT_INTERVAL)
+        SCHED.add_job(ProcessDerivativeQueue, 'interval', minutes=5, next_run_time=SecondsFromNowLocal(10))
         SCHED.start()
     PREBOORU_APP.name = 'worker'
     PREBOORU_APP.run(threaded=True, port=WORKER_PORT)